@@ -0,0 +1,97 @@
+#!/usr/bin/env spack-python
+
+# Compare serial and concurrent date-prefix probing in MirrorGHCR.fetch_spec
+# against a local stand-in for a GitHub pages build cache.
+#
+#     spack python benchmarks/ghcr_dates.py --dates 12 --latency 0.05
+#
+# Every lookup starts from an empty temporary misc cache, so it probes the
+# dates instead of finding the spec in the index of an earlier one.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import spack.caches  # noqa: E402
+import spack.spec  # noqa: E402
+from spack.util.file_cache import FileCache  # noqa: E402
+
+import mirrors.health  # noqa: E402
+from mirrors import MirrorGHCR  # noqa: E402
+from server import BuildCacheServer  # noqa: E402
+
+specfile = "linux-ubuntu20.04-x86_64-gcc-10.3.0-zlib-1.2.11-abcdefg.spec.json"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dates", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4, 8])
+    return parser
+
+
+def time_lookup(server, tmp, name, jobs, repeat):
+    """
+    Time a cold lookup of name, with the date prefixes already known.
+
+    Returns the best and mean seconds, and the mean number of requests.
+    """
+    times = []
+    requests = 0
+    for _ in range(repeat):
+        spack.caches.misc_cache = FileCache(tempfile.mkdtemp(dir=tmp))
+        mirror = MirrorGHCR({"url": server.url, "oras": "localhost/bench"},
+                            name="bench")
+        mirror.get_prefixes()
+        server.reset_requests()
+        start = time.time()
+        mirror.fetch_spec(name, jobs=jobs)
+        times.append(time.time() - start)
+        requests += server.requests
+    return min(times), sum(times) / len(times), float(requests) / repeat
+
+
+def main():
+    args = get_parser().parse_args()
+    dates = ["%02d.%02d" % (21 - i // 12, 12 - i % 12)
+             for i in range(args.dates)]
+    payload = spack.spec.Spec("zlib@1.2.11").to_json()
+    cases = [("hit (newest)", specfile),
+             ("hit (oldest)", "old-" + specfile),
+             ("miss", "missing-" + specfile)]
+
+    # Keep the lookups' caches and mirror health out of spack's misc cache
+    misc_cache = spack.caches.misc_cache
+    tmp = tempfile.mkdtemp(prefix="mirror-bench-")
+    mirrors.health._tracker = mirrors.health.HealthTracker(
+        cache=FileCache(os.path.join(tmp, "health")))
+    try:
+        with BuildCacheServer(latency=args.latency) as server:
+            server.add_ghcr_dates(dates)
+            server.add_file("_cache/%s/%s" % (dates[0], specfile), payload)
+            server.add_file("_cache/%s/old-%s" % (dates[-1], specfile),
+                            payload)
+
+            print("%-14s %6s %10s %10s %9s" % (
+                "case", "jobs", "best(s)", "mean(s)", "requests"))
+            for label, name in cases:
+                for jobs in args.jobs:
+                    best, mean, requests = time_lookup(
+                        server, tmp, name, jobs, args.repeat)
+                    print("%-14s %6d %10.3f %10.3f %9.1f" % (
+                        label, jobs, best, mean, requests))
+    finally:
+        spack.caches.misc_cache = misc_cache
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
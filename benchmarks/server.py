@@ -0,0 +1,294 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+A local HTTP stand-in for a GitHub pages build cache, used by benchmarks
+and tests.
+
+The server serves a ``manifest/dates/`` endpoint and specfiles under
+``_cache/<date>/``, and every response is delayed by a fixed latency to
+emulate a round trip to github.io. It can also act as a minimal OCI
+registry (``/v2/`` manifests and blobs, with an optional bearer token),
+like ghcr.io, and serve the ``build_cache/`` layout of a filesystem or S3
+mirror (specfiles, archives, index.json and the _pgp keys index).
+
+Latency can have random jitter added, and a fraction of requests can be
+answered with an error status instead, to see how clients cope.
+"""
+
+import collections
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class BuildCacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve files from the server's ``files`` lookup of path to bytes
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _authorized(self, path):
+        """
+        Registry paths need the bearer token when the server has one
+        """
+        if not self.server.token or not path.startswith("/v2/"):
+            return True
+        if self.headers.get("Authorization") == "Bearer " + self.server.token:
+            return True
+        self._send_empty(401, {"WWW-Authenticate": (
+            'Bearer realm="%s/token",service="stand-in"' % self.server.url)})
+        return False
+
+    def _delay_or_fail(self):
+        """
+        Wait for the latency (and jitter), and return True if an error was
+        sent instead of the response
+        """
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.paths[self.path.split('?')[0]] += 1
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+            delay = server.latency + server.random.uniform(0, server.jitter)
+            fail = server.random.random() < server.error_rate
+            if fail:
+                server.errors += 1
+        time.sleep(delay)
+        with server.lock:
+            server.in_flight -= 1
+        if fail:
+            self._send_empty(server.error_status)
+        return fail
+
+    def do_GET(self):
+        if self._delay_or_fail():
+            return
+        path = self.path.split('?')[0]
+
+        if path == "/token":
+            body = json.dumps({"token": self.server.token}).encode('utf-8')
+            self.server.files["/token"] = body
+        elif not self._authorized(path):
+            return
+
+        body = self.server.files.get(path)
+        if body is None:
+            self._send_empty(404)
+            return
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self._send_empty(304, {"ETag": etag})
+            return
+
+        # Support a single bytes=start-[end] range, for resumed downloads
+        status, start, end = 200, 0, len(body)
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(body)
+            if start >= len(body):
+                self._send_empty(416)
+                return
+            status, end = 206, min(end, len(body))
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                start, end - 1, len(body)))
+        self.end_headers()
+        self.wfile.write(body[start:end])
+
+    def do_HEAD(self):
+        if self._delay_or_fail():
+            return
+        found = self.path.split('?')[0] in self.server.files
+        self.send_response(200 if found else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class BuildCacheServer(object):
+    """
+    A build cache stand-in running on a background thread.
+
+    Use add_file to register content, and url to build absolute urls.
+    Each response waits latency seconds plus up to jitter more, and
+    error_rate of the requests get error_status instead (seed makes the
+    choices repeatable). paths counts the requests for each path, and
+    peak is the most requests that were waiting out the latency at once.
+    """
+    def __init__(self, latency=0.05, host="127.0.0.1", port=0, jitter=0.0,
+                 error_rate=0.0, error_status=503, seed=None):
+        self.httpd = _ThreadingServer((host, port), BuildCacheHandler)
+        self.httpd.latency = latency
+        self.httpd.jitter = jitter
+        self.httpd.error_rate = error_rate
+        self.httpd.error_status = error_status
+        self.httpd.random = random.Random(seed)
+        self.httpd.lock = threading.Lock()
+        self.httpd.files = {}
+        self.httpd.requests = 0
+        self.httpd.errors = 0
+        self.httpd.paths = collections.Counter()
+        self.httpd.in_flight = 0
+        self.httpd.peak = 0
+        self.httpd.token = None
+        self.httpd.url = self.url
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def errors(self):
+        return self.httpd.errors
+
+    @property
+    def paths(self):
+        return self.httpd.paths
+
+    @property
+    def peak(self):
+        return self.httpd.peak
+
+    def reset_requests(self):
+        with self.httpd.lock:
+            self.httpd.requests = 0
+            self.httpd.errors = 0
+            self.httpd.paths.clear()
+            self.httpd.peak = 0
+
+    def add_file(self, path, content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        self.httpd.files["/" + path.lstrip("/")] = content
+
+    def add_json(self, path, data):
+        self.add_file(path, json.dumps(data))
+
+    def add_ghcr_dates(self, dates):
+        """
+        Add the manifest/dates/ endpoint a GHCR pages mirror exposes
+        """
+        self.add_json("manifest/dates/", {
+            "url_prefix": "%s/_cache/" % self.url, "dates": list(dates)})
+
+    def add_build_cache(self, specfiles, prefix="build_cache"):
+        """
+        Add specfiles (a dictionary of name to content) in the layout of a
+        filesystem or S3 mirror's build cache
+        """
+        for name, content in specfiles.items():
+            self.add_file("%s/%s" % (prefix, name), content)
+
+    def add_build_cache_index(self, installs, prefix="build_cache"):
+        """
+        Add a build cache index.json (and its hash) for installs, a
+        dictionary of DAG hash to database record
+        """
+        index = json.dumps({"database": {"version": "6",
+                                         "installs": installs}})
+        self.add_file("%s/index.json" % prefix, index)
+        self.add_file("%s/index.json.hash" % prefix,
+                      hashlib.sha256(index.encode('utf-8')).hexdigest())
+
+    def add_keys(self, fingerprints, prefix="build_cache/_pgp"):
+        """
+        Add public keys and the keys index.json of an S3 style mirror
+        """
+        for fingerprint in fingerprints:
+            self.add_file("%s/%s.pub" % (prefix, fingerprint),
+                          "-----BEGIN PGP PUBLIC KEY BLOCK-----\n%s\n"
+                          "-----END PGP PUBLIC KEY BLOCK-----\n" % fingerprint)
+        self.add_json("%s/index.json" % prefix, {
+            "keys": dict((fingerprint, {}) for fingerprint in fingerprints)})
+
+    def add_ghcr_manifest(self, keys=None, prefix="keys"):
+        """
+        Add the manifest/ endpoint of a GHCR pages mirror, with links to
+        the public keys for fingerprints in keys (which are added too)
+        """
+        links = []
+        for fingerprint in keys or []:
+            link = "%s/%s.pub" % (prefix, fingerprint)
+            self.add_file(link, "-----BEGIN PGP PUBLIC KEY BLOCK-----\n%s\n"
+                          "-----END PGP PUBLIC KEY BLOCK-----\n" % fingerprint)
+            links.append({"link": link, "fingerprint": fingerprint})
+        self.add_json("manifest/", {"keys": links})
+
+    def add_oci_artifact(self, repository, filename, content, tag="latest"):
+        """
+        Add a single file artifact the way oras pushes it to a registry.
+
+        Returns the blob digest.
+        """
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        digest = "sha256:" + hashlib.sha256(content).hexdigest()
+        self.add_file("v2/%s/blobs/%s" % (repository, digest), content)
+        self.add_json("v2/%s/manifests/%s" % (repository, tag), {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "layers": [{
+                "mediaType": "application/vnd.oci.image.layer.v1.tar",
+                "digest": digest,
+                "size": len(content),
+                "annotations": {"org.opencontainers.image.title": filename},
+            }],
+        })
+        return digest
+
+    def require_token(self, token="stand-in-token"):
+        """
+        Make registry (/v2/) requests need a bearer token from /token
+        """
+        self.httpd.token = token
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
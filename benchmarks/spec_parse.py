@@ -0,0 +1,125 @@
+#!/usr/bin/env spack-python
+
+# Compare how Mirror._get_request loaded a specfile before (a buffered
+# response, wrapped in a utf-8 codecs reader for sjson.load) with the
+# streamed response handed to the loader now, both against a local
+# stand-in server with a large synthetic deep-DAG specfile (or a real one).
+#
+#     spack python benchmarks/spec_parse.py --nodes 2000 --depth 8
+#     spack python benchmarks/spec_parse.py --specfile my.spec.json
+#
+# Both paths end in one json parse of the whole body (sjson.load reads it
+# all first), so the difference is the copies made on the way there.
+
+import argparse
+import codecs
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import spack.util.spack_json as sjson  # noqa: E402
+
+from mirrors import Mirror  # noqa: E402
+from mirrors.session import read_from_url  # noqa: E402
+from server import BuildCacheServer  # noqa: E402
+
+specfile = "linux-ubuntu20.04-x86_64-gcc-10.3.0-bench-1.0-abcdefg.spec.json"
+
+
+def synthetic_spec(nodes, depth):
+    """
+    A spec.json shaped document where each node depends on the depth
+    nodes before it, so the DAG is both deep and wide.
+    """
+    def node_hash(i):
+        return hashlib.sha1(str(i).encode('utf-8')).hexdigest()[:32]
+
+    spec_nodes = []
+    for i in range(nodes):
+        spec_nodes.append({
+            "name": "pkg-%d" % i,
+            "version": "1.%d.0" % i,
+            "arch": {"platform": "linux", "platform_os": "ubuntu20.04",
+                     "target": {"name": "broadwell", "vendor": "GenuineIntel",
+                                "features": ["avx", "avx2", "sse4_2"] * 4}},
+            "compiler": {"name": "gcc", "version": "10.3.0"},
+            "namespace": "builtin",
+            "parameters": {"shared": True, "cflags": [], "cxxflags": [],
+                           "patches": [node_hash(i + nodes)]},
+            "dependencies": [
+                {"name": "pkg-%d" % j, "build_hash": node_hash(j),
+                 "type": ["build", "link"]}
+                for j in range(max(0, i - depth), i)],
+            "hash": node_hash(i),
+            "full_hash": node_hash(i),
+            "build_hash": node_hash(i),
+        })
+    return {"spec": {"_meta": {"version": 2}, "nodes": spec_nodes}}
+
+
+def buffered_get_request(url):
+    # What Mirror._get_request did before specfiles were streamed
+    _, _, json_file = read_from_url(url)
+    return sjson.load(codecs.getreader('utf-8')(json_file))
+
+
+def measure(func, url, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(url)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func(url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=2000)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--specfile", help="use a real spec.json instead")
+    args = parser.parse_args()
+
+    if args.specfile:
+        with open(args.specfile, 'rb') as fd:
+            body = fd.read()
+    else:
+        body = json.dumps(synthetic_spec(args.nodes, args.depth)).encode()
+
+    with BuildCacheServer(latency=0) as server:
+        server.add_file("build_cache/" + specfile, body)
+        mirror = Mirror(server.url, name="bench")
+        url = mirror.build_cache_url(specfile)
+        assert buffered_get_request(url) == mirror._get_request(url)
+
+        print("specfile size: %.1f MB" % (len(body) / 1e6))
+        print("%-12s %10s %12s" % ("path", "best(s)", "peak(MB)"))
+        for label, func in (("buffered", buffered_get_request),
+                            ("streamed", mirror._get_request)):
+            best, peak = measure(func, url, args.repeat)
+            print("%-12s %10.4f %12.1f" % (label, best, peak / 1e6))
+
+    # Building the Spec itself is the same in both paths
+    if not args.specfile:
+        return
+    import spack.spec
+    data = sjson.load(body.decode('utf-8'))
+    start = time.time()
+    spack.spec.Spec.from_dict(data)
+    print("Spec.from_dict: %.4f s" % (time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
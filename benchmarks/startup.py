@@ -0,0 +1,110 @@
+#!/usr/bin/env spack-python
+
+# Time what a "spack mirror list" style command pays before any request:
+# importing the mirror modules, creating a MirrorCollection from a config
+# with many mirrors, looking up one mirror and displaying them all. This is
+# compared to building every mirror up front, as the collection used to.
+# Each run is a fresh interpreter, so imports are not already cached.
+#
+#     spack python benchmarks/startup.py --mirrors 48
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+# Run in the child interpreter, prints a json dictionary of timings
+child = """
+import json, os, sys, time
+sys.path.insert(0, %(root)r)
+result = {}
+start = time.time()
+import mirror
+result['import'] = time.time() - start
+
+config = json.loads(%(config)r)
+start = time.time()
+collection = mirror.MirrorCollection(config)
+if %(eager)r:
+    [collection[name] for name in collection]
+result['create'] = time.time() - start
+
+start = time.time()
+collection.lookup(%(lookup)r)
+result['lookup'] = time.time() - start
+
+start = time.time()
+stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+collection.display()
+sys.stdout = stdout
+result['display'] = time.time() - start
+
+result['bindist imported'] = 'spack.binary_distribution' in sys.modules
+
+# What the first network use (or every Mirror() before) pays on top
+start = time.time()
+import spack.binary_distribution
+result['deferred'] = time.time() - start
+print(json.dumps(result))
+"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mirrors", type=int, default=48)
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser
+
+
+def make_config(count):
+    """
+    A mirrors config with a mix of filesystem, s3 and ghcr mirrors
+    """
+    config = {}
+    for i in range(count):
+        kind = ("base", "s3", "ghcr")[i % 3]
+        if kind == "base":
+            config["local-%d" % i] = "file:///mirrors/local-%d" % i
+            continue
+        url = {"url": "https://example.com/cache-%d" % i}
+        if kind == "s3":
+            url = {"url": "s3://bucket-%d" % i, "access_pair": [None, None],
+                   "access_token": None, "profile": None,
+                   "endpoint_url": None}
+        if kind == "ghcr":
+            url["oras"] = "ghcr.io/org/cache-%d" % i
+        config["%s-%d" % (kind, i)] = {"fetch": url, "push": url, "type": kind}
+    return config
+
+
+def run_child(config, lookup, eager):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in sys.path if p)
+    script = child % {"root": root, "config": json.dumps(config),
+                      "lookup": lookup, "eager": eager}
+    output = subprocess.check_output([sys.executable, "-c", script], env=env)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    args = get_parser().parse_args()
+    config = make_config(args.mirrors)
+    lookup = sorted(config)[0]
+
+    for eager in (False, True):
+        runs = [run_child(config, lookup, eager) for _ in range(args.repeat)]
+        label = "built up front" if eager else "built on first use"
+        print("%s (%d mirrors, best of %d)" % (
+            label, args.mirrors, args.repeat))
+        for step in ("import", "create", "lookup", "display"):
+            print("  %-10s %9.4fs" % (step, min(r[step] for r in runs)))
+        print("  spack.binary_distribution imported: %s (deferred %.4fs)" % (
+            runs[0]["bindist imported"], min(r["deferred"] for r in runs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env spack-python
+
+# Run lookup and download scenarios against a local stand-in server and
+# report latency percentiles and throughput as json, to track regressions
+# without github.io, ghcr.io or S3.
+#
+#     spack python benchmarks/suite.py --latency 0.02 --ops 50 -o out.json
+#     spack python benchmarks/suite.py --scenarios hit miss --types ghcr \
+#         --jitter 0.01 --error-rate 0.05
+#
+# Scenarios (and the mirror types they run for):
+#
+#     hit         fetch_spec of specfiles the mirror has (base, s3, ghcr)
+#     miss        fetch_spec of specfiles no one has (base, s3, ghcr)
+#     dates       fetch_spec of specfiles only in the oldest date (ghcr)
+#     keys        a cold sync of the mirror's public keys (s3, ghcr)
+#     download    download a .spack archive, or pull it over OCI (all)
+#     collection  create a MirrorCollection and resolve a batch in it
+#     create      mirror.create of a batch of packages whose archives are on
+#                 the server, in --create-jobs worker processes
+#
+# The s3 mirrors are given the server's http:// url, so they time the S3
+# mirror class (keys index, urls) over the pooled http session. Requests
+# for s3:// urls, which go through spack.util.web and boto3, are not
+# exercised.
+
+import argparse
+import collections
+import hashlib
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import spack.caches  # noqa: E402
+import spack.repo  # noqa: E402
+import spack.spec  # noqa: E402
+from spack.util.file_cache import FileCache  # noqa: E402
+from spack.util.naming import mod_to_class  # noqa: E402
+
+from mirror import MirrorCollection, get_matching_versions  # noqa: E402
+from mirror import create as create_mirror  # noqa: E402
+import mirrors  # noqa: E402
+from mirrors.download import download  # noqa: E402
+from mirrors.health import HealthTracker  # noqa: E402
+from mirrors.keys import Keyring  # noqa: E402
+from server import BuildCacheServer  # noqa: E402
+
+types = ("base", "s3", "ghcr")
+
+# A package of the create scenario, with its archive on the server
+package_template = """\
+from spack import *
+
+
+class {class_name}(Package):
+    url = "{url}"
+
+    version("1.0", sha256="{sha256}")
+
+    def install(self, spec, prefix):
+        pass
+"""
+
+# Scenario name to (function, mirror types it runs for)
+scenarios = collections.OrderedDict()
+
+
+def scenario(name, kinds=types):
+    def register(function):
+        scenarios[name] = (function, kinds)
+        return function
+    return register
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="+", default=list(scenarios),
+                        choices=list(scenarios))
+    parser.add_argument("--types", nargs="+", default=list(types),
+                        choices=list(types))
+    parser.add_argument("--ops", type=int, default=30,
+                        help="operations timed per scenario and mirror type")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--dates", type=int, default=12)
+    parser.add_argument("--keys", type=int, default=20)
+    parser.add_argument("--mirrors", type=int, default=12,
+                        help="mirrors in the collection scenario")
+    parser.add_argument("--batch", type=int, default=20,
+                        help="specfiles resolved per collection operation, "
+                        "and packages per create")
+    parser.add_argument("--create-jobs", type=int, default=4,
+                        help="worker processes of the create scenario")
+    parser.add_argument("--archive-size", type=int, default=1024 * 1024)
+    parser.add_argument("-o", "--output", help="write the json report here")
+    return parser
+
+
+def percentile(values, fraction):
+    """
+    The nearest rank percentile of sorted values
+    """
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1,
+                      int(math.ceil(fraction * len(values))) - 1))
+    return values[rank]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": values[-1] if values else None,
+        "mean": sum(values) / len(values) if values else None,
+    }
+
+
+class Bench(object):
+    """
+    The stand-in server, a run id (so no two runs share specfile names)
+    and helpers to add content and build mirrors for it.
+
+    The spec indices, manifests, blobs and health of the run are kept in a
+    temporary misc cache instead of spack's, so every run starts cold.
+    """
+    def __init__(self, args, server):
+        self.args = args
+        self.server = server
+        self.run_id = uuid.uuid4().hex
+        self.counter = 0
+        self.tmp = tempfile.mkdtemp(prefix="mirror-bench-")
+        self.misc_cache = spack.caches.misc_cache
+        spack.caches.misc_cache = FileCache(os.path.join(self.tmp, "cache"))
+        mirrors.health._tracker = HealthTracker(
+            cache=spack.caches.misc_cache)
+        self.dates = ["%02d.%02d" % (21 - i // 12, 12 - i % 12)
+                      for i in range(args.dates)]
+        self.payload = spack.spec.Spec("zlib@1.2.11").to_json()
+        server.add_ghcr_dates(self.dates)
+
+    def close(self):
+        spack.caches.misc_cache = self.misc_cache
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def unique(self):
+        self.counter += 1
+        return hashlib.sha1(("%s-%d" % (self.run_id, self.counter)).encode(
+            'utf-8')).hexdigest()[:32]
+
+    def specfile(self):
+        return ("linux-ubuntu20.04-x86_64-gcc-10.3.0-zlib-1.2.11-%s.spec.json"
+                % self.unique())
+
+    def add_specfiles(self, count, date=None):
+        """
+        Add count new specfiles to the build cache and to a date of the
+        GHCR layout (the newest by default), returning their names
+        """
+        date = date or self.dates[0]
+        names = [self.specfile() for _ in range(count)]
+        specfiles = dict((name, self.payload) for name in names)
+        self.server.add_build_cache(specfiles)
+        self.server.add_build_cache(specfiles, prefix="_cache/" + date)
+        return names
+
+    def config(self, kind, name="bench"):
+        url = {"url": self.server.url}
+        if kind == "s3":
+            url.update({"access_pair": [None, None], "access_token": None,
+                        "profile": None, "endpoint_url": None})
+        if kind == "ghcr":
+            host = self.server.url.split("://", 1)[1]
+            url.update({"oras": "%s/%s" % (host, name),
+                        "oras_scheme": "http"})
+        if kind == "base":
+            return self.server.url
+        return {"fetch": url, "push": url, "type": kind}
+
+    def mirror(self, kind, name=None):
+        name = name or "bench-%s-%s" % (kind, self.unique()[:8])
+        return mirrors.from_dict(self.config(kind, name), name)
+
+
+def lookup(mirror, name):
+    return mirror.fetch_spec(name, name.replace(".spec.json", ".spec.yaml"))
+
+
+def timed(function, items):
+    """
+    Call function for each item, returning (latencies, failures)
+    """
+    latencies = []
+    failures = 0
+    for item in items:
+        start = time.time()
+        try:
+            if not function(item):
+                failures += 1
+        except Exception:
+            failures += 1
+        latencies.append(time.time() - start)
+    return latencies, failures
+
+
+@scenario("hit")
+def hit(bench, kind):
+    mirror = bench.mirror(kind)
+    names = bench.add_specfiles(bench.args.ops)
+    return timed(lambda name: lookup(mirror, name), names)
+
+
+@scenario("miss")
+def miss(bench, kind):
+    mirror = bench.mirror(kind)
+    names = [bench.specfile() for _ in range(bench.args.ops)]
+    return timed(lambda name: lookup(mirror, name) is None, names)
+
+
+@scenario("dates", kinds=("ghcr",))
+def dates(bench, kind):
+    mirror = bench.mirror(kind)
+    names = bench.add_specfiles(bench.args.ops, date=bench.dates[-1])
+    return timed(lambda name: lookup(mirror, name), names)
+
+
+@scenario("keys", kinds=("s3", "ghcr"))
+def keys(bench, kind):
+    fingerprints = [bench.unique()[:16].upper()
+                    for _ in range(bench.args.keys)]
+    bench.server.add_keys(fingerprints)
+    bench.server.add_ghcr_manifest(fingerprints)
+
+    def sync(i):
+        mirror = bench.mirror(kind)
+        keyring = Keyring(os.path.join(bench.tmp, "keys-%s-%d" % (kind, i)))
+        return len(keyring.sync(mirror)) == len(fingerprints)
+    return timed(sync, range(bench.args.ops))
+
+
+@scenario("download")
+def download_archive(bench, kind):
+    mirror = bench.mirror(kind)
+    dest = tempfile.mkdtemp(dir=bench.tmp)
+
+    def fetch(i):
+        # Each archive is new, so the blob cache does not answer it
+        name = bench.specfile().replace(".spec.json", ".spack")
+        content = os.urandom(bench.args.archive_size)
+        path = os.path.join(dest, name)
+        if kind != "ghcr":
+            bench.server.add_file("build_cache/" + name, content)
+            download(mirror.build_cache_url(name), path)
+        else:
+            oras = "%s/build_cache/%s" % (bench.dates[0], name)
+            bench.server.add_oci_artifact(
+                "%s/%s" % (mirror.name, oras), name, content)
+            spec_url = "%s/_cache/%s" % (bench.server.url, oras.replace(
+                ".spack", ".spec.json"))
+            path = mirror.pull_tarball(
+                mirrors.MirrorDownload(None, spec_url, mirror), dest)
+        return os.path.getsize(path) == len(content)
+    return timed(fetch, range(bench.args.ops))
+
+
+@scenario("collection", kinds=("collection",))
+def collection(bench, kind):
+    args = bench.args
+
+    def create_and_resolve(i):
+        names = bench.add_specfiles(args.batch)
+        config = dict(("bench-%d-%d" % (i, n),
+                       bench.config(types[n % 3], "bench-%d-%d" % (i, n)))
+                      for n in range(args.mirrors))
+        found = MirrorCollection(config).fetch_specs(names)
+        return len(found) == len(names)
+    return timed(create_and_resolve, range(args.ops))
+
+
+@scenario("create", kinds=("create",))
+def bulk_create(bench, kind):
+    args = bench.args
+    repo_root, _ = spack.repo.create_repo(
+        os.path.join(bench.tmp, "repo"), "bench" + bench.run_id[:8])
+    names = ["bench-create-%d" % n for n in range(args.batch)]
+    for name in names:
+        archive = "archives/%s-1.0.tar.gz" % name
+        content = os.urandom(args.archive_size)
+        bench.server.add_file(archive, content)
+        package_dir = os.path.join(repo_root, "packages", name)
+        os.makedirs(package_dir)
+        with open(os.path.join(package_dir, "package.py"), "w") as stream:
+            stream.write(package_template.format(
+                class_name=mod_to_class(name),
+                url="%s/%s" % (bench.server.url, archive),
+                sha256=hashlib.sha256(content).hexdigest()))
+
+    def create(i):
+        # Each operation fills a new mirror, so nothing is present yet
+        path = os.path.join(bench.tmp, "create-%d" % i)
+        with spack.repo.use_repositories(repo_root):
+            specs = get_matching_versions(
+                [spack.spec.Spec(name) for name in names])
+            _, mirrored, errors = create_mirror(path, specs,
+                                                jobs=args.create_jobs)
+        return len(mirrored) == len(names) and not errors
+    return timed(create, range(args.ops))
+
+
+def run(bench, name, kind):
+    function = scenarios[name][0]
+    server = bench.server
+    server.reset_requests()
+    metrics = mirrors.metrics.enable()
+    start = time.time()
+    latencies, failures = function(bench, kind)
+    elapsed = time.time() - start
+    mirrors.set_instrumentation()
+
+    ops = len(latencies)
+    counters = metrics.snapshot()["counters"]
+    result = collections.OrderedDict([
+        ("scenario", name),
+        ("mirror", kind),
+        ("ops", ops),
+        ("failures", failures),
+        ("seconds", elapsed),
+        ("throughput", ops / elapsed if elapsed else None),
+        ("latency", summarize(latencies)),
+        ("requests_per_op", float(server.requests) / ops if ops else None),
+        ("injected_errors", server.errors),
+    ])
+    downloaded = sum(counters.get("download_bytes", {}).values())
+    if downloaded:
+        result["bytes_per_second"] = downloaded / elapsed
+    return result
+
+
+def main():
+    args = get_parser().parse_args()
+    results = []
+    server = BuildCacheServer(latency=args.latency, jitter=args.jitter,
+                              error_rate=args.error_rate,
+                              error_status=args.error_status, seed=args.seed)
+    with server:
+        bench = Bench(args, server)
+        try:
+            for name in args.scenarios:
+                kinds = scenarios[name][1]
+                for kind in kinds:
+                    if kind in types and kind not in args.types:
+                        continue
+                    results.append(run(bench, name, kind))
+                    sys.stderr.write("%-10s %-10s p50 %.4fs p99 %.4fs\n" % (
+                        name, kind, results[-1]["latency"]["p50"],
+                        results[-1]["latency"]["p99"]))
+        finally:
+            bench.close()
+
+    report = collections.OrderedDict([
+        ("time", time.time()),
+        ("python", sys.version.split()[0]),
+        ("config", dict((key, value) for key, value in vars(args).items()
+                        if key != "output")),
+        ("results", results),
+    ])
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env spack-python
+
+# Compare the per-lookup cost of building mirror urls by joining them every
+# time (as lookups used to) with the precomputed base urls of a mirror.
+#
+#     spack python benchmarks/url_build.py --lookups 100000
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spack.util.url as url_util  # noqa: E402
+from spack.binary_distribution import _build_cache_relative_path  # noqa: E402
+
+from mirrors import Mirror, MirrorDownload, MirrorGHCR  # noqa: E402
+
+specfile = "linux-ubuntu20.04-x86_64-gcc-10.3.0-zlib-1.2.11-abcdefg.spec.json"
+spec_url = ("https://autamus.github.io/spack-build-cache/_cache/21.11/"
+            "build_cache/" + specfile)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--url", default="https://mirror.example.com/cache")
+    return parser
+
+
+def joined_spec_urls(mirror):
+    # What Mirror.fetch_spec did for its json and yaml urls
+    return [
+        url_util.join(mirror.fetch_url, _build_cache_relative_path, specfile),
+        url_util.join(mirror.fetch_url, _build_cache_relative_path,
+                      specfile.replace('.json', '.yaml')),
+    ]
+
+
+def built_spec_urls(mirror):
+    return [mirror.build_cache_url(specfile),
+            mirror.build_cache_url(specfile.replace('.json', '.yaml'))]
+
+
+def split_oras(mirror, match):
+    # What MirrorGHCR.get_download_tarball did
+    parts = [x.strip('/') for x in match.spec_url.split('/_cache/')[1:]]
+    oras = mirror._fetch_url['oras'] + "/" + "/".join(parts)
+    return oras.replace('spec.json', 'spack')
+
+
+def main():
+    args = get_parser().parse_args()
+    mirror = Mirror(args.url, name="bench")
+    ghcr = MirrorGHCR({"url": "https://autamus.github.io/spack-build-cache",
+                       "oras": "ghcr.io/autamus/spack-build-cache"},
+                      name="bench-ghcr")
+    match = MirrorDownload(None, spec_url, ghcr)
+
+    assert joined_spec_urls(mirror) == built_spec_urls(mirror)
+    assert split_oras(ghcr, match) == ghcr.get_download_tarball(match)
+
+    cases = [
+        ("spec urls", lambda: joined_spec_urls(mirror),
+         lambda: built_spec_urls(mirror)),
+        ("tarball url", lambda: url_util.join(
+            mirror.fetch_url, _build_cache_relative_path, specfile),
+         lambda: mirror.get_download_tarball(specfile)),
+        ("ghcr oras", lambda: split_oras(ghcr, match),
+         lambda: ghcr.get_download_tarball(match)),
+    ]
+    print("%-12s %14s %14s %9s" % ("case", "joined (us)", "built (us)",
+                                   "speedup"))
+    for label, before, after in cases:
+        old = timeit.timeit(before, number=args.lookups) / args.lookups
+        new = timeit.timeit(after, number=args.lookups) / args.lookups
+        print("%-12s %14.3f %14.3f %8.1fx" % (label, old * 1e6, new * 1e6,
+                                              old / new))
+
+
+if __name__ == "__main__":
+    main()
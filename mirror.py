@@ -12,11 +12,15 @@ where spack is run is not connected to the internet, it allows spack
 to download packages directly from a mirror (e.g., on an intranet).
 """
 import collections
+import multiprocessing
+import multiprocessing.pool
 import operator
 import os
 import os.path
 import re
 import sys
+import threading
+import time
 import traceback
 
 
@@ -34,7 +38,12 @@ import spack.fetch_strategy as fs
 
 # import spack.mirrors # does not exist!
 import mirrors as spack_mirrors
+from mirrors.errors import MirrorRequestError
+from mirrors.metrics import get_instrumentation
+from mirrors.pipeline import Pipeline
+from mirrors.retry import RetryPolicy, is_transient
 import spack.spec
+import spack.stage
 import spack.url as url
 import spack.util.spack_json as sjson
 import spack.util.spack_yaml as syaml
@@ -46,13 +55,23 @@ from spack.version import VersionList
 class MirrorCollection(Mapping):
     """A mapping of mirror names to mirrors."""
 
-    def __init__(self, mirrors=None, scope=None):
-        self._mirrors = collections.OrderedDict()
+    # Number of specs fetch_specs resolves at once
+    fetch_jobs = 16
+
+    # Try the healthiest mirror first, instead of config order
+    health_ordering = True
+
+    def __init__(self, mirrors=None, scope=None, pins=None):
         mirrors = mirrors or spack.config.get('mirrors', scope=scope)
 
-        # Prepare a mirror collection of different types of mirrors
-        for name, mirror in mirrors.items():
-            self._mirrors[name] = spack_mirrors.from_dict(mirror, name)
+        # Mirror names to always try first, in this order
+        self._pins = dict((name, i) for i, name in enumerate(pins or []))
+
+        # Mirrors of different types are built from their config on first
+        # use, so listing or looking up one mirror does not build them all
+        self._config = collections.OrderedDict(mirrors.items())
+        self._mirrors = {}
+        self._lock = threading.Lock()
 
     def to_json(self, stream=None):
         return sjson.dump(self.to_dict(True), stream)
@@ -69,7 +88,7 @@ class MirrorCollection(Mapping):
         return syaml_dict(sorted(
             (
                 (k, (v.to_dict() if recursive else v))
-                for (k, v) in self._mirrors.items()
+                for (k, v) in self.items()
             ), key=operator.itemgetter(0)
         ))
 
@@ -78,11 +97,16 @@ class MirrorCollection(Mapping):
         return MirrorCollection(d)
 
     def __getitem__(self, item):
-        return self._mirrors[item]
+        with self._lock:
+            mirror = self._mirrors.get(item)
+            if mirror is None:
+                mirror = spack_mirrors.from_dict(self._config[item], item)
+                self._mirrors[item] = mirror
+            return mirror
 
     def display(self):
-        max_len = max(len(mirror.name) for mirror in self._mirrors.values())
-        for mirror in self._mirrors.values():
+        max_len = max(len(name) for name in self._config)
+        for mirror in self.values():
             mirror.display(max_len)
 
     def lookup(self, name_or_url):
@@ -100,11 +124,136 @@ class MirrorCollection(Mapping):
 
         return result
 
+    def ordered(self):
+        """Return the mirrors in the order a lookup should try them.
+
+        Pinned mirrors (by the pins given here, or a priority in the
+        mirror's fetch config) come first. The rest are ordered by their
+        recorded latency and error rate, and mirrors whose circuit breaker
+        is open are skipped. With health_ordering off, this is config order.
+        """
+        mirrors = list(self.values())
+        if not self.health_ordering:
+            return mirrors
+
+        def priority(mirror):
+            if mirror.name in self._pins:
+                return (0, self._pins[mirror.name])
+            if mirror.priority is not None:
+                return (1, mirror.priority)
+        return spack_mirrors.get_tracker().order(mirrors, priority)
+
+    def _fetch_first(self, specfile_name):
+        """
+        Fetch one specfile from the first mirror (in order) that has it
+        """
+        deprecated_specfile_name = specfile_name.replace('.spec.json',
+                                                         '.spec.yaml')
+        for mirror in self.ordered():
+            try:
+                download = mirror.fetch_spec(specfile_name,
+                                             deprecated_specfile_name)
+            except MirrorRequestError as e:
+                if e.not_found:
+                    tty.debug('Did not find {0} on {1}'.format(
+                        specfile_name, mirror.name))
+                    continue
+                tty.error('Unable to fetch {0} from {1}, caught exception '
+                          'attempting to read from {2}.'.format(
+                              specfile_name, mirror.name,
+                              url_util.format(e.url or mirror.fetch_url)))
+                tty.debug(e)
+                continue
+            if download:
+                return download
+
+    def fetch_specs(self, specfile_names, jobs=None):
+        """Resolve many specfiles across all mirrors in one pass.
+
+        Specfiles are looked up concurrently, up to jobs at a time. Each
+        one tries the mirrors in the order of ordered() and stops at the first
+        mirror that has it. Returns a dictionary of specfile name to the
+        mirror download, leaving out specfiles that no mirror has.
+        """
+        specfile_names = list(collections.OrderedDict.fromkeys(specfile_names))
+        if not specfile_names or not self._config:
+            return {}
+
+        jobs = min(jobs or self.fetch_jobs, len(specfile_names))
+        if jobs <= 1:
+            downloads = [self._fetch_first(n) for n in specfile_names]
+        else:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            try:
+                downloads = pool.map(self._fetch_first, specfile_names)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        return collections.OrderedDict(
+            (name, download) for name, download
+            in zip(specfile_names, downloads) if download)
+
+    def fetch_spec_set(self, specfile_names, jobs=None):
+        """Resolve many specfiles like fetch_specs, returning the downloads
+        as a MirrorDownloadSet (to look up by DAG hash or group by mirror).
+        """
+        return spack_mirrors.MirrorDownloadSet(
+            self.fetch_specs(specfile_names, jobs).values())
+
+    def refresh_catalog(self, force=False):
+        """Download the build cache index of every mirror into the local
+        catalog, skipping mirrors whose index has not changed.
+        """
+        catalog = spack_mirrors.get_catalog()
+        for mirror in self.values():
+            try:
+                catalog.refresh(mirror, force=force)
+            except Exception as e:
+                tty.debug('Unable to catalog {0}: {1}'.format(mirror.name, e))
+
+    def sync_keys(self, jobs=None):
+        """Update the local keyring from every mirror's keys index.
+
+        Returns a dictionary of fingerprint to the local .pub path.
+        """
+        keys = {}
+        for mirror in self.values():
+            keys.update(mirror.sync_keys(jobs=jobs))
+        return keys
+
+    def locate(self, hashes, refresh=True):
+        """Find which mirrors have each of a list of DAG hashes.
+
+        This is answered from the local catalog of mirror indices (updated
+        first, if refresh is set), so it needs no request per spec. Returns
+        a dictionary of hash to the names of the mirrors that have it, in
+        the order of ordered(), leaving out hashes no mirror has.
+        """
+        if refresh:
+            self.refresh_catalog()
+        mirrors = self.ordered()
+        names = dict((mirror.fetch_url, mirror.name) for mirror in mirrors)
+        rank = dict((mirror.name, i) for i, mirror in enumerate(mirrors))
+        found = spack_mirrors.get_catalog().locate(hashes, set(names))
+        return dict(
+            (dag_hash, sorted(set(names[url] for url, _ in locations),
+                              key=rank.get))
+            for dag_hash, locations in found.items())
+
+    def pipeline(self, dest=None, **kwargs):
+        """Return a Pipeline that resolves, downloads and verifies specfiles
+        (and their dependencies) from these mirrors concurrently.
+
+        Keyword arguments are passed to mirrors.pipeline.Pipeline.
+        """
+        return Pipeline(self, dest=dest, **kwargs)
+
     def __iter__(self):
-        return iter(self._mirrors)
+        return iter(self._config)
 
     def __len__(self):
-        return len(self._mirrors)
+        return len(self._config)
 
 
 def _determine_extension(fetcher):
@@ -313,7 +462,74 @@ def get_mirror_credentials(args):
     return {"fetch": mirror_data, "push": mirror_data, "type": "base"}
 
 
-def create(path, specs, skip_unstable_versions=False):
+def _spec_host(spec):
+    """Return the host a spec's primary source is fetched from, if any."""
+    try:
+        fetch_url = getattr(spec.package.fetcher, 'url', None)
+    except Exception:
+        fetch_url = None
+    if not fetch_url:
+        return None
+    return url_util.parse(fetch_url).netloc or None
+
+
+class _HostLimits(object):
+    """Caps the number of specs fetched at once from any single host.
+
+    With a multiprocessing semaphore, the limits are shared by worker
+    processes forked after get() was called for each host.
+    """
+
+    def __init__(self, per_host, semaphore=threading.BoundedSemaphore):
+        self.per_host = per_host
+        self._semaphore = semaphore
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        if not host or not self.per_host:
+            return None
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = self._semaphore(self.per_host)
+            return self._semaphores[host]
+
+
+def _add_spec(spec, mirror_cache, mirror_stats, host_limits):
+    mirror_stats.next_spec(spec)
+    limit = host_limits.get(_spec_host(spec))
+    if limit is None:
+        _add_single_spec(spec, mirror_cache, mirror_stats)
+    else:
+        with limit:
+            _add_single_spec(spec, mirror_cache, mirror_stats)
+    mirror_stats.next_spec(None)
+
+
+#: The specs, mirror cache and host limits of a parallel create, set before
+#: its worker processes are forked
+_create_state = None
+
+
+def _add_spec_in_process(index):
+    """Add one spec of a parallel create in a worker process, returning its
+    index, counts (see MirrorStats.tally) and the seconds it took."""
+    specs, mirror_cache, host_limits = _create_state
+    mirror_stats = MirrorStats()
+    start = time.time()
+    _add_spec(specs[index], mirror_cache, mirror_stats, host_limits)
+    return index, mirror_stats.tally(specs[index]), time.time() - start
+
+
+def _process_pool(jobs):
+    """A pool of forked worker processes (they inherit the create state)."""
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(jobs)
+    return multiprocessing.Pool(jobs)
+
+
+def create(path, specs, skip_unstable_versions=False, jobs=1,
+           host_jobs=None):
     """Create a directory to be used as a spack mirror, and fill it with
     package archives.
 
@@ -324,6 +540,12 @@ def create(path, specs, skip_unstable_versions=False):
         skip_unstable_versions: if true, this skips adding resources when
             they do not have a stable archive checksum (as determined by
             ``fetch_strategy.stable_target``)
+        jobs: number of specs to stage and cache at once, each in its own
+            worker process (staging changes the working directory, so specs
+            cannot be staged by threads of one process). The default of 1
+            adds specs one after the other.
+        host_jobs: if set, the most specs fetched at once from the same
+            host, so a parallel create does not flood one upstream.
 
     Return Value:
         Returns a tuple of lists: (present, mirrored, error)
@@ -360,13 +582,46 @@ def create(path, specs, skip_unstable_versions=False):
     mirror_stats = MirrorStats()
 
     # Iterate through packages and download all safe tarballs for each
-    for spec in specs:
-        mirror_stats.next_spec(spec)
-        _add_single_spec(spec, mirror_cache, mirror_stats)
+    jobs = min(jobs or 1, len(specs))
+    with get_instrumentation().span('create', mirror_root):
+        if jobs <= 1:
+            host_limits = _HostLimits(host_jobs)
+            for spec in specs:
+                _add_spec(spec, mirror_cache, mirror_stats, host_limits)
+        else:
+            _create_parallel(specs, mirror_cache, mirror_stats, jobs,
+                             host_jobs)
 
     return mirror_stats.stats()
 
 
+def _create_parallel(specs, mirror_cache, mirror_stats, jobs, host_jobs):
+    """Add specs to the mirror cache in jobs worker processes, and tally
+    them in mirror_stats."""
+    global _create_state
+
+    # The host semaphores must exist before the workers fork to be shared
+    host_limits = _HostLimits(host_jobs, multiprocessing.BoundedSemaphore)
+    for spec in specs:
+        host_limits.get(_spec_host(spec))
+
+    instrumentation = get_instrumentation()
+    _create_state = (specs, mirror_cache, host_limits)
+    pool = _process_pool(jobs)
+    try:
+        for index, tally, elapsed in pool.imap_unordered(
+                _add_spec_in_process, range(len(specs))):
+            mirror_stats.add_tally(specs[index], tally)
+            instrumentation.record('add_spec', elapsed,
+                                   getattr(mirror_cache, 'root', None),
+                                   error=tally[2])
+        pool.close()
+    finally:
+        _create_state = None
+        pool.terminate()
+        pool.join()
+
+
 def add(name, url, scope, args={}):
     """Add a named mirror in the given scope"""
     mirrors = spack.config.get('mirrors', scope=scope)
@@ -415,32 +670,78 @@ def remove(name, scope):
 
 
 class MirrorStats(object):
+    """Tallies of present, new and failed specs while creating a mirror.
+
+    The spec being worked on (and its resources) is tracked per thread, so
+    one instance can be shared by a parallel ``create``.
+    """
+
     def __init__(self):
         self.present = {}
         self.new = {}
         self.errors = set()
+        self.retries = collections.Counter()
 
-        self.current_spec = None
-        self.added_resources = set()
-        self.existing_resources = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current_spec(self):
+        return getattr(self._local, 'spec', None)
+
+    @property
+    def added_resources(self):
+        if not hasattr(self._local, 'added'):
+            self._local.added = set()
+        return self._local.added
+
+    @property
+    def existing_resources(self):
+        if not hasattr(self._local, 'existing'):
+            self._local.existing = set()
+        return self._local.existing
 
     def next_spec(self, spec):
         self._tally_current_spec()
-        self.current_spec = spec
+        self._local.spec = spec
 
     def _tally_current_spec(self):
         if self.current_spec:
-            if self.added_resources:
-                self.new[self.current_spec] = len(self.added_resources)
-            if self.existing_resources:
-                self.present[self.current_spec] = len(self.existing_resources)
-            self.added_resources = set()
-            self.existing_resources = set()
-        self.current_spec = None
+            with self._lock:
+                if self.added_resources:
+                    self.new[self.current_spec] = len(self.added_resources)
+                if self.existing_resources:
+                    self.present[self.current_spec] = len(
+                        self.existing_resources)
+            self._local.added = set()
+            self._local.existing = set()
+        self._local.spec = None
 
     def stats(self):
         self._tally_current_spec()
-        return list(self.present), list(self.new), list(self.errors)
+        with self._lock:
+            return list(self.present), list(self.new), list(self.errors)
+
+    def tally(self, spec):
+        """The (present, new, error, retries) counts of one spec, e.g. to
+        send back from a worker process."""
+        self._tally_current_spec()
+        with self._lock:
+            return (self.present.get(spec, 0), self.new.get(spec, 0),
+                    spec in self.errors, self.retries.get(spec, 0))
+
+    def add_tally(self, spec, tally):
+        """Add the counts of a spec from tally() of another MirrorStats."""
+        present, new, error, retries = tally
+        with self._lock:
+            if present:
+                self.present[spec] = present
+            if new:
+                self.new[spec] = new
+            if error:
+                self.errors.add(spec)
+            if retries:
+                self.retries[spec] += retries
 
     def already_existed(self, resource):
         # If an error occurred after caching a subset of a spec's
@@ -452,28 +753,69 @@ class MirrorStats(object):
         self.added_resources.add(resource)
 
     def error(self):
-        self.errors.add(self.current_spec)
+        with self._lock:
+            self.errors.add(self.current_spec)
+
+    def retry(self):
+        with self._lock:
+            self.retries[self.current_spec] += 1
+
+
+#: Fetch errors that another try would only repeat (a bad checksum, or a
+#: problem with the package rather than the download)
+_permanent_fetch_errors = tuple(
+    getattr(fs, name) for name in (
+        'ChecksumError', 'NoStageError', 'NoDigestError', 'NoCacheError',
+        'NoArchiveFileError', 'ExtrapolationError', 'FetcherConflict',
+        'InvalidArgsError')
+    if hasattr(fs, name))
+
+
+def _is_transient_fetch_error(error):
+    """Failed downloads (including "All fetchers failed") are worth another
+    try, bad checksums and other problems of the package are not."""
+    if isinstance(error, _permanent_fetch_errors):
+        return False
+    return isinstance(error, fs.FetchError) or is_transient(error)
+
+
+#: How resources are retried when adding a spec to a mirror
+retry_policy = RetryPolicy(attempts=3, base_delay=1.0, max_delay=30.0,
+                           retry_on=_is_transient_fetch_error)
 
 
-def _add_single_spec(spec, mirror, mirror_stats):
+def _add_single_spec(spec, mirror, mirror_stats, policy=None):
     tty.msg("Adding package {pkg} to mirror".format(
         pkg=spec.format("{name}{@version}")
     ))
-    num_retries = 3
-    while num_retries > 0:
+    policy = policy or retry_policy
+
+    def cache_mirror(stage):
+        # Retry each resource (and patch) on its own, so a failed patch does
+        # not fetch the main archive again
+        policy.call(stage.cache_mirror, mirror, mirror_stats,
+                    on_retry=lambda e: mirror_stats.retry())
+
+    exception = None
+    span = get_instrumentation().span('add_spec',
+                                      getattr(mirror, 'root', None))
+    with span:
         try:
             with spec.package.stage as pkg_stage:
-                pkg_stage.cache_mirror(mirror, mirror_stats)
+                if isinstance(pkg_stage, spack.stage.StageComposite):
+                    stages = list(pkg_stage)
+                else:
+                    stages = [pkg_stage]
+                for stage in stages:
+                    cache_mirror(stage)
                 for patch in spec.package.all_patches():
                     if patch.stage:
-                        patch.stage.cache_mirror(mirror, mirror_stats)
+                        cache_mirror(patch.stage)
                     patch.clean()
-            exception = None
-            break
         except Exception as e:
             exc_tuple = sys.exc_info()
             exception = e
-        num_retries -= 1
+            span.error()
 
     if exception:
         if spack.config.get('config:debug'):
@@ -9,9 +9,12 @@ Retrieve a type specific mirror, with the most basic being a filesystem mirror.
 
 import six
 
-from .base import Mirror
+from .base import Mirror, MirrorDownload, MirrorDownloadSet  # noqa: F401
 from .s3 import MirrorS3
+from .catalog import get_catalog  # noqa: F401
 from .ghcr import MirrorGHCR
+from .health import get_tracker  # noqa: F401
+from .metrics import get_instrumentation, set_instrumentation  # noqa: F401
 
 
 def from_dict(d, name=None):
@@ -0,0 +1,518 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+An asyncio interface to the mirrors, to keep many lookups in flight at once.
+
+The blocking mirrors need a thread for every request they have open. Here
+AsyncMirror (and AsyncMirrorS3, AsyncMirrorGHCR) wrap a mirror with
+coroutine versions of its lookups, so thousands of specfile requests can
+wait on one event loop. The mirror itself still owns its settings, spec
+index and health, and lookups are resolved exactly as the blocking
+fetch_spec would.
+
+Requests go through aiohttp when it is installed. Without it (or for urls
+that are not http or https) they run on the pooled session in a thread
+pool, which still bounds the threads to the session's pool size.
+
+All coroutines run on one event loop shared by the process, in a
+background thread, so blocking code can use them through run() (or the
+fetch_specs facade) without managing a loop. Spec index reads and writes
+and building the Spec run in the transport's thread pool, so they do not
+stall the loop. This module needs Python 3.6 or newer, and is not imported
+by the mirrors package.
+"""
+
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import io
+import threading
+import time
+import weakref
+
+import llnl.util.tty as tty
+
+import spack.util.spack_json as sjson
+import spack.util.url as url_util
+
+from six.moves.urllib.parse import urlsplit
+
+from .base import _specfile_loader
+from .errors import MirrorRequestError, error_for
+from .ghcr import MirrorGHCR
+from .health import get_tracker, is_failure
+from .metrics import get_instrumentation
+from .s3 import MirrorS3
+from .session import _ok_statuses, retry_policy, session
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Requests in flight at once on the shared loop
+max_in_flight = 256
+
+# Seconds an aiohttp request may take in all (reads time out after the
+# session's timeout without data)
+request_timeout = 5 * 60
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """
+    The event loop shared by the process, running in a daemon thread
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever,
+                                      name='mirrors-aio')
+            thread.daemon = True
+            thread.start()
+            _loop, _loop_thread = loop, thread
+            atexit.register(_close_loop)
+        return _loop
+
+
+def run(coroutine):
+    """
+    Run a coroutine on the shared loop and wait for its result.
+
+    This is the way into the async API from blocking code, and must not be
+    called from a coroutine on the shared loop itself.
+    """
+    loop = get_loop()
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError('run() called from the shared mirrors event loop')
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+async def first_hit(func, items, jobs=None):
+    """
+    Return (item, result) for the first item (in order) with a result.
+
+    The coroutine version of parallel.first_hit: func(item) is awaited for
+    up to jobs items at a time (all at once by default), and once an item
+    has a result the later ones are cancelled. Returns None if no item has
+    a result, and an error is raised in order like a result would be.
+    """
+    items = list(items)
+    limit = asyncio.Semaphore(jobs or len(items) or 1)
+
+    async def call(item):
+        async with limit:
+            return await func(item)
+
+    tasks = [asyncio.ensure_future(call(item)) for item in items]
+    try:
+        for item, task in zip(items, tasks):
+            result = await task
+            if result:
+                return item, result
+    finally:
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                task.exception()
+            task.cancel()
+
+
+class Transport(object):
+    """
+    Async GET requests, limited to limit in flight, with the session's
+    retry policy. A transport belongs to the event loop it is first used on.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit or max_in_flight
+        self._semaphore = None
+        self._client = None
+        self._executor = None
+
+    @property
+    def semaphore(self):
+        # Created on first use, so it belongs to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=session.pool_size)
+        return self._executor
+
+    async def in_thread(self, func, *args):
+        """
+        Run a blocking call in the transport's thread pool
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _blocking_get(self, url, headers):
+        response = session.get(url, headers=headers)
+        with response:
+            return response.status, response.headers, response.read()
+
+    async def _get_once(self, url, headers):
+        if aiohttp is None or urlsplit(url).scheme not in ('http', 'https'):
+            status, _, body = await self.in_thread(
+                self._blocking_get, url, headers)
+        else:
+            if self._client is None:
+                self._client = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.limit,
+                                                   ssl=session.context),
+                    timeout=aiohttp.ClientTimeout(
+                        total=request_timeout, sock_connect=session.timeout,
+                        sock_read=session.timeout))
+            try:
+                async with self._client.get(url, headers=headers) as response:
+                    status, body = response.status, await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise error_for(url, reason=str(e) or type(e).__name__)
+        if status not in _ok_statuses:
+            raise error_for(url, status)
+        return body
+
+    async def get(self, url, headers=None, record=None):
+        """
+        Return the body of url, or raise a MirrorRequestError.
+
+        Transient errors are retried with backoff like read_from_url. If
+        given, record is called with the seconds and error (None on success)
+        of every attempt.
+        """
+        retry = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    start = time.time()
+                    try:
+                        body = await self._get_once(url, headers)
+                    except Exception as e:
+                        if record:
+                            record(time.time() - start, e)
+                        raise
+                    if record:
+                        record(time.time() - start, None)
+                    return body
+            except Exception as e:
+                if (retry + 1 >= retry_policy.attempts or
+                        not retry_policy.retry_on(e)):
+                    raise
+                delay = retry_policy.delay(retry)
+                tty.debug('Retrying in {0:.1f}s after: {1}'.format(delay, e))
+            await asyncio.sleep(delay)
+            retry += 1
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+# Transports by event loop, since their semaphore and client are bound to one
+_transports = weakref.WeakKeyDictionary()
+_transports_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    The transport shared by async mirrors on the running event loop, for
+    those that are not given their own
+    """
+    loop = asyncio.get_event_loop()
+    with _transports_lock:
+        transport = _transports.get(loop)
+        if transport is None:
+            transport = _transports[loop] = Transport()
+        return transport
+
+
+async def close_transport():
+    """
+    Close the shared transport of the running event loop, which callers
+    running their own loop should await before closing it. The shared
+    loop's transport is closed at exit.
+    """
+    loop = asyncio.get_event_loop()
+    with _transports_lock:
+        transport = _transports.pop(loop, None)
+    if transport is not None:
+        await transport.close()
+
+
+def _close_loop():
+    """
+    Close the shared loop's transport and stop the loop, at exit
+    """
+    loop = _loop
+    if loop is None or not loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_transport(), loop).result(5)
+    except Exception as e:
+        tty.debug('Unable to close the mirrors transport: {0}'.format(e))
+    loop.call_soon_threadsafe(loop.stop)
+
+
+class AsyncMirror(object):
+    """
+    Coroutine versions of a filesystem (or plain url) mirror's lookups
+    """
+    def __init__(self, mirror, transport=None):
+        self.mirror = mirror
+        self._transport = transport
+
+    @property
+    def transport(self):
+        return self._transport or get_transport()
+
+    @property
+    def name(self):
+        return self.mirror.name
+
+    @property
+    def fetch_url(self):
+        return self.mirror.fetch_url
+
+    def _record(self, elapsed, error):
+        get_tracker().record(self.fetch_url, elapsed, error)
+
+    async def _read(self, url):
+        """
+        The body of url, recording the mirror's latency and health for each
+        attempt (not counting the backoff between them)
+        """
+        get_tracker().start(self.fetch_url)
+        start = time.time()
+        try:
+            body = await self.transport.get(url, record=self._record)
+        except Exception as e:
+            get_instrumentation().record('request', time.time() - start,
+                                         self.fetch_url, is_failure(e))
+            raise
+        get_instrumentation().record('request', time.time() - start,
+                                     self.fetch_url)
+        return body
+
+    async def _get_request(self, url, allow_fail=False, errors=None,
+                           loader=None):
+        """
+        Perform a get request for a url, like Mirror._get_request
+        """
+        loader = loader or sjson.load
+        try:
+            body = await self._read(url)
+        except MirrorRequestError as url_err:
+            if errors is not None:
+                errors.append(url_err)
+            if allow_fail or url_err.not_found:
+                tty.debug('Did not find {0}'.format(url))
+                return
+            tty.error('Unable to perform request to {0}, caught exception '
+                      'attempting to read from {1}.'.format(
+                          url_util.format(self.fetch_url),
+                          url_util.format(url)))
+            tty.debug(url_err)
+            return
+        return loader(io.BytesIO(body))
+
+    async def spec_index(self):
+        # Validating the index the first time may make a request
+        return await self.transport.in_thread(
+            lambda: self.mirror.spec_index)
+
+    async def fetch_spec(self, specfile_name, deprecated_specfile_name=None,
+                         race=None):
+        """
+        Fetch a specfile (json, or else yaml), like Mirror.fetch_spec
+        """
+        if deprecated_specfile_name is None:
+            deprecated_specfile_name = specfile_name.replace('.spec.json',
+                                                             '.spec.yaml')
+        index = await self.spec_index()
+        spec_url = fs = None
+        errors = []
+
+        entry = await self.transport.in_thread(index.lookup, specfile_name)
+        if entry is not None:
+            spec_url = entry['url']
+            if not spec_url:
+                return
+            fs = await self._get_request(spec_url, True, errors,
+                                         _specfile_loader(spec_url))
+
+        if not fs:
+            spec_urls = self.mirror._spec_urls(index, specfile_name,
+                                               deprecated_specfile_name)
+            race = self.mirror.race_formats if race is None else race
+            jobs = 2 if race and not index.spec_format else 1
+            hit = await first_hit(
+                lambda url: self._get_request(url, True, errors,
+                                              _specfile_loader(url)),
+                spec_urls, jobs=jobs)
+            if hit:
+                spec_url, fs = hit
+
+        return await self._resolve_spec(index, entry, specfile_name,
+                                        spec_url, fs, errors)
+
+    async def _resolve_spec(self, *args):
+        # Records the lookup in the index and builds the Spec, off the loop
+        return await self.transport.in_thread(self.mirror._resolve_spec,
+                                              *args)
+
+    async def get_fingerprint_links(self):
+        """
+        Return a list of links (to .pub) for the mirror's public keys
+        """
+        return await self.transport.in_thread(
+            lambda: list(self.mirror.get_fingerprint_links() or []))
+
+    async def iter_fingerprint_links(self):
+        """
+        Yield links (to .pub) for the mirror's public keys
+        """
+        for link in await self.get_fingerprint_links():
+            yield link
+
+
+class AsyncMirrorS3(AsyncMirror):
+
+    async def get_fingerprint_links(self):
+        """
+        Return a list of links (to .pub), from the keys index
+        """
+        mirror = self.mirror
+        tty.debug('Finding public keys in {0}'.format(
+            url_util.format(mirror.fetch_url)))
+
+        json_index = await self._get_request(mirror.keys_url('index.json'),
+                                             allow_fail=True)
+        if not json_index:
+            return []
+        return [mirror.keys_url(fingerprint + '.pub')
+                for fingerprint in json_index['keys']]
+
+
+class AsyncMirrorGHCR(AsyncMirror):
+
+    async def get_prefixes(self):
+        # The manifests are cached (and revalidated) for the whole process
+        return await self.transport.in_thread(self.mirror.get_prefixes)
+
+    async def get_manifest(self):
+        return await self.transport.in_thread(self.mirror.get_manifest)
+
+    async def get_fingerprint_links(self):
+        manifest = await self.get_manifest()
+        if not manifest:
+            return []
+        return manifest.get('keys', [])
+
+    async def fetch_spec(self, specfile_name, _=None, jobs=None):
+        """
+        Fetch a specfile from the newest date prefix that has it, like
+        MirrorGHCR.fetch_spec
+        """
+        mirror = self.mirror
+        index = await self.spec_index()
+        errors = []
+
+        entry = await self.transport.in_thread(index.lookup, specfile_name)
+        if entry is not None:
+            if not entry['url']:
+                return
+            result = await self._get_request(entry['url'], True, errors)
+            if result:
+                return await self._resolve_spec(index, entry, specfile_name,
+                                                entry['url'], result, errors)
+
+        prefixes = await self.get_prefixes()
+        if not prefixes:
+            return
+
+        # Every date is requested at once unless the mirror limits it
+        jobs = jobs or mirror._fetch_url.get('probe_jobs')
+        json_urls = mirror._date_urls(prefixes, specfile_name)
+        json_url, result = await first_hit(
+            lambda url: self._get_request(url, True, errors),
+            json_urls, jobs=jobs) or (None, None)
+        return await self._resolve_spec(index, entry, specfile_name,
+                                        json_url, result, errors)
+
+
+def from_mirror(mirror, transport=None):
+    """
+    Wrap a mirror in the async mirror class for its type
+    """
+    if isinstance(mirror, MirrorGHCR):
+        return AsyncMirrorGHCR(mirror, transport)
+    if isinstance(mirror, MirrorS3):
+        return AsyncMirrorS3(mirror, transport)
+    return AsyncMirror(mirror, transport)
+
+
+class AsyncMirrorCollection(object):
+    """
+    Coroutine lookups across a MirrorCollection, in its ordered() order
+    """
+    def __init__(self, collection, transport=None):
+        self.collection = collection
+        self._mirrors = dict(
+            (id(mirror), from_mirror(mirror, transport))
+            for mirror in collection.values())
+
+    async def fetch_spec(self, specfile_name):
+        """
+        Fetch one specfile from the first mirror (in order) that has it
+        """
+        for mirror in self.collection.ordered():
+            try:
+                download = await self._mirrors[id(mirror)].fetch_spec(
+                    specfile_name)
+            except MirrorRequestError as e:
+                if e.not_found:
+                    tty.debug('Did not find {0} on {1}'.format(
+                        specfile_name, mirror.name))
+                    continue
+                tty.error('Unable to fetch {0} from {1}, caught exception '
+                          'attempting to read from {2}.'.format(
+                              specfile_name, mirror.name,
+                              url_util.format(e.url or mirror.fetch_url)))
+                tty.debug(e)
+                continue
+            if download:
+                return download
+
+    async def fetch_specs(self, specfile_names):
+        """
+        Resolve many specfiles at once, like MirrorCollection.fetch_specs
+        """
+        specfile_names = list(collections.OrderedDict.fromkeys(specfile_names))
+        downloads = await asyncio.gather(
+            *[self.fetch_spec(name) for name in specfile_names])
+        return collections.OrderedDict(
+            (name, download) for name, download
+            in zip(specfile_names, downloads) if download)
+
+
+def fetch_specs(collection, specfile_names):
+    """
+    Blocking facade: resolve specfiles across a MirrorCollection on the
+    shared event loop, returning the same result as its fetch_specs
+    """
+    return run(AsyncMirrorCollection(collection).fetch_specs(specfile_names))
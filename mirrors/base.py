@@ -13,19 +13,38 @@ import llnl.util.tty as tty
 
 import spack.spec
 import spack.util.url as url_util
-import spack.util.web as web_util
 import spack.util.spack_json as sjson
 import spack.util.spack_yaml as syaml
 from spack.util.spack_yaml import syaml_dict
-from six.moves.urllib.error import URLError
 
-import codecs
+import collections
+import os
+import threading
+import time
+
+from . import blobs
+from .catalog import index_entries
+from .download import download
+from .errors import MirrorRequestError
+from .health import get_tracker
+from .index import SpecIndex
+from .keys import get_keyring
+from .metrics import get_instrumentation
+from .parallel import first_hit
+from .session import read_from_url, retry_policy
 
 
 def _is_string(url):
     return isinstance(url, six.string_types)
 
 
+def _specfile_loader(url):
+    """
+    Return the function that loads a specfile stream, by its extension
+    """
+    return sjson.load if url.endswith('json') else syaml.load
+
+
 def _display_mirror_entry(size, name, url, type_=None):
     if type_:
         type_ = "".join((" (", type_, ")"))
@@ -34,23 +53,173 @@ def _display_mirror_entry(size, name, url, type_=None):
     print("%-*s%s%s" % (size + 4, name, url, type_))
 
 
+def _specfile_checksum(data):
+    """
+    Return the archive digest (algorithm:hex) recorded in a specfile, if any
+    """
+    checksum = data.get('binary_cache_checksum') or {}
+    if checksum.get('hash'):
+        return "%s:%s" % (checksum.get('hash_algorithm', 'sha256'),
+                          checksum['hash'])
+
+
 class MirrorDownload(object):
     """
     A mirror download keeps a record of a mirror and spec to download
+
+    The checksum is the digest of the archive, when the specfile has it.
+    Records are immutable and slotted, since a batch resolve can hold tens
+    of thousands of them. Indexing one like a dictionary (download["spec"],
+    download.get("checksum")) is kept for older callers.
     """
-    def __init__(self, spec, spec_url, mirror):
-        self.spec = spec
-        self.spec_url = spec_url
-        self.mirror = mirror
+    __slots__ = ('spec', 'spec_url', 'mirror', 'checksum')
 
-    def to_dict(self):
-        return {"spec": self.spec, "mirror_url": self.mirror.fetch_url,
-                "mirror": self.mirror, "spec_url": self.spec_url}
+    _keys = ("spec", "mirror_url", "mirror", "spec_url", "checksum")
+
+    def __init__(self, spec, spec_url, mirror, checksum=None):
+        set_attr = super(MirrorDownload, self).__setattr__
+        set_attr('spec', spec)
+        set_attr('spec_url', spec_url)
+        set_attr('mirror', mirror)
+        set_attr('checksum', checksum)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MirrorDownload is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("MirrorDownload is immutable")
+
+    def __reduce__(self):
+        return (MirrorDownload,
+                (self.spec, self.spec_url, self.mirror, self.checksum))
+
+    def __repr__(self):
+        return "MirrorDownload(%r, %r)" % (self.spec_url, self.mirror_url)
+
+    def __eq__(self, other):
+        if not isinstance(other, MirrorDownload):
+            return NotImplemented
+        return (self.spec_url == other.spec_url and
+                self.mirror_url == other.mirror_url)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash((self.spec_url, self.mirror_url))
 
     @property
     def mirror_url(self):
         return self.mirror.fetch_url
 
+    @property
+    def dag_hash(self):
+        return self.spec.dag_hash()
+
+    # The dictionary view, for callers of the old to_dict() results
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self._keys:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self._keys)
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self._keys)
+
+
+class MirrorDownloadSet(object):
+    """
+    A set of mirror downloads, indexed by DAG hash and by mirror (url)
+
+    The same spec can be on several mirrors, so each hash maps to the
+    downloads for it in the order they were added.
+    """
+    def __init__(self, downloads=None):
+        self._downloads = collections.OrderedDict()
+        self._by_hash = collections.OrderedDict()
+        self._by_mirror = collections.OrderedDict()
+        for item in downloads or []:
+            self.add(item)
+
+    def add(self, download):
+        """
+        Add a download, returning False if it was already in the set
+        """
+        if download is None or download in self._downloads:
+            return False
+        self._downloads[download] = None
+        self._by_hash.setdefault(download.dag_hash, []).append(download)
+        self._by_mirror.setdefault(download.mirror_url, []).append(download)
+        return True
+
+    def update(self, downloads):
+        for item in downloads:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._downloads)
+
+    def __iter__(self):
+        return iter(self._downloads)
+
+    def __contains__(self, item):
+        """
+        True for a download in the set, or the DAG hash of one
+        """
+        if isinstance(item, MirrorDownload):
+            return item in self._downloads
+        return item in self._by_hash
+
+    def __repr__(self):
+        return "MirrorDownloadSet(%d specs on %d mirrors)" % (
+            len(self._by_hash), len(self._by_mirror))
+
+    def hashes(self):
+        return list(self._by_hash)
+
+    def mirror_urls(self):
+        return list(self._by_mirror)
+
+    def get(self, dag_hash, default=None):
+        """
+        The first download added for a DAG hash
+        """
+        downloads = self._by_hash.get(dag_hash)
+        return downloads[0] if downloads else default
+
+    def by_hash(self, dag_hash):
+        return list(self._by_hash.get(dag_hash, []))
+
+    def by_mirror(self, mirror):
+        """
+        The downloads on a mirror, given the mirror or its fetch url
+        """
+        if not _is_string(mirror):
+            mirror = mirror.fetch_url
+        return list(self._by_mirror.get(mirror, []))
+
+    def group_by_mirror(self):
+        """
+        An ordered dictionary of mirror url to its downloads
+        """
+        return collections.OrderedDict(
+            (url, list(downloads)) for url, downloads
+            in self._by_mirror.items())
+
+    def missing(self, dag_hashes):
+        """
+        The DAG hashes (of those given) that no download in the set has
+        """
+        return [h for h in dag_hashes if h not in self._by_hash]
+
 
 class Mirror(object):
     """A named location for storing source tarballs and binary packages
@@ -58,16 +227,41 @@ class Mirror(object):
     The default used to be s3, and now they are split into two classes to
     allow for extendability or customization if needed.
     """
+
+    # Seconds a resolved spec location (or a miss) is trusted, None uses
+    # the default. A mirror's fetch config can set miss_ttl too.
+    spec_index_ttl = None
+    spec_miss_ttl = None
+
+    # Seconds between checks of the mirror's manifest token, which drop
+    # the spec index (and so every known miss) when the mirror changes
+    manifest_check_interval = 300
+
+    # Request the json and yaml specfiles at the same time when the mirror's
+    # format is not known yet, instead of one after the other
+    race_formats = False
+
     def __init__(self, fetch_url, push_url=None, name=None, **kwargs):
         self._fetch_url = fetch_url
         self._push_url = push_url
         self._name = name
-
-        # S3 puts keys alongside the key cache storage, provide if needed
+        self._base_urls = None
+        self._spec_index = None
+        self._spec_index_checked = None
+        self._spec_index_lock = threading.Lock()
+
+    # S3 puts keys alongside the key cache storage, provide if needed. These
+    # import spack.binary_distribution (which is slow) on first network use,
+    # not when the mirror is created.
+    @property
+    def _build_cache_relative_path(self):
         from spack.binary_distribution import _build_cache_relative_path
+        return _build_cache_relative_path
+
+    @property
+    def _build_cache_keys_relative_path(self):
         from spack.binary_distribution import _build_cache_keys_relative_path
-        self._build_cache_relative_path = _build_cache_relative_path
-        self._build_cache_keys_relative_path = _build_cache_keys_relative_path
+        return _build_cache_keys_relative_path
 
     def to_json(self, stream=None):
         return sjson.dump(self.to_dict(), stream)
@@ -75,9 +269,64 @@ class Mirror(object):
     def to_yaml(self, stream=None):
         return syaml.dump(self.to_dict(), stream)
 
+    def _urls(self):
+        """
+        The mirror's base urls, joined once and reused by every lookup.
+
+        Each ends with a slash, so a url under it is a concatenation.
+        """
+        urls = self._base_urls
+        if urls is None:
+            build_cache = url_util.join(self.fetch_url,
+                                        self._build_cache_relative_path)
+            keys = url_util.join(build_cache,
+                                 self._build_cache_keys_relative_path)
+            urls = self._base_urls = {
+                'build_cache': build_cache.rstrip('/') + '/',
+                'keys': keys.rstrip('/') + '/',
+            }
+        return urls
+
+    def build_cache_url(self, name):
+        """
+        The url of a file (specfile, tarball or index) in the build cache
+        """
+        return self._urls()['build_cache'] + name
+
+    def keys_url(self, name):
+        """
+        The url of a file (a .pub, or the index) in the build cache keys
+        """
+        return self._urls()['keys'] + name
+
     def get_download_tarball(self, tarball, _=None):
-        relpath = self._build_cache_relative_path
-        return url_util.join(self.fetch_url, relpath, tarball)
+        return self.build_cache_url(tarball)
+
+    def fetch_tarball(self, match, dest=None):
+        """
+        Download the .spack archive for a fetch_spec match into dest.
+
+        If the specfile has the archive checksum, the local blob cache is
+        used first and the download is verified against it.
+        """
+        import spack.binary_distribution as bindist
+        tarball = bindist.tarball_path_name(match.spec, '.spack')
+        url = self.get_download_tarball(tarball)
+        path = os.path.join(dest or os.getcwd(), os.path.basename(tarball))
+
+        digest = match.checksum
+        instrumentation = get_instrumentation()
+
+        def fetch(dest):
+            downloaded = download(url, dest, digest=digest)
+            instrumentation.count('archive_bytes',
+                                  os.path.getsize(downloaded), self.fetch_url)
+            return downloaded
+
+        with instrumentation.span('fetch_tarball', self.fetch_url):
+            if not digest:
+                return fetch(path)
+            return blobs.fetch(digest, path, fetch)
 
     @staticmethod
     def from_yaml(stream, name=None):
@@ -139,54 +388,201 @@ class Mirror(object):
             ')'
         ))
 
-    def _get_request(self, url, allow_fail=False):
+    @property
+    def priority(self):
+        """
+        An explicit pin (lower is tried first), or None to order by health
+        """
+        if isinstance(self._fetch_url, dict):
+            return self._fetch_url.get('priority')
+
+    def _read(self, url, **kwargs):
+        """
+        read_from_url for this mirror, recording its latency and health.
+
+        Transient errors are retried here rather than in read_from_url, so
+        each attempt is recorded on its own and the backoff in between is
+        not counted as latency.
+        """
+        with get_instrumentation().span('request', self.fetch_url):
+            return retry_policy.call(self._read_once, url, **kwargs)
+
+    def _read_once(self, url, **kwargs):
+        get_tracker().start(self.fetch_url)
+        start = time.time()
+        try:
+            result = read_from_url(url, retries=0, **kwargs)
+        except Exception as e:
+            get_tracker().record(self.fetch_url, time.time() - start, e)
+            raise
+        get_tracker().record(self.fetch_url, time.time() - start)
+        return result
+
+    def _get_request(self, url, allow_fail=False, errors=None, loader=None):
         """
         Perform a basic get request for a URL, allow fail (or not)
+
+        The response is handed to loader (json by default) as a file, with
+        no utf-8 reader around it, and is parsed once. If errors is a list,
+        a failed request's MirrorRequestError is added to it so the caller
+        can tell a missing file from other problems.
         """
+        loader = loader or sjson.load
         try:
-            _, _, json_file = web_util.read_from_url(url)
-            return sjson.load(codecs.getreader('utf-8')(json_file))
-        except (URLError, web_util.SpackWebError) as url_err:
-            if allow_fail:
+            _, _, response = self._read(url, stream=True)
+            with response:
+                return loader(response)
+        except MirrorRequestError as url_err:
+            if errors is not None:
+                errors.append(url_err)
+            if allow_fail or url_err.not_found:
                 tty.debug('Did not find {0}'.format(url))
                 return
-            if web_util.url_exists(url):
-                err_msg = [
-                    'Unable to perform request to {0},',
-                    ' caught exception attempting to read from {1}.',
-                ]
-                tty.error(''.join(err_msg).format(url_util.format(url)))
-                tty.debug(url_err)
-
-    def fetch_spec(self, specfile_name, deprecated_specfile_name):
+            err_msg = [
+                'Unable to perform request to {0},',
+                ' caught exception attempting to read from {1}.',
+            ]
+            tty.error(''.join(err_msg).format(
+                url_util.format(self.fetch_url), url_util.format(url)))
+            tty.debug(url_err)
+
+    def _get_manifest_token(self):
         """
-        Fetch from S3, supporting both json and yaml, return MirrorDownload
+        Return a token that changes when the mirror's build cache changes.
+
+        For a filesystem or S3 mirror this is the build cache index hash.
         """
-        relpath = self._build_cache_relative_path
+        hash_url = self.build_cache_url('index.json.hash')
+        try:
+            _, _, fs = self._read(hash_url)
+            return fs.read().decode('utf-8').strip()
+        except MirrorRequestError:
+            tty.debug('No build cache index hash at {0}'.format(hash_url))
 
-        # First try json, and then fall back to yaml
-        spec_url = url_util.join(self.fetch_url, relpath, specfile_name)
+    def get_index_entries(self):
+        """
+        Return (hash, name, specfile name, spec url) for every spec in the
+        mirror's build cache index.json, or None if it has no index
+        """
+        index = self._get_request(self.build_cache_url('index.json'),
+                                  allow_fail=True)
+        if index is None:
+            return
+        return [(dag_hash, name, specfile,
+                 specfile and self.build_cache_url(specfile))
+                for dag_hash, name, specfile in index_entries(index)]
 
-        fs = self._get_request(spec_url, allow_fail=True)
-        if not fs:
-            spec_url = url_util.join(self.fetch_url, relpath, deprecated_specfile_name)
-            fs = self._get_request(spec_url, allow_fail=True)
+    @property
+    def spec_index(self):
+        """
+        The persistent index of spec locations and misses, revalidated
+        against the manifest token every manifest_check_interval seconds.
+
+        The token request is made outside the lock by the one thread whose
+        turn it is, other lookups go on with the index meanwhile. A new
+        (empty) index has nothing to drop, so it is not checked until the
+        next interval (and its entries are dropped once then, since they
+        were not recorded against a token).
+        """
+        with self._spec_index_lock:
+            if self._spec_index is None:
+                miss_ttl = self.spec_miss_ttl
+                if isinstance(self._fetch_url, dict):
+                    miss_ttl = self._fetch_url.get('miss_ttl', miss_ttl)
+                self._spec_index = SpecIndex(self.name, self.fetch_url,
+                                             ttl=self.spec_index_ttl,
+                                             miss_ttl=miss_ttl)
+                if self._spec_index.empty():
+                    self._spec_index_checked = time.time()
+            index = self._spec_index
+            checked = self._spec_index_checked
+            due = (checked is None or
+                   time.time() - checked >= self.manifest_check_interval)
+            if due:
+                self._spec_index_checked = time.time()
+        if due:
+            index.validate(self._get_manifest_token())
+        return index
+
+    def _spec_urls(self, index, specfile_name, deprecated_specfile_name):
+        """
+        The json and yaml specfile urls, the format last served first
+        """
+        spec_urls = [
+            self.build_cache_url(specfile_name),
+            self.build_cache_url(deprecated_specfile_name)
+        ]
+        if index.spec_format == 'yaml':
+            spec_urls.reverse()
+        return spec_urls
+
+    def _resolve_spec(self, index, entry, specfile_name, spec_url, fs, errors):
+        """
+        Record the outcome of a lookup in the index and build the result
 
-        # If we still don't have a result, no go, return empty
+        fs is the loaded specfile from spec_url, or None if it was not
+        found, and entry is what the index had before the lookup.
+        """
+        # If we still don't have a result, no go, return empty. Only a
+        # definite not found is remembered as a miss.
         if not fs:
+            if all(e.not_found for e in errors):
+                index.update(specfile_name, None)
             return
+        if entry is None or entry['url'] != spec_url:
+            index.update(specfile_name, spec_url)
+
+        spec_format = 'json' if spec_url.endswith('json') else 'yaml'
+        if spec_format != index.spec_format:
+            index.spec_format = spec_format
 
-        # Which function and specfile name to use?
-        func = (spack.spec.Spec.from_json if spec_url.endswith('json')
-                else spack.spec.Spec.from_yaml)
+        # read the spec from the build cache file (already loaded from json
+        # or yaml). All specs in build caches are concrete (as they are
+        # built) so we need to mark this spec concrete on read-in.
+        spec = spack.spec.Spec.from_dict(fs)
+        return MirrorDownload(spec, spec_url, self, _specfile_checksum(fs))
 
-        specfile_contents = codecs.getreader('utf-8')(fs).read()
+    def fetch_spec(self, specfile_name, deprecated_specfile_name, race=None):
+        """
+        Fetch from S3, supporting both json and yaml, return MirrorDownload
+
+        The format the mirror served last is tried first. If it is not known
+        yet and race (or the mirror's race_formats) is set, both formats are
+        requested at once and json is preferred.
+        """
+        with get_instrumentation().span('fetch_spec', self.fetch_url):
+            return self._fetch_spec(specfile_name, deprecated_specfile_name,
+                                    race)
+
+    def _fetch_spec(self, specfile_name, deprecated_specfile_name, race):
+        index = self.spec_index
+        spec_url = fs = None
+        errors = []
+
+        # A known location (or known miss) skips the discovery requests
+        entry = index.lookup(specfile_name)
+        if entry is not None:
+            spec_url = entry['url']
+            if not spec_url:
+                return
+            fs = self._get_request(spec_url, allow_fail=True, errors=errors,
+                                   loader=_specfile_loader(spec_url))
 
-        # read the spec from the build cache file. All specs in build caches
-        # are concrete (as they are built) so we need to mark this spec
-        # concrete on read-in.
-        spec = func(specfile_contents)
-        return MirrorDownload(spec, spec_url, self).to_dict()
+        # By default, first try json, and then fall back to yaml
+        if not fs:
+            spec_urls = self._spec_urls(index, specfile_name,
+                                        deprecated_specfile_name)
+            race = self.race_formats if race is None else race
+            jobs = 2 if race and not index.spec_format else 1
+            hit = first_hit(
+                lambda url: self._get_request(
+                    url, True, errors=errors, loader=_specfile_loader(url)),
+                spec_urls, jobs=jobs)
+            if hit:
+                spec_url, fs = hit
+
+        return self._resolve_spec(index, entry, specfile_name, spec_url, fs,
+                                  errors)
 
     @property
     def name(self):
@@ -198,6 +594,19 @@ class Mirror(object):
     def get_fingerprint_links(self):
         return []
 
+    def get_key_links(self):
+        """
+        Return a lookup of fingerprint to (link to .pub, key metadata)
+        """
+        return {}
+
+    def sync_keys(self, jobs=None):
+        """
+        Update the local keyring from the mirror's keys index, downloading
+        only new or changed keys. Returns fingerprint to local .pub path.
+        """
+        return get_keyring().sync(self, jobs=jobs)
+
     def fetch(self, **kwargs):
         """
         Fetch a spec based on id from a url
@@ -230,24 +639,35 @@ class Mirror(object):
 
     @property
     def fetch_url(self):
+        if isinstance(self._fetch_url, dict):
+            return self._fetch_url["url"]
         return self._fetch_url
 
     @property
     def push_url(self):
         if self._push_url is None:
-            return self._fetch_url
+            return self.fetch_url
+        if isinstance(self._push_url, dict):
+            return self._push_url["url"]
         return self._push_url
 
     @fetch_url.setter
     def fetch_url(self, url):
-        self._fetch_url["url"] = url
+        if isinstance(self._fetch_url, dict):
+            self._fetch_url["url"] = url
+        else:
+            self._fetch_url = url
         self._normalize()
 
     @push_url.setter
     def push_url(self, url):
-        self._push_url["url"] = url
+        if isinstance(self._push_url, dict):
+            self._push_url["url"] = url
+        else:
+            self._push_url = url
         self._normalize()
 
     def _normalize(self):
         if self._push_url is not None and self._push_url == self._fetch_url:
             self._push_url = None
+        self._base_urls = None
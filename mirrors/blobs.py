@@ -0,0 +1,227 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+A content addressed cache of downloaded build cache archives.
+
+Archives are stored by digest, so the same .spack file pulled from two
+mirrors (or two GHCR date prefixes) is only downloaded once. Blobs are
+stored read-only and hardlinked into place, so a hit costs no copy and
+writing to a file we handed out cannot change the cache. Across devices
+they are reflinked, or, where the filesystem cannot, copied. The least
+recently used entries are removed when the cache is over its size budget.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+import llnl.util.tty as tty
+from llnl.util.filesystem import mkdirp
+
+import spack.caches
+
+from .download import Digest, normalize_digest
+from .metrics import get_instrumentation
+
+# Default size budget, in bytes
+default_max_size = 10 * 1024 ** 3
+
+# Mode of stored blobs, which are shared with the files linked to them
+_read_only = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+# ioctl request for a copy-on-write clone on Linux (btrfs, xfs)
+_FICLONE = 0x40049409
+
+
+def _reflink(source, dest):
+    """
+    Clone source to dest copy-on-write, returning False if unsupported
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return True
+        except (IOError, OSError):
+            pass
+    os.remove(dest)
+    return False
+
+
+def link_or_copy(source, dest):
+    """
+    Put source at dest as a hardlink, or a reflink or copy where source is
+    on another device (or the filesystem has no hardlinks)
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+        return
+    except (AttributeError, OSError):
+        pass
+    if not _reflink(source, dest):
+        shutil.copyfile(source, dest)
+
+
+class BlobCache(object):
+    """
+    Archives on disk by digest, under root/<algorithm>/<xx>/<hex>
+    """
+    def __init__(self, root=None, max_size=None):
+        self._root = root
+        self.max_size = default_max_size if max_size is None else max_size
+        self._lock = threading.Lock()
+
+        # Bytes in the cache, counted once and then kept up to date
+        self._size = None
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = os.path.join(spack.caches.misc_cache.root,
+                                      'mirrors', 'blobs')
+        return self._root
+
+    def path(self, digest):
+        algorithm, _, hexdigest = normalize_digest(digest).partition(':')
+        return os.path.join(self.root, algorithm, hexdigest[:2], hexdigest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def link(self, digest, dest):
+        """
+        Put the cached blob for digest at dest. Returns False on a miss.
+        """
+        if not digest:
+            return False
+        if digest not in self:
+            get_instrumentation().count('blob_cache_misses')
+            return False
+        path = self.path(digest)
+        try:
+            mkdirp(os.path.dirname(os.path.abspath(dest)))
+            link_or_copy(path, dest)
+        except (IOError, OSError) as e:
+            if os.path.exists(path):
+                tty.debug('Unable to use cached {0}: {1}'.format(digest, e))
+            return False
+
+        # The modification time orders entries for eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        tty.debug('Using cached {0} for {1}'.format(digest, dest))
+        get_instrumentation().count('blob_cache_hits')
+        return True
+
+    def add(self, digest, source, verify=False):
+        """
+        Add a downloaded file to the cache, then evict if over the size
+        budget
+        """
+        if not digest or digest in self:
+            return
+        if verify and not Digest(normalize_digest(digest)).verify_file(source):
+            tty.debug('Not caching {0}, digest does not match'.format(source))
+            return
+
+        path = self.path(digest)
+        mkdirp(os.path.dirname(path))
+
+        # Link to a temporary name first, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        os.close(fd)
+        try:
+            link_or_copy(source, tmp)
+            os.chmod(tmp, _read_only)
+            size = os.path.getsize(tmp)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            tty.debug('Unable to cache {0}: {1}'.format(source, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self.entries())
+            else:
+                self._size += size
+            over = self._size > self.max_size
+        if over:
+            self.evict()
+
+    def entries(self):
+        """
+        Yield (mtime, size, path) for every blob in the cache
+        """
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                yield info.st_mtime, info.st_size, path
+
+    def evict(self, max_size=None):
+        """
+        Remove least recently used blobs until the cache fits max_size
+
+        This also recounts the size of the cache, which other processes
+        may have added to.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= max_size:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    tty.debug('Evicted {0} from blob cache'.format(path))
+                except OSError:
+                    pass
+            self._size = total
+
+
+_blob_cache = None
+
+
+def get_blob_cache():
+    """
+    The blob cache shared by all mirrors in the process
+    """
+    global _blob_cache
+    if _blob_cache is None:
+        _blob_cache = BlobCache()
+    return _blob_cache
+
+
+def fetch(digest, dest, download):
+    """
+    Put the blob for digest at dest, calling download(dest) on a cache miss.
+
+    Returns dest.
+    """
+    cache = get_blob_cache()
+    if cache.link(digest, dest):
+        return dest
+    download(dest)
+    cache.add(digest, dest)
+    return dest
@@ -0,0 +1,234 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+A local catalog of what every mirror's build cache holds.
+
+Probing for one specfile at a time costs at least one request per spec
+(and per mirror, and per GHCR date). A mirror's whole index (index.json
+for a filesystem or S3 mirror, the manifest for GHCR) is one request, so
+here it is downloaded once and stored in a SQLite database in spack's misc
+cache. Questions like "which of these DAG hashes are on which mirror?" are
+then answered locally, without any requests.
+
+A mirror's entries are only downloaded again when its manifest token (the
+index hash, or the GHCR list of dates) changes, or, for a mirror without a
+token, when they are older than max_age.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import llnl.util.tty as tty
+from llnl.util.filesystem import mkdirp
+
+import spack.caches
+
+# Seconds entries are used for a mirror without a manifest token
+default_max_age = 60 * 60
+
+# The DAG hash at the end of a specfile name
+_specfile_hash = re.compile(r'-([a-z0-9]{32})\.spec\.(json|yaml)$')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS mirrors (
+    mirror TEXT PRIMARY KEY,
+    name TEXT,
+    token TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS specs (
+    hash TEXT NOT NULL,
+    mirror TEXT NOT NULL,
+    name TEXT,
+    specfile TEXT,
+    spec_url TEXT,
+    PRIMARY KEY (hash, mirror)
+);
+CREATE INDEX IF NOT EXISTS specs_by_name ON specs (name);
+"""
+
+
+def specfile_hash(specfile_name):
+    """
+    The DAG hash in a build cache specfile name (or url), if it has one
+    """
+    match = _specfile_hash.search(specfile_name or '')
+    if match:
+        return match.group(1)
+
+
+def _node_specfile_name(dag_hash, node):
+    """
+    The specfile name for a database node dictionary, like
+    binary_distribution.tarball_name, or None if it is missing something
+    """
+    try:
+        arch = node['arch']
+        target = arch['target']
+        if isinstance(target, dict):
+            target = target['name']
+        compiler = node['compiler']
+        return "%s-%s-%s-%s-%s-%s-%s-%s.spec.json" % (
+            arch['platform'], arch['platform_os'], target,
+            compiler['name'], compiler['version'],
+            node['name'], node['version'], dag_hash)
+    except (KeyError, TypeError):
+        return None
+
+
+def index_entries(index):
+    """
+    Yield (hash, name, specfile name) for each spec in a build cache
+    index.json (the spack database format)
+    """
+    installs = (index.get('database') or {}).get('installs') or {}
+    for dag_hash, record in installs.items():
+        node = record.get('spec') or {}
+
+        # Older databases key the node by the package name
+        if 'name' not in node and len(node) == 1:
+            name, node = list(node.items())[0]
+            node = dict(node, name=name)
+        yield dag_hash, node.get('name'), _node_specfile_name(dag_hash, node)
+
+
+class Catalog(object):
+    """
+    Spec hashes on each mirror (by fetch url), in a SQLite database
+    """
+    def __init__(self, path=None, max_age=None):
+        self._path = path
+        self.max_age = default_max_age if max_age is None else max_age
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(spack.caches.misc_cache.root,
+                                      'mirrors', 'catalog.db')
+        return self._path
+
+    @property
+    def db(self):
+        # Called with the lock held, connections are shared by threads
+        if self._db is None:
+            mkdirp(os.path.dirname(os.path.abspath(self.path)))
+            self._db = sqlite3.connect(self.path, timeout=30,
+                                       check_same_thread=False)
+            self._db.executescript(_schema)
+        return self._db
+
+    def _mirror_row(self, mirror_url):
+        return self.db.execute(
+            'SELECT token, updated FROM mirrors WHERE mirror = ?',
+            (mirror_url,)).fetchone()
+
+    def is_current(self, mirror, token=None):
+        """
+        True if the stored entries for mirror match its manifest token (or
+        are newer than max_age when it has none)
+        """
+        with self._lock:
+            row = self._mirror_row(mirror.fetch_url)
+        if row is None:
+            return False
+        if token is not None:
+            return row[0] == token
+        return time.time() - row[1] < self.max_age
+
+    def refresh(self, mirror, force=False):
+        """
+        Download a mirror's index into the catalog, unless it is current.
+
+        Returns True if the entries were downloaded again.
+        """
+        token = mirror._get_manifest_token()
+        if not force and self.is_current(mirror, token):
+            return False
+
+        entries = mirror.get_index_entries()
+        if entries is None:
+            tty.debug('No build cache index for {0}'.format(mirror.name))
+            return False
+        rows = [(dag_hash, mirror.fetch_url, name, specfile, spec_url)
+                for dag_hash, name, specfile, spec_url in entries]
+
+        with self._lock:
+            with self.db:
+                self.db.execute('DELETE FROM specs WHERE mirror = ?',
+                                (mirror.fetch_url,))
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO specs VALUES (?, ?, ?, ?, ?)',
+                    rows)
+                self.db.execute(
+                    'INSERT OR REPLACE INTO mirrors VALUES (?, ?, ?, ?)',
+                    (mirror.fetch_url, mirror.name, token, time.time()))
+        tty.debug('Cataloged {0} specs on {1}'.format(len(rows), mirror.name))
+        return True
+
+    def locate(self, hashes, mirror_urls=None):
+        """
+        Return a dictionary of hash to a list of (mirror url, spec url) for
+        each of hashes that is on a mirror (optionally, one of mirror_urls)
+        """
+        hashes = list(hashes)
+        found = {}
+        with self._lock:
+            # SQLite limits the number of parameters in one query
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                query = 'SELECT hash, mirror, spec_url FROM specs ' \
+                        'WHERE hash IN (%s)' % ', '.join('?' * len(chunk))
+                for dag_hash, mirror_url, spec_url in self.db.execute(
+                        query, chunk):
+                    if mirror_urls is None or mirror_url in mirror_urls:
+                        found.setdefault(dag_hash, []).append(
+                            (mirror_url, spec_url))
+        return found
+
+    def find(self, name, mirror_urls=None):
+        """
+        Return (hash, mirror url, spec url) for every spec of a package
+        """
+        with self._lock:
+            rows = self.db.execute(
+                'SELECT hash, mirror, spec_url FROM specs WHERE name = ?',
+                (name,)).fetchall()
+        return [row for row in rows
+                if mirror_urls is None or row[1] in mirror_urls]
+
+    def remove(self, mirror_url):
+        with self._lock:
+            with self.db:
+                self.db.execute('DELETE FROM specs WHERE mirror = ?',
+                                (mirror_url,))
+                self.db.execute('DELETE FROM mirrors WHERE mirror = ?',
+                                (mirror_url,))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """
+    The catalog shared by all mirrors in the process
+    """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog()
+        return _catalog
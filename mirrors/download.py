@@ -0,0 +1,338 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Download build cache archives to disk, checking their digest on the way.
+
+When the server supports range requests, a large archive is split into
+ranges that are fetched in parallel and written in place into
+``<path>.part``. Finished ranges are recorded in a ``<path>.part.state``
+sidecar, so an interrupted download picks up where it left off instead of
+starting again. The digest is computed as the leading ranges complete,
+while later ones are still downloading, rather than by reading the whole
+file again at the end. Urls whose requests carry no headers (file:// and
+s3://) are always downloaded whole.
+"""
+
+import hashlib
+import multiprocessing.pool
+import os
+import re
+import threading
+
+import llnl.util.tty as tty
+from llnl.util.filesystem import mkdirp
+
+import spack.util.spack_json as sjson
+
+from .errors import MirrorRequestError, error_for
+from .metrics import get_instrumentation
+from .session import session
+
+# Bytes read from the network at a time
+chunk_size = 1024 * 1024
+
+# Size of each range request, and how many run at once
+range_size = 16 * 1024 * 1024
+range_jobs = 4
+
+
+class DigestMismatchError(MirrorRequestError):
+    """Downloaded content does not match the expected digest."""
+
+
+class Digest(object):
+    """
+    Incremental check of content against a digest (algorithm:hex).
+
+    A bare hex digest is taken to be sha256.
+    """
+    def __init__(self, digest):
+        algorithm, _, expected = digest.rpartition(':')
+        self.digest = digest
+        self.expected = expected.lower()
+        self.hasher = hashlib.new((algorithm or 'sha256').replace('-', ''))
+
+    def update(self, data):
+        self.hasher.update(data)
+
+    def verify(self):
+        return self.hasher.hexdigest() == self.expected
+
+    def verify_file(self, path):
+        with open(path, 'rb') as fd:
+            for data in iter(lambda: fd.read(chunk_size), b''):
+                self.update(data)
+        return self.verify()
+
+
+def normalize_digest(digest):
+    """
+    Return a digest as algorithm:hex, assuming sha256 for a bare hex digest
+    """
+    if digest and ':' not in digest:
+        return 'sha256:' + digest.lower()
+    return digest
+
+
+def _content_range_total(response):
+    """
+    The total size from a 206 response's Content-Range, if given
+    """
+    match = re.match(r'bytes \d+-\d+/(\d+)',
+                     response.headers.get('Content-Range') or '')
+    if match:
+        return int(match.group(1))
+
+
+class _RangeDownload(object):
+    """
+    One download, split into ranges that are fetched by a pool of threads
+    """
+    def __init__(self, url, path, digest=None, headers=None, size=None,
+                 jobs=None, auth=None):
+        self.url = url
+        self.path = path
+        self.partial = path + '.part'
+        self.state_path = path + '.part.state'
+        self.headers = dict(headers or {})
+        self.auth = auth
+        self.ranged = session.supports_headers(url)
+        self.jobs = jobs or range_jobs
+        self.check = Digest(digest) if digest else None
+        self.digest = digest
+
+        self.size = size
+        self.ranges = []
+        self.done = set()
+        self.hashed = 0
+        self._lock = threading.Lock()
+        self._hash_lock = threading.Lock()
+        self._auth_lock = threading.Lock()
+
+    def _get(self, extra=None):
+        """
+        GET the url with the download's headers plus extra. On a 401 (e.g.,
+        a bearer token that expired during a long download) the headers
+        are renewed with auth once, and the request is sent again.
+        """
+        for retry in (False, True):
+            used = self.headers
+            headers = dict(used)
+            headers.update(extra or {})
+            response = session.get(self.url, headers=headers, stream=True)
+            if response.status != 401 or self.auth is None or retry:
+                return response
+            response.close()
+
+            # The ranges that failed together only renew the headers once
+            with self._auth_lock:
+                if self.headers is used:
+                    tty.debug('Renewing credentials for {0}'.format(self.url))
+                    headers = dict(used)
+                    headers.update(self.auth(response))
+                    self.headers = headers
+
+    def _set_size(self, size):
+        self.size = size
+        self.ranges = [(start, min(start + range_size, size))
+                       for start in range(0, size, range_size)]
+
+    def _state(self):
+        return {'url': self.url, 'size': self.size, 'range_size': range_size,
+                'digest': self.digest, 'done': sorted(self.done)}
+
+    def _load_state(self):
+        """
+        Continue from the sidecar if it matches this download
+        """
+        if not (os.path.exists(self.state_path) and
+                os.path.exists(self.partial)):
+            return False
+        try:
+            with open(self.state_path) as fd:
+                state = sjson.load(fd)
+        except (IOError, OSError, ValueError):
+            return False
+
+        same = (state.get('url') == self.url and
+                state.get('range_size') == range_size and
+                state.get('digest') == self.digest and
+                (self.size is None or state.get('size') == self.size) and
+                os.path.getsize(self.partial) == state.get('size'))
+        if not same:
+            return False
+        self._set_size(state['size'])
+        self.done = set(state.get('done', []))
+        tty.debug('Resuming {0} with {1} of {2} ranges done'.format(
+            self.path, len(self.done), len(self.ranges)))
+        return True
+
+    def _save_state(self):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as fd:
+            sjson.dump(self._state(), fd)
+        os.rename(tmp, self.state_path)
+
+    def _allocate(self):
+        with open(self.partial, 'wb') as fd:
+            fd.truncate(self.size)
+        self.done = set()
+        self._save_state()
+
+    def _write(self, response, start, end):
+        """
+        Write a range of the response body into the partial file
+        """
+        written = 0
+        with open(self.partial, 'r+b') as fd:
+            fd.seek(start)
+            for data in iter(lambda: response.read(chunk_size), b''):
+                fd.write(data)
+                written += len(data)
+        get_instrumentation().count('download_bytes', written)
+        if written != end - start:
+            raise error_for(self.url, reason='Short read for bytes %d-%d' % (
+                start, end - 1))
+
+    def _finish_range(self, index):
+        with self._lock:
+            self.done.add(index)
+            self._save_state()
+        self._advance_hash()
+
+    def _advance_hash(self):
+        """
+        Hash the leading ranges that are complete, while the rest download
+        """
+        if not self.check:
+            return
+        with self._hash_lock:
+            with open(self.partial, 'rb') as fd:
+                while True:
+                    with self._lock:
+                        if self.hashed not in self.done:
+                            return
+                    start, end = self.ranges[self.hashed]
+                    fd.seek(start)
+                    remaining = end - start
+                    while remaining:
+                        data = fd.read(min(chunk_size, remaining))
+                        if not data:
+                            break
+                        self.check.update(data)
+                        remaining -= len(data)
+                    self.hashed += 1
+
+    def _fetch_range(self, index):
+        start, end = self.ranges[index]
+        response = self._get({'Range': 'bytes=%d-%d' % (start, end - 1)})
+        with response:
+            if response.status != 206:
+                response.read()
+                raise error_for(self.url, response.status)
+            self._write(response, start, end)
+        self._finish_range(index)
+
+    def _fetch_stream(self, response):
+        """
+        The server sent the whole body, so write it in one pass
+        """
+        written = 0
+        with response:
+            with open(self.partial, 'wb') as fd:
+                for data in iter(lambda: response.read(chunk_size), b''):
+                    if self.check:
+                        self.check.update(data)
+                    fd.write(data)
+                    written += len(data)
+        get_instrumentation().count('download_bytes', written)
+
+    def _start(self):
+        """
+        Request the first range, which also tells us the size and whether
+        the server supports ranges at all. Returns False if the whole body
+        was already downloaded without ranges.
+        """
+        if self.ranged:
+            response = self._get({'Range': 'bytes=0-%d' % (range_size - 1)})
+        else:
+            response = self._get()
+
+        # No range support (or an empty file): take the whole body
+        if response.status in (200, 416):
+            if response.status == 416:
+                response.close()
+                response = self._get()
+            if response.status != 200:
+                with response:
+                    response.read()
+                raise error_for(self.url, response.status)
+            self._fetch_stream(response)
+            return False
+
+        total = _content_range_total(response)
+        if response.status != 206 or total is None:
+            with response:
+                response.read()
+            raise error_for(self.url, response.status)
+
+        self._set_size(total)
+        self._allocate()
+        with response:
+            self._write(response, *self.ranges[0])
+        self._finish_range(0)
+        return True
+
+    def run(self):
+        from .session import retry_policy
+
+        mkdirp(os.path.dirname(os.path.abspath(self.path)))
+        if self.ranged and self._load_state():
+            self._advance_hash()
+        elif not retry_policy.call(self._start):
+            return self._finish()
+
+        pending = [i for i in range(len(self.ranges)) if i not in self.done]
+        jobs = max(1, min(self.jobs, len(pending)))
+        if pending:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            try:
+                pool.map(lambda i: retry_policy.call(self._fetch_range, i),
+                         pending, chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        self._advance_hash()
+        return self._finish()
+
+    def _finish(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        if self.check and not self.check.verify():
+            os.remove(self.partial)
+            raise DigestMismatchError(
+                self.url, reason='Digest mismatch for %s' % self.digest)
+        os.rename(self.partial, self.path)
+        tty.debug('Downloaded {0} to {1}'.format(self.url, self.path))
+        return self.path
+
+
+def download(url, path, digest=None, headers=None, size=None, jobs=None,
+             auth=None):
+    """
+    Download url to path, checking digest (if given) as the data arrives.
+
+    Large files on servers that support ranges are fetched as parallel
+    range requests (jobs at a time) and resumed from the .part.state
+    sidecar if interrupted. The content goes to path.part and is only
+    moved to path once it is complete and matches the digest.
+
+    If the server answers 401, auth (if given) is called with the response
+    and returns headers to send instead, e.g. with a new bearer token.
+    """
+    return _RangeDownload(url, path, digest=digest, headers=headers,
+                          size=size, jobs=jobs, auth=auth).run()
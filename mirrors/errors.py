@@ -0,0 +1,141 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Errors for mirror requests, classified from the status of the response.
+
+Every request error keeps the url and (when there was a response) the http
+status, so callers can tell a missing file from a permission problem or a
+flaky server without sending another request to find out.
+"""
+
+import errno
+import socket
+
+import spack.util.web as web_util
+
+# Statuses worth retrying, the rest are a final answer from the server
+transient_statuses = (408, 425, 429, 500, 502, 503, 504)
+
+# S3 error codes and urllib messages by status, for errors that only reach
+# us as a message (e.g., from spack.util.web for s3:// urls)
+_message_statuses = (
+    (404, ('NoSuchKey', 'NoSuchBucket', 'HTTP Error 404', 'HTTP Error 410')),
+    (403, ('AccessDenied', 'InvalidAccessKeyId', 'SignatureDoesNotMatch',
+           'HTTP Error 403')),
+    (401, ('HTTP Error 401',)),
+    (503, ('SlowDown', 'ServiceUnavailable', 'HTTP Error 503')),
+    (500, ('InternalError', 'HTTP Error 500')),
+)
+
+# Socket errors of a connection that failed, rather than a refused request
+_connection_errnos = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED,
+                      errno.ETIMEDOUT, errno.EPIPE, errno.EHOSTUNREACH,
+                      errno.ENETUNREACH)
+
+
+class MirrorRequestError(web_util.SpackWebError):
+    """
+    A failed request to a mirror. This is a SpackWebError, so existing
+    handlers still catch it.
+    """
+    # One of "not_found", "forbidden", "transient" or "error"
+    kind = "error"
+
+    def __init__(self, url, status=None, reason=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        message = "Request to {0} failed".format(url)
+        if status:
+            message += ": HTTP Error {0}".format(status)
+        super(MirrorRequestError, self).__init__(message, reason)
+
+    @property
+    def not_found(self):
+        return self.kind == "not_found"
+
+    @property
+    def transient(self):
+        return self.kind == "transient"
+
+
+class MirrorNotFoundError(MirrorRequestError):
+    """The url does not exist on the mirror (404 or 410)."""
+    kind = "not_found"
+
+
+class MirrorForbiddenError(MirrorRequestError):
+    """The mirror refused the request (401 or 403)."""
+    kind = "forbidden"
+
+
+class MirrorTransientError(MirrorRequestError):
+    """A timeout, rate limit, server error or dropped connection."""
+    kind = "transient"
+
+
+def error_for(url, status=None, reason=None):
+    """
+    Return the error class instance that matches a status.
+
+    A status of None means there was no response at all, which we treat
+    as transient.
+    """
+    if status in (404, 410):
+        cls = MirrorNotFoundError
+    elif status in (401, 403):
+        cls = MirrorForbiddenError
+    elif status is None or status in transient_statuses:
+        cls = MirrorTransientError
+    else:
+        cls = MirrorRequestError
+    return cls(url, status, reason)
+
+
+def _causes(error):
+    """
+    The error and the errors it was raised from (or wraps, for a URLError)
+    """
+    seen = set()
+    while isinstance(error, BaseException) and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        reason = getattr(error, 'reason', None)
+        error = (reason if isinstance(reason, BaseException) else
+                 getattr(error, '__cause__', None) or
+                 getattr(error, '__context__', None))
+
+
+def error_from(url, error):
+    """
+    Return the error class instance for an error raised without a response
+    (e.g., by spack.util.web for s3:// and file:// urls).
+
+    The status is taken from the errors it was raised from, or from its
+    message (an S3 NoSuchKey is a 404). Without one, only timeouts and
+    dropped connections are transient, anything else is a final error.
+    """
+    reason = str(error)
+    for cause in _causes(error):
+        status = getattr(cause, 'code', None)
+        if isinstance(status, int):
+            return error_for(url, status, reason)
+        response = getattr(cause, 'response', None)
+        if isinstance(response, dict):
+            status = response.get('ResponseMetadata', {}).get(
+                'HTTPStatusCode')
+            if status:
+                return error_for(url, status, reason)
+        if isinstance(cause, socket.timeout) or (
+                isinstance(cause, socket.error) and
+                cause.errno in _connection_errnos):
+            return MirrorTransientError(url, None, reason)
+    for status, messages in _message_statuses:
+        if any(message in reason for message in messages):
+            return error_for(url, status, reason)
+    if 'timed out' in reason:
+        return MirrorTransientError(url, None, reason)
+    return MirrorRequestError(url, None, reason)
@@ -11,17 +11,32 @@ import spack.spec
 import spack.util.spack_json as sjson
 import llnl.util.tty as tty
 import spack.util.url as url_util
-import spack.util.web as web_util
 
-from six.moves.urllib.error import URLError
+import collections
+import hashlib
+import multiprocessing.pool
+import os
 
-import codecs
+from six.moves.urllib.parse import urljoin
 
-from .base import Mirror, MirrorDownload
+from . import oci
+from . import blobs
+from .base import Mirror, MirrorDownload, _specfile_checksum
+from .catalog import index_entries
+from .errors import MirrorRequestError
+from .manifest import manifests
+from .metrics import get_instrumentation
+from .parallel import first_hit
 
 
 class MirrorGHCR(Mirror):
 
+    # Number of date prefixes to probe at once, 1 probes them serially
+    probe_jobs = 4
+
+    # Seconds the manifest endpoints are used before revalidating them
+    manifest_max_age = None
+
     @property
     def fetch_url(self):
         return self._fetch_url["url"]
@@ -32,11 +47,57 @@ class MirrorGHCR(Mirror):
             return self._fetch_url["url"]
         return self._push_url["url"]
 
+    def _urls(self):
+        """
+        The mirror's base urls, built once and reused by every lookup
+        """
+        urls = self._base_urls
+        if urls is None:
+            base = self._fetch_url['url']
+            urls = self._base_urls = {
+                'dates': "%s/manifest/dates/" % base,
+                'manifest': "%s/manifest/" % base,
+                'oras': self._fetch_url.get('oras', '') + "/",
+            }
+        return urls
+
     def get_download_tarball(self, match):
-        parts = [x.strip('/') for x in match['spec_url'].split('/_cache/')[1:]]
-        oras = self._fetch_url['oras'] + "/" + "/".join(parts)
+        # The path after /_cache/ in the specfile url is the oras path
+        _, _, path = match.spec_url.partition('/_cache/')
+        if '/_cache/' in path:
+            path = "/".join(x.strip('/') for x in path.split('/_cache/'))
+        oras = self._urls()['oras'] + path.strip('/')
         return oras.replace('spec.json', 'spack')
 
+    def pull_tarball(self, match, dest=None):
+        """
+        Download the .spack archive for a fetch_spec match into dest.
+
+        This uses the native OCI client, so oras is not needed. An archive
+        whose checksum is in the local blob cache needs no request at all.
+        """
+        reference = self.get_download_tarball(match)
+        dest = dest or os.getcwd()
+        path = os.path.join(dest, reference.rsplit('/', 1)[-1])
+        if blobs.get_blob_cache().link(match.checksum, path):
+            return path
+
+        instrumentation = get_instrumentation()
+        with instrumentation.span('pull_tarball', self.fetch_url):
+            path = oci.pull(reference, dest,
+                            username=self._fetch_url.get('ghcr_username'),
+                            password=self._fetch_url.get('ghcr_token'),
+                            scheme=self._fetch_url.get('oras_scheme', 'https'))
+        instrumentation.count('archive_bytes', os.path.getsize(path),
+                              self.fetch_url)
+        return path
+
+    def fetch_tarball(self, match, dest=None):
+        """
+        GHCR archives are OCI artifacts, so this is pull_tarball
+        """
+        return self.pull_tarball(match, dest)
+
     def get_prefixes(self):
         """
         The traditional spack cache seems to assume that the user must know
@@ -46,15 +107,30 @@ class MirrorGHCR(Mirror):
         until we find a match (or do not). This means if the build cache has
         a matching entry for any date we will find it.
         """
-        prefix_url = "%s/manifest/dates/" % self._fetch_url['url']
-        return self._get_request(prefix_url)
+        return manifests.get(self._urls()['dates'],
+                             max_age=self._manifest_max_age)
+
+    def _get_manifest_token(self):
+        """
+        The list of date prefixes changes whenever a new cache is deployed
+        """
+        prefixes = self.get_prefixes()
+        if prefixes:
+            dates = sjson.dump(prefixes.get('dates', []))
+            return hashlib.sha1(dates.encode('utf-8')).hexdigest()
 
-    def get_manifest(self):
+    def get_manifest(self, max_age=None):
         """
         Get the build cache manifest, with packages and keys
         """
-        keys_url = "%s/manifest/" % self._fetch_url['url']
-        return self._get_request(keys_url)
+        if max_age is None:
+            max_age = self._manifest_max_age
+        return manifests.get(self._urls()['manifest'], max_age=max_age)
+
+    @property
+    def _manifest_max_age(self):
+        max_age = self._fetch_url.get('manifest_max_age')
+        return self.manifest_max_age if max_age is None else max_age
 
     def get_fingerprint_links(self):
         """
@@ -68,27 +144,135 @@ class MirrorGHCR(Mirror):
             return []
         return manifest.get('keys', [])
 
-    def fetch_spec(self, specfile_name, _=None):
+    def get_key_links(self):
         """
-        Fetch an object from GitHub packages, supporting both json and yaml
+        Return a lookup of fingerprint to (link to .pub, key metadata)
+
+        Keys in the manifest are links, or dictionaries with a link (or
+        url) and optionally the fingerprint. The manifest is revalidated
+        with a conditional request each time, and a MirrorRequestError is
+        raised if it cannot be read (rather than using a stale copy).
+        """
+        manifest = manifests.get(self._urls()['manifest'], max_age=0,
+                                 read=self._read, strict=True)
+        links = collections.OrderedDict()
+        for key in (manifest or {}).get('keys', []):
+            metadata = key if isinstance(key, dict) else {}
+            link = metadata.get('link') or metadata.get('url') or key
+            if not link or isinstance(link, dict):
+                continue
+            link = urljoin(self.fetch_url + '/', link)
+            fingerprint = metadata.get('fingerprint')
+            if not fingerprint:
+                fingerprint = os.path.basename(link)
+                if fingerprint.endswith('.pub'):
+                    fingerprint = fingerprint[:-len('.pub')]
+            links[fingerprint] = (link, metadata or None)
+        return links
+
+    def _probe_spec(self, json_url, errors=None):
+        """
+        Request a single specfile url, returning the loaded json or None
+
+        Failed requests are added to errors, if provided.
+        """
+        try:
+            _, _, response = self._read(json_url, stream=True)
+            with response:
+                return sjson.load(response)
+        except MirrorRequestError as e:
+            if errors is not None:
+                errors.append(e)
+            tty.debug('Did not find {0}: {1}'.format(json_url, e))
+
+    def get_index_entries(self):
+        """
+        Return (hash, name, specfile name, spec url) for every spec in the
+        build cache index.json of each date, newest date first for a spec
+        that is under more than one
         """
         prefixes = self.get_prefixes()
+        if not prefixes:
+            return
+        index_urls = self._date_urls(prefixes, 'index.json')
+        jobs = self._fetch_url.get('probe_jobs') or self.probe_jobs
+        pool = multiprocessing.pool.ThreadPool(
+            max(1, min(jobs, len(index_urls))))
+        try:
+            indices = pool.map(
+                lambda url: self._get_request(url, allow_fail=True),
+                index_urls)
+        finally:
+            pool.terminate()
+            pool.join()
 
-        # Empty result means not found in the cache
-        result = None
-        json_url = None
+        entries = collections.OrderedDict()
+        for index_url, index in zip(index_urls, indices):
+            base_url = index_url[:-len('index.json')]
+            for dag_hash, name, specfile in index_entries(index or {}):
+                if dag_hash not in entries or not entries[dag_hash][2]:
+                    entries[dag_hash] = (dag_hash, name, specfile,
+                                         specfile and base_url + specfile)
+        return list(entries.values())
+
+    def _date_urls(self, prefixes, specfile_name):
+        """
+        The specfile url under each date prefix, newest first
+        """
         raw_url = prefixes['url_prefix']
+        return ["%s%s/%s" % (raw_url, prefix, specfile_name)
+                for prefix in prefixes.get('dates', [])]
+
+    def _resolve_spec(self, index, entry, specfile_name, spec_url, fs, errors):
+        """
+        Record the outcome of a lookup in the index and build the result
+        """
+        # Only remember a miss if every date definitely did not have it
+        if not fs:
+            if all(e.not_found for e in errors):
+                index.update(specfile_name, None)
+            return
+        if entry is None or entry['url'] != spec_url:
+            index.update(specfile_name, spec_url)
+        spec = spack.spec.Spec.from_dict(fs)
+        return MirrorDownload(spec, spec_url, self, _specfile_checksum(fs))
+
+    def fetch_spec(self, specfile_name, _=None, jobs=None):
+        """
+        Fetch an object from GitHub packages, supporting both json and yaml
+
+        Date prefixes are probed newest first, up to jobs (or the mirror's
+        probe_jobs) at a time, and the newest date with a match wins.
+        """
+        with get_instrumentation().span('fetch_spec', self.fetch_url):
+            return self._fetch_spec(specfile_name, jobs)
+
+    def _fetch_spec(self, specfile_name, jobs):
+        index = self.spec_index
+        errors = []
+
+        # A known location is a single request, a known miss is none
+        entry = index.lookup(specfile_name)
+        if entry is not None:
+            if not entry['url']:
+                return
+            result = self._probe_spec(entry['url'], errors)
+            if result:
+                return self._resolve_spec(index, entry, specfile_name,
+                                          entry['url'], result, errors)
+
+        prefixes = self.get_prefixes()
+        if not prefixes:
+            return
+
+        if jobs is None:
+            jobs = self._fetch_url.get('probe_jobs') or self.probe_jobs
 
         # Look for the specfile name directory (we only use json)
-        for prefix in prefixes.get('dates', []):
-            json_url = "%s%s/%s" % (raw_url, prefix, specfile_name)
-            try:
-                _, _, json_file = web_util.read_from_url(json_url)
-                result = sjson.load(codecs.getreader('utf-8')(json_file))
-                break
-            except (URLError, web_util.SpackWebError):
-                pass
-
-        if result:
-            spec = spack.spec.Spec.from_dict(result)
-            return MirrorDownload(spec, json_url, self).to_dict()
+        json_urls = self._date_urls(prefixes, specfile_name)
+
+        # Empty result means not found in the cache
+        json_url, result = first_hit(lambda url: self._probe_spec(url, errors),
+                                     json_urls, jobs=jobs) or (None, None)
+        return self._resolve_spec(index, entry, specfile_name, json_url,
+                                  result, errors)
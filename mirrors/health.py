@@ -0,0 +1,255 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Track how fast and how reliable each mirror is, to try the best one first.
+
+Every request a mirror makes records its latency and whether the mirror
+failed (a timeout, connection error, 5xx, rate limit or denied request; a
+plain not found is a healthy answer). Both are kept as exponentially
+weighted moving averages, so recent requests count the most, and are saved
+in spack's misc cache so the next run starts with what this one learned.
+
+A mirror that fails several times in a row has its circuit breaker opened
+and is skipped until a cooldown passes. The breaker is then half open: the
+first request made to the mirror is its probe, while other callers keep
+skipping it, and the probe's result closes the breaker or opens it for
+another cooldown.
+"""
+
+import atexit
+import threading
+import time
+
+import llnl.util.tty as tty
+
+import spack.caches
+import spack.util.spack_json as sjson
+
+# The misc cache key for saved health
+health_key = "mirrors/health.json"
+
+
+class MirrorHealth(object):
+    """
+    Moving averages of latency (seconds) and error rate (0 to 1) for a mirror
+    """
+    def __init__(self, latency=None, error_rate=0.0, failures=0, opened=None,
+                 samples=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.failures = failures
+        self.opened = opened
+        self.samples = samples
+
+        # When the probe of a half open breaker was let through (per process)
+        self.probing = None
+
+    def update(self, elapsed, failed, alpha):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += alpha * (elapsed - self.latency)
+        self.error_rate += alpha * (float(failed) - self.error_rate)
+        self.samples += 1
+
+    def to_dict(self):
+        return {"latency": self.latency, "error_rate": self.error_rate,
+                "failures": self.failures, "opened": self.opened,
+                "samples": self.samples}
+
+    @staticmethod
+    def from_dict(d):
+        return MirrorHealth(d.get("latency"), d.get("error_rate", 0.0),
+                            d.get("failures", 0), d.get("opened"),
+                            d.get("samples", 0))
+
+
+def is_failure(error):
+    """
+    True if an error says the mirror is unhealthy, not that a file is missing
+    """
+    return error is not None and not getattr(error, 'not_found', False)
+
+
+class HealthTracker(object):
+    """
+    Health of every mirror, by fetch url, shared by the whole process.
+
+    alpha is the weight of the newest request in the moving averages. After
+    failure_threshold failures in a row the circuit breaker opens for
+    cooldown seconds. Changes are saved at most every save_interval seconds
+    (and at exit).
+    """
+    def __init__(self, alpha=0.3, failure_threshold=3, cooldown=60,
+                 save_interval=5, cache=None):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.save_interval = save_interval
+        self._cache = cache
+        self._health = None
+        self._changed = set()
+        self._saved = time.time()
+        self._lock = threading.RLock()
+
+    @property
+    def cache(self):
+        return self._cache or spack.caches.misc_cache
+
+    def _read(self):
+        try:
+            if not self.cache.mtime(health_key):
+                return {}
+            with self.cache.read_transaction(health_key) as cache_file:
+                return sjson.load(cache_file) or {}
+        except Exception as e:
+            tty.debug('Ignoring unreadable mirror health: {0}'.format(e))
+            return {}
+
+    def _load(self):
+        with self._lock:
+            if self._health is None:
+                self._health = dict(
+                    (url, MirrorHealth.from_dict(d))
+                    for url, d in self._read().items())
+            return self._health
+
+    def get(self, url):
+        """
+        The health of the mirror at url (empty if never seen)
+        """
+        with self._lock:
+            return self._load().setdefault(url, MirrorHealth())
+
+    def record(self, url, elapsed, error=None):
+        """
+        Record one request to the mirror at url, and whether it failed
+        """
+        failed = is_failure(error)
+        with self._lock:
+            health = self.get(url)
+            health.update(elapsed, failed, self.alpha)
+            probe, health.probing = health.probing, None
+            if not failed:
+                health.failures = 0
+                health.opened = None
+            else:
+                health.failures += 1
+                if probe is not None or (
+                        health.opened is None and
+                        health.failures >= self.failure_threshold):
+                    tty.debug('Skipping mirror {0} for {1}s after {2} '
+                              'failures'.format(url, self.cooldown,
+                                                health.failures))
+                    health.opened = time.time()
+            self._changed.add(url)
+            due = time.time() - self._saved >= self.save_interval
+        if due:
+            self.save()
+
+    def _is_open(self, health, now):
+        if health.opened is None:
+            return False
+        if now - health.opened < self.cooldown:
+            return True
+        return (health.probing is not None and
+                now - health.probing < self.cooldown)
+
+    def is_open(self, url):
+        """
+        True if the circuit breaker for url is open, so it should be skipped
+
+        After the cooldown it is False until a request to the mirror claims
+        the probe (see start), and then True again until the probe's request
+        is recorded, or until a probe that never reported is a cooldown old.
+        """
+        with self._lock:
+            return self._is_open(self.get(url), time.time())
+
+    def start(self, url):
+        """
+        Note that a request to the mirror at url is about to be made.
+
+        If the breaker is half open, this request becomes its probe.
+        """
+        now = time.time()
+        with self._lock:
+            health = self.get(url)
+            if health.opened is not None and not self._is_open(health, now):
+                health.probing = now
+
+    def score(self, url):
+        """
+        Expected cost of asking the mirror at url, lower is better.
+
+        A mirror that has not been seen scores best, so it gets tried.
+        """
+        health = self.get(url)
+        if health.latency is None:
+            return 0.0
+        return health.latency * (1 + 4 * health.error_rate)
+
+    def order(self, mirrors, priority=None):
+        """
+        Order mirrors to try: pinned first (by priority), then healthiest.
+
+        priority returns a mirror's pin (lower first) or None, and defaults
+        to the mirror's own priority. Mirrors with an open circuit breaker
+        are left out, unless all of them are, in which case there is
+        nothing better to try.
+        """
+        priority = priority or (lambda m: m.priority)
+        mirrors = list(mirrors)
+        available = [m for m in mirrors if not self.is_open(m.fetch_url)]
+        if not available:
+            available = mirrors
+
+        pinned = [m for m in available if priority(m) is not None]
+        pinned.sort(key=priority)
+        others = [m for m in available if priority(m) is None]
+        others.sort(key=lambda m: self.score(m.fetch_url))
+        return pinned + others
+
+    def save(self):
+        """
+        Save changed health to the misc cache, keeping other mirrors' entries
+        """
+        with self._lock:
+            if not self._changed:
+                return
+            changed = dict((url, self._health[url].to_dict())
+                           for url in self._changed)
+            self._changed = set()
+            self._saved = time.time()
+        try:
+            self.cache.init_entry(health_key)
+            with self.cache.write_transaction(health_key) as (old, new):
+                data = {}
+                if old:
+                    try:
+                        data = sjson.load(old) or {}
+                    except Exception:
+                        pass
+                data.update(changed)
+                sjson.dump(data, new)
+        except Exception as e:
+            tty.debug('Unable to save mirror health: {0}'.format(e))
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    """
+    The health tracker shared by all mirrors, saved when spack exits
+    """
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = HealthTracker()
+            atexit.register(_tracker.save)
+        return _tracker
@@ -0,0 +1,221 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+A persistent index of where specfiles live on a mirror.
+
+Finding a specfile can take several requests (json and yaml names for a
+filesystem or S3 mirror, one per date prefix for GHCR), so once a lookup is
+resolved we record the url (or that the spec is missing) in spack's misc
+cache. The file cache takes care of locking, so many spack processes on a
+shared filesystem can read and update the same index.
+
+Resolved locations are kept in memory and written in batches (and at
+exit), since every write rewrites the whole index.
+"""
+
+import atexit
+import hashlib
+import re
+import threading
+import time
+import weakref
+
+import llnl.util.tty as tty
+
+import spack.caches
+import spack.util.spack_json as sjson
+
+from .metrics import get_instrumentation
+
+# How long (in seconds) a recorded location is trusted
+default_ttl = 24 * 60 * 60
+
+# How long (in seconds) a recorded miss is trusted. A missing spec may be
+# pushed at any time, so this is much shorter.
+default_miss_ttl = 10 * 60
+
+
+# Indices with entries not written yet, flushed at exit
+_unflushed = weakref.WeakSet()
+
+
+def _flush_all():
+    for index in list(_unflushed):
+        index.flush()
+
+
+atexit.register(_flush_all)
+
+
+def _index_key(name, fetch_url):
+    """
+    The misc cache key for a mirror, by name plus a hash of its url
+    """
+    url_hash = hashlib.sha1(fetch_url.encode('utf-8')).hexdigest()[:12]
+    name = re.sub('[^A-Za-z0-9_.-]', '_', name or 'unnamed')
+    return "mirrors/spec-index/%s-%s.json" % (name, url_hash)
+
+
+class SpecIndex(object):
+    """
+    Lookup of specfile name to the url it was found at on one mirror.
+
+    Each entry records the url (None for a known miss) and when it was
+    resolved. Locations expire after ttl seconds and misses after miss_ttl.
+    The whole index is dropped when the mirror's manifest token changes,
+    e.g., the build cache index hash or the GHCR list of dates.
+
+    Updates are written once flush_size of them are pending, or
+    flush_interval seconds after the last write.
+    """
+    flush_size = 256
+    flush_interval = 5.0
+
+    def __init__(self, name, fetch_url, ttl=None, miss_ttl=None, cache=None):
+        self.key = _index_key(name, fetch_url)
+        self.fetch_url = fetch_url
+        self.ttl = default_ttl if ttl is None else ttl
+        self.miss_ttl = default_miss_ttl if miss_ttl is None else miss_ttl
+        self._cache = cache
+        self._data = None
+        self._mtime = None
+        self._pending = {}
+        self._flushed = time.time()
+
+        # spack's file locks are per process, so threads take turns
+        self._lock = threading.RLock()
+
+    @property
+    def cache(self):
+        return self._cache or spack.caches.misc_cache
+
+    def _empty(self, manifest=None):
+        return {"manifest": manifest, "specs": {}}
+
+    def _load(self):
+        """
+        Load (or reload, if another process updated it) the index from disk
+        """
+        with self._lock:
+            mtime = self.cache.mtime(self.key)
+            if self._data is not None and mtime == self._mtime:
+                return self._data
+
+            data = self._empty()
+            if mtime:
+                try:
+                    with self.cache.read_transaction(self.key) as cache_file:
+                        data = sjson.load(cache_file)
+                except Exception as e:
+                    tty.debug('Ignoring unreadable mirror index {0}: '
+                              '{1}'.format(self.key, e))
+            self._data = data
+            self._mtime = mtime
+            return data
+
+    def _write(self, update=None):
+        """
+        Apply pending entries and then update to the latest index on disk,
+        under a write lock
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            _unflushed.discard(self)
+            self.cache.init_entry(self.key)
+            with self.cache.write_transaction(self.key) as (old, new):
+                data = self._empty()
+                if old:
+                    try:
+                        data = sjson.load(old)
+                    except Exception:
+                        pass
+                data.setdefault("specs", {}).update(pending)
+                if update:
+                    update(data)
+                sjson.dump(data, new)
+            self._data = data
+            self._mtime = self.cache.mtime(self.key)
+            self._flushed = time.time()
+
+    def flush(self):
+        """
+        Write any pending entries
+        """
+        with self._lock:
+            if self._pending:
+                self._write()
+
+    def empty(self):
+        """
+        True if nothing is recorded (or pending) for the mirror
+        """
+        return not self._pending and not self._load()["specs"]
+
+    def validate(self, manifest):
+        """
+        Drop all entries if the mirror manifest token has changed.
+
+        A manifest of None means the mirror does not provide one, in which
+        case entries only expire through the ttl.
+        """
+        if manifest is None or self._load().get("manifest") == manifest:
+            return
+
+        def reset(data):
+            if data.get("manifest") != manifest:
+                data.clear()
+                data.update(self._empty(manifest))
+        self._write(reset)
+
+    @property
+    def spec_format(self):
+        """
+        The specfile format ("json" or "yaml") the mirror last served
+        """
+        return self._load().get("format")
+
+    @spec_format.setter
+    def spec_format(self, spec_format):
+        def set_format(data):
+            data["format"] = spec_format
+        self._write(set_format)
+
+    def lookup(self, specfile_name):
+        """
+        Return the entry for a specfile if it is recorded and fresh.
+
+        The entry is a dictionary with the resolved "url", which is None for
+        a known miss. None is returned if the location is unknown.
+        """
+        entry = self._pending.get(specfile_name)
+        if entry is None:
+            entry = self._load()["specs"].get(specfile_name)
+        if entry:
+            ttl = self.ttl if entry.get("url") else self.miss_ttl
+            if time.time() - entry.get("time", 0) < ttl:
+                get_instrumentation().count('spec_index_hits', 1,
+                                            self.fetch_url)
+                return entry
+        get_instrumentation().count('spec_index_misses', 1, self.fetch_url)
+
+    def update(self, specfile_name, spec_url):
+        """
+        Record where a specfile was found, or spec_url None if missing
+        """
+        with self._lock:
+            self._pending[specfile_name] = {"url": spec_url,
+                                            "time": time.time()}
+            _unflushed.add(self)
+            if (len(self._pending) >= self.flush_size or
+                    time.time() - self._flushed >= self.flush_interval):
+                self._write()
+
+    def remove(self, specfile_name):
+        def pop(data):
+            data.get("specs", {}).pop(specfile_name, None)
+        with self._lock:
+            self._pending.pop(specfile_name, None)
+            self._write(pop)
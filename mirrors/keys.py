@@ -0,0 +1,214 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Keep a local copy of the public keys that mirrors sign build caches with.
+
+A mirror's keys index is read through the manifest cache, so when it has
+not changed it costs one conditional request. Keys are stored by
+fingerprint, and a .pub file is only downloaded when the fingerprint is
+not in the local keyring yet or the index entry for it has changed. Those
+downloads run concurrently.
+
+Fingerprints come from the mirror and name files in the keyring, so only
+hexadecimal ones are accepted.
+"""
+
+import hashlib
+import multiprocessing.pool
+import os
+import re
+import tempfile
+import threading
+
+import six
+
+import llnl.util.tty as tty
+from llnl.util.filesystem import mkdirp
+
+import spack.caches
+import spack.util.spack_json as sjson
+from spack.util.file_cache import FileCache
+
+from .errors import MirrorRequestError
+
+# Number of .pub files downloaded at once
+sync_jobs = 8
+
+_fingerprint_re = re.compile(r'^[0-9A-Fa-f]{16,64}$')
+
+
+def is_fingerprint(fingerprint):
+    """
+    True if fingerprint is safe to store a key under
+    """
+    return bool(isinstance(fingerprint, six.string_types) and
+                _fingerprint_re.match(fingerprint))
+
+
+def _digest(metadata):
+    """
+    A digest of a key's index entry, to tell when it has changed
+    """
+    data = sjson.dump(metadata or {})
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class Keyring(object):
+    """
+    Public keys on disk by fingerprint, under root/<fingerprint>.pub
+
+    The keyring's index.json records, for each fingerprint, the link it
+    was downloaded from and a digest of its entry in the mirror's index.
+    It is kept in spack's misc cache (or a file cache at root, if one is
+    given), and updated under its write lock, so processes syncing at the
+    same time do not drop each other's keys.
+    """
+    def __init__(self, root=None):
+        self._root = root
+        self._cache = None if root is None else FileCache(root)
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = os.path.join(spack.caches.misc_cache.root,
+                                      'mirrors', 'keys')
+        return self._root
+
+    def path(self, fingerprint):
+        if not is_fingerprint(fingerprint):
+            raise ValueError('Invalid key fingerprint: {0!r}'.format(
+                fingerprint))
+        return os.path.join(self.root, fingerprint + '.pub')
+
+    @property
+    def cache(self):
+        return self._cache or spack.caches.misc_cache
+
+    @property
+    def _index_key(self):
+        return 'index.json' if self._cache else 'mirrors/keys/index.json'
+
+    def _read_index(self, stream):
+        try:
+            return sjson.load(stream) or {}
+        except ValueError as e:
+            tty.debug('Ignoring unreadable keyring index: {0}'.format(e))
+            return {}
+
+    def _load(self):
+        if self._index is None:
+            self._index = {}
+            if self.cache.mtime(self._index_key):
+                try:
+                    with self.cache.read_transaction(self._index_key) as fd:
+                        self._index = self._read_index(fd)
+                except (IOError, OSError) as e:
+                    tty.debug('Ignoring unreadable keyring index: {0}'.format(
+                        e))
+        return self._index
+
+    def _save(self, fingerprint, entry):
+        """
+        Add an entry to the index on disk, merged with what other processes
+        wrote since we read it
+        """
+        self.cache.init_entry(self._index_key)
+        with self.cache.write_transaction(self._index_key) as (old, new):
+            index = self._read_index(old) if old else {}
+            index[fingerprint] = entry
+            sjson.dump(index, new)
+        self._index = index
+
+    def is_current(self, fingerprint, metadata=None):
+        """
+        True if the key is stored and its index entry has not changed
+        """
+        with self._lock:
+            entry = self._load().get(fingerprint)
+        return (entry is not None and entry.get('digest') == _digest(metadata)
+                and os.path.exists(self.path(fingerprint)))
+
+    def add(self, fingerprint, content, link=None, metadata=None):
+        """
+        Store a key's content, replacing any older copy
+        """
+        path = self.path(fingerprint)
+        mkdirp(self.root)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(content)
+        os.rename(tmp, path)
+        with self._lock:
+            self._save(fingerprint, {'link': link,
+                                     'digest': _digest(metadata)})
+        return path
+
+    def fingerprints(self):
+        with self._lock:
+            return sorted(self._load())
+
+    def sync(self, mirror, jobs=None):
+        """
+        Bring the keyring up to date with a mirror's keys index.
+
+        Returns a dictionary of fingerprint to the local .pub path for the
+        mirror's keys that are in the keyring. A MirrorRequestError is
+        raised if the mirror's keys index cannot be read. Keys whose
+        fingerprint is not hexadecimal are skipped with a warning.
+        """
+        keys = {}
+        for fingerprint, key in (mirror.get_key_links() or {}).items():
+            if is_fingerprint(fingerprint):
+                keys[fingerprint] = key
+            else:
+                tty.warn('Skipping key with invalid fingerprint {0!r} from '
+                         '{1}'.format(fingerprint, mirror.name))
+        stale = [(fingerprint, link, metadata)
+                 for fingerprint, (link, metadata) in keys.items()
+                 if not self.is_current(fingerprint, metadata)]
+
+        def fetch(key):
+            fingerprint, link, metadata = key
+            try:
+                _, _, response = mirror._read(link)
+                with response:
+                    content = response.read()
+            except MirrorRequestError as e:
+                tty.warn('Unable to download key {0}: {1}'.format(link, e))
+                return
+            return self.add(fingerprint, content, link, metadata)
+
+        if stale:
+            tty.debug('Downloading {0} of {1} keys from {2}'.format(
+                len(stale), len(keys), mirror.name))
+            jobs = max(1, min(jobs or sync_jobs, len(stale)))
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            try:
+                pool.map(fetch, stale, chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        return dict((fingerprint, self.path(fingerprint))
+                    for fingerprint in keys
+                    if os.path.exists(self.path(fingerprint)))
+
+
+_keyring = None
+_keyring_lock = threading.Lock()
+
+
+def get_keyring():
+    """
+    The keyring shared by all mirrors in the process
+    """
+    global _keyring
+    with _keyring_lock:
+        if _keyring is None:
+            _keyring = Keyring()
+        return _keyring
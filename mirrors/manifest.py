@@ -0,0 +1,175 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+A cache for small json manifest endpoints (e.g., GHCR manifest/dates/).
+
+Manifests are kept in memory for the process and in spack's misc cache
+between runs, along with the ETag and Last-Modified headers of the last
+response. Within max_age a manifest is returned without a request, and
+after that it is revalidated with a conditional GET, so an unchanged
+manifest costs a 304 instead of a download and a parse.
+"""
+
+import hashlib
+import threading
+import time
+
+import llnl.util.tty as tty
+
+import spack.caches
+import spack.util.spack_json as sjson
+
+from .errors import MirrorRequestError
+from .metrics import get_instrumentation
+from .session import read_from_url
+
+# Seconds a manifest is used without revalidating
+default_max_age = 5 * 60
+
+
+def _manifest_key(url):
+    return "mirrors/manifests/%s.json" % hashlib.sha1(
+        url.encode('utf-8')).hexdigest()
+
+
+def _conditional_get(url, entry=None, read=None):
+    """
+    GET a url with read (read_from_url by default), conditional on the
+    validators of a cached entry.
+
+    Returns a tuple of (status, headers, response), where a 304 status
+    means the cached entry is still current.
+    """
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    _, response_headers, response = (read or read_from_url)(
+        url, headers=headers)
+    return response.status, response_headers, response
+
+
+class ManifestCache(object):
+    """
+    Process wide (and persistent) cache of json manifests by url
+    """
+    def __init__(self, max_age=None, cache=None):
+        self.max_age = default_max_age if max_age is None else max_age
+        self._cache = cache
+        self._entries = {}
+        self._url_locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return self._cache or spack.caches.misc_cache
+
+    def _read_entry(self, url):
+        key = _manifest_key(url)
+        if not self.cache.mtime(key):
+            return
+        try:
+            with self.cache.read_transaction(key) as cache_file:
+                return sjson.load(cache_file)
+        except Exception as e:
+            tty.debug('Ignoring unreadable manifest cache for {0}: {1}'.format(
+                url, e))
+
+    def _write_entry(self, url, entry):
+        key = _manifest_key(url)
+        try:
+            self.cache.init_entry(key)
+            with self.cache.write_transaction(key) as (_, new):
+                sjson.dump(entry, new)
+        except Exception as e:
+            tty.debug('Unable to write manifest cache for {0}: {1}'.format(
+                url, e))
+
+    def _entry(self, url):
+        entry = self._entries.get(url)
+        if entry is None:
+            entry = self._read_entry(url)
+            if entry is not None:
+                with self._lock:
+                    self._entries[url] = entry
+        return entry
+
+    def _url_lock(self, url):
+        with self._lock:
+            lock = self._url_locks.get(url)
+            if lock is None:
+                lock = self._url_locks[url] = threading.Lock()
+            return lock
+
+    def get(self, url, max_age=None, read=None, strict=False):
+        """
+        Return the loaded json for a manifest url, or None if unavailable.
+
+        If the server cannot be reached, a stale cached copy is returned,
+        unless strict is set: then None is returned if the manifest does
+        not exist, and any other error is raised as a MirrorRequestError.
+        read replaces read_from_url for the request, e.g. with a mirror's
+        own _read so its health is tracked. One request per url is made at
+        a time (other callers wait for its result), while different
+        manifests are fetched in parallel.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        with self._url_lock(url):
+            entry = self._entry(url)
+            if entry and time.time() - entry['checked'] < max_age:
+                get_instrumentation().count('manifest_cache_hits')
+                return entry['data']
+
+            try:
+                status, headers, response = _conditional_get(url, entry, read)
+            except MirrorRequestError as e:
+                tty.debug('Unable to read manifest {0}: {1}'.format(url, e))
+                if not strict:
+                    return entry['data'] if entry else None
+                if not e.not_found:
+                    raise
+                return None
+
+            if status == 304 and entry:
+                tty.debug('Manifest {0} is unchanged'.format(url))
+                get_instrumentation().count('manifest_cache_hits')
+                entry['checked'] = time.time()
+            else:
+                get_instrumentation().count('manifest_cache_misses')
+                try:
+                    data = sjson.load(response)
+                except ValueError as e:
+                    tty.debug('Invalid manifest at {0}: {1}'.format(url, e))
+                    if strict:
+                        raise MirrorRequestError(
+                            url, reason='Invalid manifest: {0}'.format(e))
+                    return entry['data'] if entry else None
+                entry = {
+                    'data': data,
+                    'etag': headers.get('ETag'),
+                    'last_modified': headers.get('Last-Modified'),
+                    'checked': time.time(),
+                }
+
+            with self._lock:
+                self._entries[url] = entry
+            self._write_entry(url, entry)
+            return entry['data']
+
+    def clear(self, url=None):
+        with self._lock:
+            urls = [url] if url else list(self._entries)
+            for url in urls:
+                self._entries.pop(url, None)
+        for url in urls:
+            self.cache.remove(_manifest_key(url))
+
+
+# Shared by every mirror in the process, keyed by manifest url
+manifests = ManifestCache()
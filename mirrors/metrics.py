@@ -0,0 +1,323 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Instrumentation of mirror operations.
+
+Mirrors report timed spans (a request, a fetch_spec, an OCI pull, adding a
+spec to a mirror) and counts (bytes, cache hits and misses) to the
+instrumentation returned by get_instrumentation(). The default records
+nothing, and its span is a shared no-op context manager, so an
+uninstrumented run pays about one method call per operation.
+
+To see where time goes, install a Metrics recorder:
+
+    metrics = mirrors.metrics.enable()
+    ...
+    metrics.write("mirrors.prom")   # or .json
+    metrics.serve(9464)             # or scrape /metrics over HTTP
+
+Spans are labeled with the mirror's fetch url (or a registry, for OCI
+pulls). A span that ends in an exception counts as an error, unless the
+error only says a file is missing, so errors over count is a mirror's
+error rate.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+
+import spack.util.spack_json as sjson
+
+from .health import is_failure
+
+# Upper bounds (seconds) of the span duration histogram buckets
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+
+class _NullSpan(object):
+    """
+    The span of the default instrumentation, which does nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def error(self):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Instrumentation(object):
+    """
+    Receives spans and counts from mirror operations, and records nothing.
+
+    Subclass this to send them elsewhere (Metrics keeps them in memory).
+    """
+    def span(self, operation, mirror=None):
+        """
+        A context manager timing one operation (on mirror, if given)
+        """
+        return _null_span
+
+    def count(self, name, value=1, mirror=None):
+        """
+        Add value to the counter name (for mirror, if given)
+        """
+
+    def record(self, operation, elapsed, mirror=None, error=False):
+        """
+        Record a finished span, elapsed seconds long
+        """
+
+
+class _Span(object):
+    def __init__(self, instrumentation, operation, mirror):
+        self.instrumentation = instrumentation
+        self.operation = operation
+        self.mirror = mirror
+        self.failed = False
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.instrumentation.record(
+            self.operation, time.time() - self.start, self.mirror,
+            self.failed or is_failure(exc))
+
+    def error(self):
+        """
+        Count the span as an error, for an operation that handles its own
+        exceptions
+        """
+        self.failed = True
+
+
+class _Series(object):
+    """
+    Count, errors, total seconds and histogram of one operation on a mirror
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(buckets)
+
+    def add(self, elapsed, error):
+        self.count += 1
+        self.seconds += elapsed
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(buckets):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self):
+        return {"count": self.count, "errors": self.errors,
+                "seconds": self.seconds,
+                "error_rate": float(self.errors) / self.count
+                if self.count else 0.0}
+
+
+def _escape(value):
+    return (value or "").replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def _by_key(items):
+    """
+    Sort (name, mirror) keyed items, the mirror may be None
+    """
+    return sorted(items, key=lambda x: (x[0][0], x[0][1] or ""))
+
+
+def _labels(**labels):
+    return "{%s}" % ",".join('%s="%s"' % (key, _escape(labels[key]))
+                             for key in sorted(labels))
+
+
+class Metrics(Instrumentation):
+    """
+    Keeps spans and counts in memory, for the Prometheus and json exporters
+    """
+    prefix = "spack_mirror"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._counters = {}
+        self.started = time.time()
+
+    def span(self, operation, mirror=None):
+        return _Span(self, operation, mirror)
+
+    def record(self, operation, elapsed, mirror=None, error=False):
+        key = (operation, mirror)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            series.add(elapsed, error)
+
+    def count(self, name, value=1, mirror=None):
+        key = (name, mirror)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+            self._counters = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        """
+        The recorded metrics as a dictionary, with an error rate for each
+        operation and mirror
+        """
+        with self._lock:
+            operations = {}
+            for (operation, mirror), series in _by_key(self._series.items()):
+                operations.setdefault(operation, {})[mirror or ""] = \
+                    series.to_dict()
+            counters = {}
+            for (name, mirror), value in _by_key(self._counters.items()):
+                counters.setdefault(name, {})[mirror or ""] = value
+        return {"started": self.started, "time": time.time(),
+                "operations": operations, "counters": counters}
+
+    def to_json(self, stream=None):
+        return sjson.dump(self.snapshot(), stream)
+
+    def to_prometheus(self):
+        """
+        The recorded metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            series = _by_key(self._series.items())
+            counters = _by_key(self._counters.items())
+
+            name = self.prefix + "_operation_seconds"
+            lines = ["# HELP %s Time spent in mirror operations" % name,
+                     "# TYPE %s histogram" % name]
+            for (operation, mirror), s in series:
+                cumulative = 0
+                for bound, value in zip(buckets, s.buckets):
+                    cumulative += value
+                    lines.append("%s_bucket%s %d" % (name, _labels(
+                        operation=operation, mirror=mirror, le=repr(bound)),
+                        cumulative))
+                labels = _labels(operation=operation, mirror=mirror)
+                lines.append("%s_bucket%s %d" % (name, _labels(
+                    operation=operation, mirror=mirror, le="+Inf"), s.count))
+                lines.append("%s_sum%s %r" % (name, labels, s.seconds))
+                lines.append("%s_count%s %d" % (name, labels, s.count))
+
+            name = self.prefix + "_operation_errors_total"
+            lines += ["# HELP %s Mirror operations that failed" % name,
+                      "# TYPE %s counter" % name]
+            for (operation, mirror), s in series:
+                lines.append("%s%s %d" % (name, _labels(
+                    operation=operation, mirror=mirror), s.errors))
+
+            seen = set()
+            for (counter, mirror), value in counters:
+                name = "%s_%s_total" % (self.prefix, counter)
+                if name not in seen:
+                    seen.add(name)
+                    lines.append("# TYPE %s counter" % name)
+                lines.append("%s%s %r" % (name, _labels(mirror=mirror), value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the metrics to path, as json if it ends in .json and in the
+        Prometheus text format otherwise (e.g. for a textfile collector)
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as stream:
+            if path.endswith('.json'):
+                self.to_json(stream)
+            else:
+                stream.write(self.to_prometheus())
+
+        # mkstemp creates the file private to us, collectors need to read it
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve /metrics (Prometheus) and /metrics.json from a daemon thread.
+        Only local connections are served unless another host is given
+        (e.g. '' for all interfaces). Returns the server, call its
+        shutdown() to stop it.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/metrics.json':
+                    body = metrics.to_json()
+                    content_type = 'application/json'
+                elif path in ('/', '/metrics'):
+                    body = metrics.to_prometheus()
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation():
+    """
+    The instrumentation mirror operations report to
+    """
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation=None):
+    """
+    Report to instrumentation from now on (None restores the default)
+    """
+    global _instrumentation
+    _instrumentation = instrumentation or Instrumentation()
+    return _instrumentation
+
+
+def enable():
+    """
+    Start recording to a new Metrics, and return it
+    """
+    return set_instrumentation(Metrics())
@@ -0,0 +1,254 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+A small OCI distribution client, to pull build cache archives from GHCR.
+
+This does what ``oras pull <ref>:latest`` does for a single file artifact
+without a subprocess or bootstrapping oras: resolve the manifest, pick the
+layer, and stream the blob to disk while checking its digest. Bearer
+tokens are requested once per repository scope and reused, and blobs are
+downloaded in resumable parallel ranges (see download.py).
+"""
+
+import base64
+import os
+import re
+import threading
+import time
+
+import llnl.util.tty as tty
+from llnl.util.filesystem import mkdirp
+
+import spack.util.spack_json as sjson
+
+from six.moves.urllib.parse import urlencode
+
+from . import blobs
+from .download import download
+from .errors import MirrorRequestError, error_for
+from .metrics import get_instrumentation
+from .session import session
+
+# Media types we accept for a manifest
+manifest_media_types = [
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.artifact.manifest.v1+json",
+]
+
+# The layer annotation oras uses for the file name
+title_annotation = "org.opencontainers.image.title"
+
+
+class OCIError(MirrorRequestError):
+    """A registry response we cannot use, such as a manifest without layers."""
+
+
+def parse_reference(reference):
+    """
+    Split a reference like ghcr.io/org/repo/path:tag into its parts.
+
+    Returns a tuple of (registry, repository, tag), where the tag defaults
+    to latest. A digest reference (@sha256:...) is returned as the tag.
+    """
+    reference = re.sub('^[a-z]+://', '', reference)
+    registry, _, rest = reference.partition('/')
+    if '@' in rest:
+        repository, _, tag = rest.partition('@')
+    elif ':' in rest.rsplit('/', 1)[-1]:
+        repository, _, tag = rest.rpartition(':')
+    else:
+        repository, tag = rest, 'latest'
+    return registry, repository, tag
+
+
+def _parse_challenge(header):
+    """
+    Parse a WWW-Authenticate Bearer challenge into a dictionary
+    """
+    if not header or not header.lower().startswith('bearer '):
+        return {}
+    return dict(re.findall(r'(\w+)="([^"]*)"', header[len('bearer '):]))
+
+
+class OCIClient(object):
+    """
+    Pull manifests and blobs from one registry over the shared session
+    """
+    def __init__(self, registry, username=None, password=None,
+                 scheme='https'):
+        self.registry = registry
+        self.scheme = scheme
+        self.username = username
+        self.password = password
+        self._tokens = {}
+        self._realm = None
+        self._service = None
+        self._lock = threading.Lock()
+
+    def _url(self, repository, kind, reference):
+        return "%s://%s/v2/%s/%s/%s" % (
+            self.scheme, self.registry, repository, kind, reference)
+
+    def _scope(self, repository):
+        return "repository:%s:pull" % repository
+
+    def _token(self, scope):
+        """
+        Return a valid cached bearer token for scope, if we have one
+        """
+        with self._lock:
+            token = self._tokens.get(scope)
+        if token and token[1] > time.time():
+            return token[0]
+
+    def _request_token(self, challenge, scope):
+        """
+        Ask the registry's token service for a pull token for scope
+        """
+        realm = challenge.get('realm') or self._realm
+        params = {'scope': challenge.get('scope') or scope}
+        if challenge.get('service'):
+            params['service'] = challenge['service']
+
+        headers = {}
+        if self.username and self.password:
+            credentials = '%s:%s' % (self.username, self.password)
+            headers['Authorization'] = 'Basic %s' % base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+
+        url = '%s?%s' % (realm, urlencode(sorted(params.items())))
+        response = session.get(url, headers=headers)
+        if response.status != 200:
+            raise error_for(url, response.status, 'Token request failed')
+        data = sjson.load(response)
+        token = data.get('token') or data.get('access_token')
+        expires = time.time() + int(data.get('expires_in') or 300) - 10
+
+        with self._lock:
+            self._realm = realm
+            self._service = challenge.get('service') or self._service
+            self._tokens[scope] = (token, expires)
+        return token
+
+    def _get(self, repository, url, headers=None, stream=False):
+        """
+        GET a registry url, authenticating with a bearer token if needed
+        """
+        headers = dict(headers or {})
+
+        # With a known token service, get a token before the first request
+        headers.update(self._auth_headers(repository))
+
+        response = session.get(url, headers=headers, stream=stream)
+        if response.status == 401:
+            response.close()
+            headers.update(self._reauthenticate(repository, response))
+            response = session.get(url, headers=headers, stream=stream)
+
+        if response.status not in (200, 206):
+            with response:
+                response.read()
+            raise error_for(url, response.status)
+        return response
+
+    def get_manifest(self, repository, reference='latest'):
+        """
+        Return the image manifest for a repository reference
+        """
+        url = self._url(repository, 'manifests', reference)
+        headers = {'Accept': ', '.join(manifest_media_types)}
+        return sjson.load(self._get(repository, url, headers=headers))
+
+    def _auth_headers(self, repository):
+        """
+        Headers carrying a bearer token for repository, if one is needed
+        """
+        scope = self._scope(repository)
+        token = self._token(scope)
+        if token is None and self._realm:
+            token = self._request_token({'service': self._service}, scope)
+        return {'Authorization': 'Bearer %s' % token} if token else {}
+
+    def _reauthenticate(self, repository, response):
+        """
+        Headers with a new bearer token for repository, after response was
+        a 401 (no token yet, or it expired)
+        """
+        challenge = _parse_challenge(response.headers.get('WWW-Authenticate'))
+        if not (challenge.get('realm') or self._realm):
+            raise error_for(response.url, 401, 'No bearer challenge')
+        token = self._request_token(challenge, self._scope(repository))
+        return {'Authorization': 'Bearer %s' % token}
+
+    def fetch_blob(self, repository, digest, path, size=None):
+        """
+        Download a blob to path, in parallel ranges when it is large.
+
+        A partial download is resumed, the content is checked against the
+        digest as it arrives, and the file is only moved into place if it
+        matches. A token that expires during the download is renewed.
+        """
+        url = self._url(repository, 'blobs', digest)
+        return download(url, path, digest=digest, size=size,
+                        headers=self._auth_headers(repository),
+                        auth=lambda response: self._reauthenticate(
+                            repository, response))
+
+    def pull(self, repository, dest, reference='latest', name=None):
+        """
+        Pull a single file artifact into the dest directory.
+
+        The layer is chosen by its title annotation (name, if given),
+        falling back to the first layer. Returns the path written.
+        """
+        manifest = self.get_manifest(repository, reference)
+        layers = manifest.get('layers') or manifest.get('blobs') or []
+        if not layers:
+            raise OCIError(self._url(repository, 'manifests', reference),
+                           reason='Manifest has no layers')
+
+        layer = layers[0]
+        for candidate in layers:
+            title = candidate.get('annotations', {}).get(title_annotation)
+            if name is None or title == name:
+                layer = candidate
+                break
+
+        title = layer.get('annotations', {}).get(title_annotation)
+        filename = title or name or repository.rsplit('/', 1)[-1]
+        mkdirp(dest)
+        path = os.path.join(dest, os.path.basename(filename))
+        tty.debug('Pulling {0} to {1}'.format(layer['digest'], path))
+        return blobs.fetch(
+            layer['digest'], path, lambda path: self.fetch_blob(
+                repository, layer['digest'], path, size=layer.get('size')))
+
+
+# Clients (and their tokens) are shared by registry and user
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(registry, username=None, password=None, scheme='https'):
+    key = (registry, username, scheme)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = OCIClient(registry, username, password, scheme=scheme)
+            _clients[key] = client
+        return client
+
+
+def pull(reference, dest=None, username=None, password=None,
+         scheme='https'):
+    """
+    Pull a reference (registry/repository[:tag]) to dest, like oras pull
+    """
+    registry, repository, tag = parse_reference(reference)
+    client = get_client(registry, username, password, scheme=scheme)
+    with get_instrumentation().span('oci_pull', registry):
+        return client.pull(repository, dest or os.getcwd(), reference=tag)
@@ -0,0 +1,94 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Small threading helpers for issuing mirror requests concurrently.
+"""
+
+import sys
+import threading
+
+_PENDING = object()
+
+
+class _OrderedProbe(object):
+    """
+    Run a function over an ordered list of items with a bounded number of
+    threads, stopping as soon as the earliest item with a result is known.
+    """
+    def __init__(self, func, items, jobs):
+        self.func = func
+        self.items = list(items)
+        self.jobs = max(1, min(jobs, len(self.items)))
+        self.results = [_PENDING] * len(self.items)
+        self.cond = threading.Condition()
+
+        # Next item to start, and the index after which nothing is started
+        self._next = 0
+        self._stop = len(self.items)
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                if self._next >= self._stop:
+                    return
+                index = self._next
+                self._next += 1
+
+            try:
+                result = (self.func(self.items[index]), None)
+            except Exception:
+                result = (None, sys.exc_info())
+
+            with self.cond:
+                self.results[index] = result
+
+                # An answer here makes every later item irrelevant
+                if result[0] and index < self._stop:
+                    self._stop = index
+                self.cond.notify_all()
+
+    def run(self):
+        for _ in range(self.jobs):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+        for index, item in enumerate(self.items):
+            with self.cond:
+                while self.results[index] is _PENDING:
+                    self.cond.wait()
+                result, exc_info = self.results[index]
+
+            if exc_info:
+                self._cancel()
+                raise exc_info[1]
+            if result:
+                return item, result
+
+    def _cancel(self):
+        with self.cond:
+            self._stop = 0
+
+
+def first_hit(func, items, jobs=4):
+    """
+    Call func on each item, up to jobs at a time, and return a tuple of
+    (item, result) for the first item in order that gave a truthy result.
+
+    Items are started in order. Once an item has answered, items that come
+    after it and have not started yet are never requested, and in flight
+    requests for them are abandoned. Returns None if nothing matched.
+    """
+    items = list(items)
+    if not items:
+        return
+    if jobs <= 1:
+        for item in items:
+            result = func(item)
+            if result:
+                return item, result
+        return
+    return _OrderedProbe(func, items, jobs).run()
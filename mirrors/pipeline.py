@@ -0,0 +1,273 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Resolve, download and verify build cache entries as a pipeline.
+
+Looking up a spec, downloading its archive and checking it are independent
+steps, so instead of doing them one spec at a time each step here has its
+own pool of threads, with bounded queues in between. Archives start
+downloading while later specs are still being resolved, and a full
+download queue holds resolving back rather than piling up matches.
+
+A resolved spec carries its whole concrete dependency DAG, so its
+dependencies are queued for resolving (and downloading) ahead of the specs
+that were asked for. Finished archives are handed to the caller's on_ready
+callback in dependency order, which is the order an installer extracts
+them in.
+"""
+
+import collections
+import itertools
+import tarfile
+import threading
+
+import llnl.util.tty as tty
+
+from six.moves import queue
+
+# Queue priorities, dependencies before the specs that need them
+_DEPENDENCY = 0
+_REQUESTED = 1
+
+
+def specfile_name(spec):
+    """
+    The build cache specfile name for a concrete spec
+    """
+    import spack.binary_distribution as bindist
+    return bindist.tarball_name(spec, '.spec.json')
+
+
+def verify_archive(match, path):
+    """
+    Check that a downloaded .spack archive holds a specfile.
+
+    The content was already checked against the specfile's checksum while
+    it downloaded (when the specfile has one), so this only catches an
+    archive that is not a build cache entry at all.
+    """
+    with tarfile.open(path) as archive:
+        return any(name.endswith(('.spec.json', '.spec.yaml'))
+                   for name in archive.getnames())
+
+
+class PipelineResult(object):
+    """
+    The outcome for one specfile: its match, archive path, or error
+    """
+    def __init__(self, name, match=None, path=None, error=None,
+                 dependencies=None):
+        self.name = name
+        self.match = match
+        self.path = path
+        self.error = error
+        self.dependencies = dependencies or []
+
+    @property
+    def ok(self):
+        return self.path is not None and self.error is None
+
+
+class Pipeline(object):
+    """
+    Resolve specfiles across a MirrorCollection, download their archives to
+    dest and verify them, with each stage running concurrently.
+
+    queue_size bounds the matches waiting for a download and the archives
+    waiting to be verified. verify is called with (match, path) and returns
+    False (or raises) for a bad archive, and defaults to verify_archive.
+    on_ready, if given, is called with each PipelineResult once it and all
+    of its dependencies are done, dependencies first.
+    """
+    def __init__(self, collection, dest=None, resolve_jobs=8,
+                 download_jobs=4, verify_jobs=2, queue_size=16,
+                 dependencies=True, verify=None, on_ready=None):
+        self.collection = collection
+        self.dest = dest
+        self.resolve_jobs = resolve_jobs
+        self.download_jobs = download_jobs
+        self.verify_jobs = verify_jobs
+        self.queue_size = queue_size
+        self.dependencies = dependencies
+        self.verify = verify or verify_archive
+        self.on_ready = on_ready
+
+    def _start(self, target, jobs):
+        threads = [threading.Thread(target=target) for _ in range(jobs)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def _put(self, q, priority, item):
+        # The counter keeps items of the same priority in order
+        q.put((priority, next(self._counter), item))
+
+    def _get(self, q):
+        return q.get()[2]
+
+    def _resolve(self, name, priority):
+        """
+        Queue a specfile for resolving, unless it already is
+        """
+        with self._lock:
+            if name in self._results:
+                return
+            self._results[name] = PipelineResult(name)
+        self._put(self._resolve_queue, priority, name)
+
+    def _resolve_worker(self):
+        while True:
+            name = self._get(self._resolve_queue)
+            try:
+                if name is None:
+                    return
+                self._resolve_one(name)
+            except Exception as e:
+                # Anything raised past the lookup still finishes the result,
+                # so the worker lives on and run() is not left waiting
+                tty.debug('Failed to resolve {0}: {1}'.format(name, e))
+                result = self._results[name]
+                result.error = e
+                self._done(result)
+            finally:
+                self._resolve_queue.task_done()
+
+    def _resolve_one(self, name):
+        result = self._results[name]
+        try:
+            result.match = self.collection._fetch_first(name)
+        except Exception as e:
+            result.error = e
+        if result.match is None:
+            if result.error is None:
+                tty.debug('No mirror has {0}'.format(name))
+            self._done(result)
+            return
+
+        spec = result.match.spec
+        priority = _REQUESTED if name in self._requested else _DEPENDENCY
+        if self.dependencies:
+            result.dependencies = [specfile_name(dep)
+                                   for dep in spec.dependencies()]
+
+            # Dependencies (leaves first) go ahead of everything requested
+            for dep in spec.traverse(order='post', root=False):
+                self._resolve(specfile_name(dep), _DEPENDENCY)
+
+        # This blocks while the download queue is full
+        self._put(self._download_queue, priority, result)
+
+    def _download_worker(self):
+        while True:
+            result = self._get(self._download_queue)
+            if result is None:
+                return
+            try:
+                mirror = result.match.mirror
+                result.path = mirror.fetch_tarball(result.match, self.dest)
+            except Exception as e:
+                tty.debug('Failed to download {0}: {1}'.format(result.name, e))
+                result.error = e
+                self._done(result)
+                continue
+            self._verify_queue.put(result)
+
+    def _verify_worker(self):
+        while True:
+            result = self._verify_queue.get()
+            if result is None:
+                return
+            try:
+                if not self.verify(result.match, result.path):
+                    raise ValueError('%s is not a valid build cache archive'
+                                     % result.path)
+            except Exception as e:
+                tty.debug('Failed to verify {0}: {1}'.format(result.name, e))
+                result.error = e
+            self._done(result)
+
+    def _done(self, result):
+        """
+        Mark a result finished, and release those whose dependencies are
+        """
+        with self._lock:
+            self._finished.append(result.name)
+            self._waiting.add(result.name)
+            changed = True
+            while changed:
+                changed = False
+                for name in sorted(self._waiting):
+                    deps = self._results[name].dependencies
+                    if all(dep in self._released or dep not in self._results
+                           for dep in deps):
+                        self._waiting.remove(name)
+                        self._released.add(name)
+                        self._unhandled.append(self._results[name])
+                        changed = True
+
+        # Callbacks run one at a time, in the order results were released,
+        # by whichever thread gets here first
+        with self._ready_lock:
+            while True:
+                with self._lock:
+                    if not self._unhandled:
+                        return
+                    result = self._unhandled.popleft()
+                self._ready(result)
+
+    def _ready(self, result):
+        if self.on_ready is None:
+            return
+        try:
+            self.on_ready(result)
+        except Exception as e:
+            tty.warn('Error handling {0}: {1}'.format(result.name, e))
+
+    def run(self, specfile_names):
+        """
+        Run the pipeline for specfile names (and their dependencies).
+
+        Returns an ordered dictionary of specfile name to PipelineResult,
+        in the order they finished.
+        """
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._ready_lock = threading.Lock()
+        self._results = collections.OrderedDict()
+        self._requested = set(specfile_names)
+        self._finished = []
+        self._waiting = set()
+        self._released = set()
+        self._unhandled = collections.deque()
+
+        self._resolve_queue = queue.PriorityQueue()
+        self._download_queue = queue.PriorityQueue(self.queue_size)
+        self._verify_queue = queue.Queue(self.queue_size)
+
+        resolvers = self._start(self._resolve_worker, self.resolve_jobs)
+        downloaders = self._start(self._download_worker, self.download_jobs)
+        verifiers = self._start(self._verify_worker, self.verify_jobs)
+
+        for name in specfile_names:
+            self._resolve(name, _REQUESTED)
+
+        # Resolving is done once nothing (including dependencies found on
+        # the way) is left, then each stage is shut down in turn
+        self._resolve_queue.join()
+        for _ in resolvers:
+            self._put(self._resolve_queue, _REQUESTED + 1, None)
+        for _ in downloaders:
+            self._put(self._download_queue, _REQUESTED + 1, None)
+        for thread in downloaders:
+            thread.join()
+        for _ in verifiers:
+            self._verify_queue.put(None)
+        for thread in verifiers + resolvers:
+            thread.join()
+
+        return collections.OrderedDict(
+            (name, self._results[name]) for name in self._finished)
@@ -0,0 +1,94 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Retry a call with exponential backoff and jitter, for transient errors only.
+"""
+
+import random
+import socket
+import time
+
+import llnl.util.tty as tty
+
+from six.moves.urllib.error import HTTPError, URLError
+
+from .errors import _connection_errnos, transient_statuses
+
+try:
+    _connection_error = ConnectionError
+except NameError:
+    # Python 2, where only sockets raise socket.error
+    _connection_error = socket.error
+
+
+def is_transient(error):
+    """
+    Default check for an error worth retrying.
+
+    Mirror request errors carry their own classification; otherwise only
+    timeouts and connection level errors are retried. Other OS errors, like
+    a missing file or a full disk, are not (in Python 3 socket.error is
+    OSError, so it is not a sign of a network problem).
+    """
+    if hasattr(error, 'transient'):
+        return error.transient
+    if isinstance(error, HTTPError):
+        return error.code in transient_statuses
+    if isinstance(error, (socket.timeout, _connection_error, URLError)):
+        return True
+    return (isinstance(error, EnvironmentError) and
+            error.errno in _connection_errnos)
+
+
+class RetryPolicy(object):
+    """
+    How many times to try a call, and how long to wait in between.
+
+    The delay before retry n is base_delay * 2 ** n, capped at max_delay,
+    and reduced by a random fraction (up to jitter) so that many workers
+    that failed together do not retry together.
+    """
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=30.0,
+                 jitter=0.5, retry_on=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on = retry_on or is_transient
+
+    def delay(self, retry):
+        delay = min(self.max_delay, self.base_delay * 2 ** retry)
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func with args, retrying transient errors.
+
+        An on_retry keyword, if given, is called with the error before each
+        retry. The last error is raised once attempts run out.
+        """
+        on_retry = kwargs.pop('on_retry', None)
+        retry = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if retry + 1 >= self.attempts or not self.retry_on(e):
+                    raise
+                delay = self.delay(retry)
+                tty.debug('Retrying in {0:.1f}s after: {1}'.format(delay, e))
+                if on_retry:
+                    on_retry(e)
+            time.sleep(delay)
+            retry += 1
+
+    def replace(self, **kwargs):
+        """
+        Return a copy of this policy with some settings changed
+        """
+        settings = dict(self.__dict__)
+        settings.update(kwargs)
+        return RetryPolicy(**settings)
@@ -7,17 +7,14 @@
 An S3 specific mirror.
 """
 
-import spack.util.spack_json as sjson
 import llnl.util.tty as tty
 import spack.util.url as url_util
-import spack.util.web as web_util
 
-from six.moves.urllib.error import URLError
-
-import os
-import codecs
+import collections
 
 from .base import Mirror
+from .errors import MirrorRequestError
+from .manifest import manifests
 
 
 class MirrorS3(Mirror):
@@ -76,37 +73,34 @@ class MirrorS3(Mirror):
             return self._fetch_url["url"]
         return self._push_url["url"]
 
-    def get_fingerprint_links(self):
+    def get_key_links(self):
         """
-        Return a lookup of links (to .pub) and key metadata with each
+        Return a lookup of fingerprint to (link to .pub, key metadata)
+
+        The keys index is revalidated with a conditional request each time,
+        and a MirrorRequestError is raised if it cannot be read (rather than
+        using a stale copy). A mirror without an index has no keys.
         """
         # A mirror can define its own keys urls/index, or fall back to AWS
-        keys_url = url_util.join(self.fetch_url,
-                                 self._build_cache_relative_path,
-                                 self._build_cache_keys_relative_path)
-        keys_index = url_util.join(keys_url, 'index.json')
+        json_index = manifests.get(self.keys_url('index.json'), max_age=0,
+                                   read=self._read, strict=True)
+        if not json_index:
+            return {}
+        return collections.OrderedDict(
+            (fingerprint, (self.keys_url(fingerprint + '.pub'), metadata))
+            for fingerprint, metadata in json_index.get('keys', {}).items())
 
+    def get_fingerprint_links(self):
+        """
+        Return a lookup of links (to .pub) and key metadata with each
+        """
         tty.debug('Finding public keys in {0}'.format(
             url_util.format(self.fetch_url)))
-
         try:
-            _, _, json_file = web_util.read_from_url(keys_index)
-            json_index = sjson.load(codecs.getreader('utf-8')(json_file))
-        except (URLError, web_util.SpackWebError) as url_err:
-            if web_util.url_exists(keys_index):
-                err_msg = [
-                    'Unable to find public keys in {0},',
-                    ' caught exception attempting to read from {1}.',
-                ]
-
-                tty.error(''.join(err_msg).format(
-                    url_util.format(self.fetch_url),
-                    url_util.format(keys_index)))
-
-                tty.debug(url_err)
-
+            key_links = self.get_key_links()
+        except MirrorRequestError as e:
+            tty.warn('Unable to read the keys index of {0}: {1}'.format(
+                self.name, e))
             return
-
-        for fingerprint, _ in json_index['keys'].items():
-            link = os.path.join(keys_url, fingerprint + '.pub')
+        for link, _ in key_links.values():
             yield link
@@ -0,0 +1,440 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+A pooled, keep-alive http(s) session shared by all mirrors.
+
+spack.util.web.read_from_url opens a new connection (and for https, does a
+new TLS handshake) for every url. Mirror lookups are many small json
+requests against the same few hosts, so here we keep a bounded pool of
+persistent connections per host and reuse them for the next request.
+
+If httpx (with h2) is installed, setting ``session.http2 = True`` sends
+requests over HTTP/2 instead. Urls that go through a proxy (http_proxy,
+https_proxy and no_proxy) are sent with urllib, which supports proxies.
+Urls that are not http or https (e.g., file:// and s3://) are handed to
+spack.util.web as before, which takes no request headers, so there is no
+Range or conditional request for them (see supports_headers).
+"""
+
+import io
+import os
+import socket
+import ssl
+import threading
+
+import llnl.util.tty as tty
+
+import spack.config
+import spack.util.url as url_util
+import spack.util.web as web_util
+
+from six.moves import http_client
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urljoin, urlsplit
+from six.moves.urllib.request import (
+    HTTPRedirectHandler, HTTPSHandler, Request, build_opener, getproxies,
+    proxy_bypass)
+
+from .errors import MirrorNotFoundError, error_for, error_from
+from .retry import RetryPolicy
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Errors of a request (or of reading its body) that mean the connection
+# failed, as opposed to a status from the server
+_connection_errors = (http_client.HTTPException, socket.error, ssl.SSLError,
+                      IOError)
+if httpx is not None:
+    _connection_errors += (httpx.HTTPError,)
+
+# Statuses that are a success for the caller (304 for conditional requests)
+_ok_statuses = (200, 203, 206, 304)
+_redirect_statuses = (301, 302, 303, 307, 308)
+
+# Attempts and backoff for transient errors
+retry_policy = RetryPolicy(attempts=3, base_delay=0.5, max_delay=4.0)
+
+
+class Response(object):
+    """
+    A response from the session, readable like a file.
+
+    Unless the request was made with stream=True the body is already read
+    and the connection is back in the pool. A streamed response goes back
+    to the pool once read to the end or closed, or when it is garbage
+    collected. Errors while reading the body raise a MirrorRequestError.
+    """
+    def __init__(self, url, status, headers, body=None, stream=None,
+                 release=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self._body = io.BytesIO(body or b'') if stream is None else None
+        self._stream = stream
+        self._release = release
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def read(self, size=-1):
+        if self._stream is None:
+            return self._body.read(size)
+        try:
+            data = self._stream.read() if size is None or size < 0 \
+                else self._stream.read(size)
+        except _connection_errors as e:
+            self.close()
+            raise error_for(self.url, reason=str(e))
+        if not data or self._stream.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        if self._release:
+            release, self._release = self._release, None
+            release(self._stream.isclosed())
+
+    def __del__(self):
+        # An unread response would hold its slot in the pool for good
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _ClosingStream(object):
+    """
+    A file-like response from urllib or spack.util.web, with the isclosed()
+    of an http.client response, to stream through a Response
+    """
+    def __init__(self, response):
+        self._response = response
+        self._closed = False
+
+    def read(self, size=-1):
+        whole = size is None or size < 0
+        data = self._response.read() if whole else self._response.read(size)
+        if whole or not data:
+            self.close()
+        return data
+
+    def isclosed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._response.close()
+
+
+def _response_for(url, status, headers, response, stream):
+    """
+    A Response for a file-like response, streamed or read into memory
+    """
+    stream = _ClosingStream(response) if stream else None
+    if stream is not None:
+        return Response(url, status, headers, stream=stream,
+                        release=lambda closed: stream.close())
+    try:
+        body = response.read()
+    finally:
+        response.close()
+    return Response(url, status, headers, body=body)
+
+
+class _NoRedirects(HTTPRedirectHandler):
+    """
+    Hand redirects back to Session.request, which drops credentials on a
+    redirect to another host
+    """
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _HostPool(object):
+    """
+    Idle persistent connections to one host, with at most size in use
+    """
+    def __init__(self, scheme, netloc, size, timeout, context):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.context = context
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return http_client.HTTPSConnection(
+                self.netloc, timeout=self.timeout, context=self.context)
+        return http_client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def acquire(self):
+        """
+        Return a tuple of (connection, reused) once a slot is free
+        """
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def release(self, connection, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class Session(object):
+    """
+    Per host pools of keep-alive connections, used for all mirror requests
+    """
+    max_redirects = 5
+
+    def __init__(self, pool_size=16, http2=False):
+        self.pool_size = pool_size
+        self.http2 = http2
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._context = None
+        self._http2_client = None
+        self._opener = None
+
+    @property
+    def timeout(self):
+        return spack.config.get('config:connect_timeout', 10)
+
+    @property
+    def context(self):
+        if self._context is None:
+            if spack.config.get('config:verify_ssl', True):
+                self._context = ssl.create_default_context()
+            else:
+                self._context = ssl._create_unverified_context()
+        return self._context
+
+    def _pool(self, scheme, netloc):
+        with self._lock:
+            pool = self._pools.get((scheme, netloc))
+            if pool is None:
+                pool = _HostPool(scheme, netloc, self.pool_size,
+                                 self.timeout, self.context)
+                self._pools[(scheme, netloc)] = pool
+            return pool
+
+    def close(self):
+        """
+        Close all idle connections, e.g., after a fork
+        """
+        with self._lock:
+            pools, self._pools = self._pools, {}
+            client, self._http2_client = self._http2_client, None
+            self._opener = None
+        for pool in pools.values():
+            pool.close()
+        if client is not None:
+            client.close()
+
+    def _send(self, method, url, headers, stream):
+        """
+        Send one request over a pooled connection, without redirects
+        """
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = dict(headers or {})
+        headers.setdefault('Host', parts.netloc)
+        headers.setdefault('User-Agent', web_util.SPACK_USER_AGENT)
+
+        pool = self._pool(parts.scheme, parts.netloc)
+        while True:
+            connection, reused = pool.acquire()
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+                break
+            except (http_client.HTTPException, socket.error):
+                pool.release(connection, False)
+
+                # The server may have closed an idle keep-alive connection
+                if reused:
+                    continue
+                raise
+
+        if stream and method != 'HEAD':
+            def release(closed):
+                pool.release(connection, not response.will_close and closed)
+            return Response(url, response.status, response.msg,
+                            stream=response, release=release)
+
+        try:
+            body = response.read()
+        except (http_client.HTTPException, socket.error):
+            pool.release(connection, False)
+            raise
+        pool.release(connection, not response.will_close)
+        return Response(url, response.status, response.msg, body=body)
+
+    def _send_http2(self, method, url, headers, stream):
+        if self._http2_client is None:
+            with self._lock:
+                if self._http2_client is None:
+                    self._http2_client = httpx.Client(
+                        http2=True, verify=self.context, timeout=self.timeout,
+                        limits=httpx.Limits(
+                            max_connections=self.pool_size,
+                            max_keepalive_connections=self.pool_size))
+        response = self._http2_client.request(method, url, headers=headers)
+        return Response(url, response.status_code, response.headers,
+                        body=response.content)
+
+    def _send_proxied(self, method, url, headers, stream):
+        """
+        Send one request with urllib, through the environment's proxy, and
+        without redirects
+        """
+        if self._opener is None:
+            self._opener = build_opener(HTTPSHandler(context=self.context),
+                                        _NoRedirects())
+        request = Request(url, headers=dict(headers or {}))
+        request.get_method = lambda: method
+        request.add_header('User-Agent', web_util.SPACK_USER_AGENT)
+        try:
+            response = self._opener.open(request, timeout=self.timeout)
+        except HTTPError as e:
+            response = e
+        return _response_for(url, response.getcode(), response.info(),
+                             response, stream and method != 'HEAD')
+
+    def supports_headers(self, url):
+        """
+        True if request headers (e.g., Range or If-None-Match) reach the
+        server for url, which is not the case for file:// and s3:// urls
+        """
+        return urlsplit(url).scheme in ('http', 'https')
+
+    def request(self, method, url, headers=None, stream=False):
+        """
+        Perform a request and return a Response, following redirects.
+
+        Any status is returned as is, and connection problems raise a
+        MirrorTransientError.
+        """
+        scheme = urlsplit(url).scheme
+        if scheme not in ('http', 'https'):
+            return self._request_fallback(method, url, stream)
+
+        for _ in range(self.max_redirects + 1):
+            send = self._send
+            if self.http2 and httpx is not None and scheme == 'https':
+                send = self._send_http2
+            elif _proxied(url):
+                send = self._send_proxied
+            try:
+                response = send(method, url, headers, stream)
+            except _connection_errors as e:
+                raise error_for(url, reason=str(e))
+            if response.status not in _redirect_statuses:
+                return response
+            response.close()
+            location = urljoin(url, response.headers.get('Location'))
+            tty.debug('Redirected to {0}'.format(location))
+
+            # Credentials are only for the host they were meant for (e.g.,
+            # a registry that redirects blob downloads to a CDN)
+            if headers and urlsplit(location).netloc != urlsplit(url).netloc:
+                headers = dict((k, v) for k, v in headers.items()
+                               if k.lower() != 'authorization')
+            url = location
+
+        raise error_for(url, response.status, 'Too many redirects')
+
+    def _request_fallback(self, method, url, stream):
+        """
+        Non-http urls (file, s3) go through spack's own url handling, which
+        takes no request headers (a Range is answered with the whole body)
+        """
+        if method == 'HEAD':
+            exists = web_util.url_exists(url)
+            return Response(url, 200 if exists else 404, {})
+        try:
+            url, response_headers, response = web_util.read_from_url(url)
+        except web_util.SpackWebError as e:
+            # A missing local file is a definite answer
+            path = url_util.local_file_path(url)
+            if path and not os.path.exists(path):
+                raise MirrorNotFoundError(url, reason=str(e))
+            raise error_from(url, e)
+        try:
+            return _response_for(url, 200, response_headers, response, stream)
+        except _connection_errors as e:
+            raise error_from(url, e)
+
+    def get(self, url, headers=None, stream=False):
+        return self.request('GET', url, headers=headers, stream=stream)
+
+    def head(self, url, headers=None):
+        return self.request('HEAD', url, headers=headers)
+
+
+def _proxied(url):
+    """
+    True if the environment sends requests for url through a proxy
+    """
+    parts = urlsplit(url)
+    return (parts.scheme in getproxies() and
+            not proxy_bypass(parts.netloc.rsplit('@', 1)[-1]))
+
+
+# Shared by every mirror in the process
+session = Session()
+
+
+def _get_ok(url, headers, stream):
+    response = session.get(url, headers=headers, stream=stream)
+    if response.status not in _ok_statuses:
+        # Drain the (small) error body so the connection is reused
+        with response:
+            response.read()
+        raise error_for(url, response.status)
+    return response
+
+
+def read_from_url(url, headers=None, retries=None, stream=False):
+    """
+    A pooled drop in for spack.util.web.read_from_url.
+
+    Returns (url, headers, response) for a successful request. Otherwise
+    raises a MirrorRequestError for the status of the response, after
+    retrying transient errors with the module's retry_policy (or up to
+    retries times). With stream=True the body is read from the connection
+    as the caller consumes it, and the caller should close the response.
+    """
+    policy = retry_policy
+    if retries is not None:
+        policy = policy.replace(attempts=retries + 1)
+    response = policy.call(_get_ok, url, headers, stream)
+    return response.url, response.headers, response
@@ -11,7 +11,10 @@ import spack.fetch_strategy as fetch
 from spack.util.spack_yaml import syaml_dict
 
 import llnl.util.tty as tty
+import spack.util.executable
 import spack.util.url as url_util
+import multiprocessing.pool
+import threading
 import re
 import os
 import sys
@@ -92,6 +95,29 @@ def add(name, url, scope, args={}):
     spack.config.set("mirrors", mirrors, scope=scope)
 
 
+# The oras executable is bootstrapped and found once per process
+_oras = None
+_oras_lock = threading.Lock()
+
+
+def get_oras():
+    """
+    Bootstrap (if needed) and return the oras executable
+    """
+    global _oras
+    with _oras_lock:
+        if _oras is None:
+            import spack.bootstrap
+
+            with spack.bootstrap.ensure_bootstrap_configuration():
+                spec = spack.spec.Spec("oras")
+                oras = spack.bootstrap.ensure_executables_in_path_or_raise(
+                    ["oras"], abstract_spec=spec
+                )
+                _oras = oras or spack.util.executable.which("oras")
+    return _oras
+
+
 # This is only here for visibility, it belongs inside a fetcher.
 def oras_fetch(url, dest=None):
     """
@@ -99,20 +125,38 @@ def oras_fetch(url, dest=None):
     """
     if dest == None:
         dest = os.getcwd()
-    import spack.bootstrap
 
     tty.msg("Fetching oras {0}".format(url))
+    oras = get_oras()
+    cmd = ["pull", url + ":latest", "--output", dest]
+    tty.msg(" ".join(cmd))
+    oras(*cmd)
+    return dest
 
-    with spack.bootstrap.ensure_bootstrap_configuration():
-        spec = spack.spec.Spec("oras")
-        spack.bootstrap.ensure_executables_in_path_or_raise(
-            ["oras"], abstract_spec=spec
-        )
-        oras = spack.util.executable.which("oras")
-        cmd = ["pull", url + ":latest", "--output", dest]
-        tty.msg(" ".join(cmd))
-        oras(*cmd)
-        return dest
+
+def oras_fetch_many(urls, dest=None, jobs=4):
+    """
+    Fetch many binary cache entries with up to jobs oras pulls at once.
+
+    Returns a dictionary of url to the destination, or None if it failed.
+    """
+    urls = list(urls)
+    if not urls:
+        return {}
+    get_oras()
+
+    def pull(url):
+        try:
+            return oras_fetch(url, dest)
+        except spack.util.executable.ProcessError as e:
+            tty.warn("Failed to pull %s: %s" % (url, e))
+
+    pool = multiprocessing.pool.ThreadPool(max(1, min(jobs, len(urls))))
+    try:
+        return dict(zip(urls, pool.map(pull, urls, chunksize=1)))
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 # This could also be added as a function to a URL Fetcher
@@ -127,11 +171,18 @@ class OrasFetcher(fetch.URLFetchStrategy):
 
     @fetch._needs_stage
     def fetch(self):
+        errors = []
         for url in self.candidate_urls:
 
             # This would fit into the current URLFetchstategy.fetch
             # you would want to check for prefix ghcr or oras first
-            self._oras_fetch(url)
+            try:
+                self._oras_fetch(url)
+                return
+            except spack.util.executable.ProcessError as e:
+                errors.append(str(e))
+
+        raise fetch.FailedDownloadError(self.url, "; ".join(errors))
 
 
 def main():
@@ -160,16 +211,19 @@ def main():
             # The GHCR build cache does not currently support yaml (it is deprecated)
             spec_json = "linux-ubuntu20.04-broadwell-gcc-10.3.0-ncurses-6.2-76gsydzye33lca3iqhfijgaxiq46ga53.spec.json"
 
-            # The mirror download is the to_dict() result of a new class, MirrorDownload, that might be useful to have
+            # The mirror download is a MirrorDownload, a small immutable record of the spec and mirror
             mirror_download = mirror.fetch_spec(spec_json)
 
             # a set of these objects is passed between installer.py and binary_distribution.py
             # Until we get into the part to generate a url for Stage, we do that by modifying the fetcher.
             # Here we will just use a custom fetcher that would be run in stage to pop the binary .spack
             # archive where it needs to be. We get the final url again from the mirror
-            url = mirror_download["mirror"].get_download_tarball(mirror_download)
+            url = mirror_download.mirror.get_download_tarball(mirror_download)
             tty.info("Preparing to download %s" % url)
-            oras_fetch(url)
+
+            # The GHCR mirror can pull it natively, oras_fetch(url) does the same
+            path = mirror_download.mirror.pull_tarball(mirror_download)
+            tty.info("Downloaded %s" % path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""
+Fixtures for the mirrors tests, run with spack's python:
+
+    spack python -m pytest tests
+
+Requests go to the build cache stand-in from benchmarks/server.py, and
+the misc cache, blob cache and mirror health are kept in a temporary
+directory, so every test starts cold.
+"""
+
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "benchmarks"))
+
+import spack.caches  # noqa: E402
+from spack.util.file_cache import FileCache  # noqa: E402
+
+import mirrors.blobs  # noqa: E402
+import mirrors.download  # noqa: E402
+import mirrors.health  # noqa: E402
+import mirrors.oci  # noqa: E402
+from server import BuildCacheServer  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    with BuildCacheServer(latency=0) as server:
+        yield server
+
+
+@pytest.fixture(autouse=True)
+def misc_cache(tmpdir, monkeypatch):
+    cache = FileCache(str(tmpdir.join("cache")))
+    monkeypatch.setattr(spack.caches, "misc_cache", cache)
+    monkeypatch.setattr(mirrors.health, "_tracker",
+                        mirrors.health.HealthTracker(cache=cache))
+    monkeypatch.setattr(mirrors.blobs, "_blob_cache",
+                        mirrors.blobs.BlobCache(str(tmpdir.join("blobs"))))
+    monkeypatch.setattr(mirrors.oci, "_clients", {})
+    return cache
+
+
+@pytest.fixture
+def small_ranges(monkeypatch):
+    """
+    Split downloads into 1000 byte ranges, so small files have many
+    """
+    monkeypatch.setattr(mirrors.download, "range_size", 1000)
+    return 1000
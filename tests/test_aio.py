@@ -0,0 +1,151 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import collections
+import sys
+import threading
+
+import pytest
+
+if sys.version_info < (3, 6):
+    pytest.skip("mirrors.aio needs Python 3.6", allow_module_level=True)
+
+import asyncio  # noqa: E402
+
+import spack.spec  # noqa: E402
+
+import mirrors.aio as aio  # noqa: E402
+import mirrors.base  # noqa: E402
+import mirrors.errors  # noqa: E402
+import mirrors.index  # noqa: E402
+from mirror import MirrorCollection  # noqa: E402
+
+
+def specfile(i):
+    return ("linux-ubuntu20.04-x86_64-gcc-10.3.0-pkg-%d-1.0-abcdefg.spec.json"
+            % i)
+
+
+@pytest.fixture
+def collection(server):
+    """
+    Two mirrors, "one" with the even specfiles 0-38 and "two" with every
+    specfile 0-39, tried in that order
+    """
+    payload = spack.spec.Spec("zlib@1.2.11").to_json()
+    server.add_build_cache(dict((specfile(i), payload)
+                                for i in range(0, 40, 2)),
+                           prefix="one/build_cache")
+    server.add_build_cache(dict((specfile(i), payload) for i in range(40)),
+                           prefix="two/build_cache")
+    return in_order(server)
+
+
+def in_order(server):
+    collection = MirrorCollection(collections.OrderedDict([
+        ("one", server.url + "/one"), ("two", server.url + "/two")]))
+    collection.health_ordering = False
+    return collection
+
+
+def test_fetch_specs_matches_blocking_lookup(server, collection):
+    names = [specfile(i) for i in range(45)]
+    found = aio.fetch_specs(collection, names)
+
+    expected = in_order(server).fetch_specs(names, jobs=1)
+    assert list(found) == list(expected) == names[:40]
+    assert found[specfile(2)].mirror.name == "one"
+    assert found[specfile(3)].mirror.name == "two"
+    for name in found:
+        assert found[name].spec_url == expected[name].spec_url
+
+
+def test_lookups_overlap(server, collection):
+    server.httpd.latency = 0.2
+    names = [specfile(i) for i in range(1, 40, 2)]
+
+    # Twenty misses on "one" and hits on "two", several in flight at once
+    assert len(aio.fetch_specs(collection, names)) == len(names)
+    assert server.peak > 1
+
+
+def test_transport_per_event_loop():
+    async def transport():
+        return aio.get_transport()
+
+    shared = aio.run(transport())
+    assert aio.run(transport()) is shared
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(transport()) is not shared
+    finally:
+        loop.close()
+
+
+def test_index_and_spec_work_runs_off_the_loop(collection, monkeypatch):
+    threads = []
+
+    def recorded(function):
+        def call(self, *args):
+            threads.append(threading.current_thread())
+            return function(self, *args)
+        return call
+    monkeypatch.setattr(mirrors.index.SpecIndex, "lookup",
+                        recorded(mirrors.index.SpecIndex.lookup))
+    monkeypatch.setattr(mirrors.base.Mirror, "_resolve_spec",
+                        recorded(mirrors.base.Mirror._resolve_spec))
+
+    async def current_thread():
+        return threading.current_thread()
+
+    assert aio.fetch_specs(collection, [specfile(0), specfile(1)])
+    assert threads
+    assert aio.run(current_thread()) not in threads
+
+
+def test_failing_mirror_is_skipped(server, collection, monkeypatch):
+    fetch_spec = aio.AsyncMirror.fetch_spec
+
+    async def forbidden(self, specfile_name):
+        if self.name == "one":
+            raise mirrors.errors.error_for(self.fetch_url, 403)
+        return await fetch_spec(self, specfile_name)
+    monkeypatch.setattr(aio.AsyncMirror, "fetch_spec", forbidden)
+
+    found = aio.fetch_specs(collection, [specfile(0)])
+    assert found[specfile(0)].mirror.name == "two"
+
+
+def test_unexpected_errors_propagate(collection, monkeypatch):
+    async def broken(self, specfile_name):
+        raise ValueError("broken")
+    monkeypatch.setattr(aio.AsyncMirror, "fetch_spec", broken)
+
+    with pytest.raises(ValueError):
+        aio.fetch_specs(collection, [specfile(0)])
+
+
+def test_close_transport():
+    closed = []
+
+    class Client(object):
+        async def close(self):
+            closed.append(self)
+
+    async def use_and_close():
+        transport = aio.get_transport()
+        transport._client = Client()
+        await aio.close_transport()
+        return transport, aio.get_transport()
+
+    loop = asyncio.new_event_loop()
+    try:
+        closed_transport, transport = loop.run_until_complete(use_and_close())
+    finally:
+        loop.close()
+    assert transport is not closed_transport
+    assert closed_transport._client is None
+    assert len(closed) == 1
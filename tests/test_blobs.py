@@ -0,0 +1,86 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import errno
+import hashlib
+import os
+import stat
+import time
+
+import pytest
+
+import mirrors.blobs
+from mirrors.blobs import BlobCache
+
+
+def blob(tmpdir, name, content):
+    path = str(tmpdir.join(name))
+    with open(path, "wb") as fd:
+        fd.write(content)
+    return "sha256:" + hashlib.sha256(content).hexdigest(), path
+
+
+def read(path):
+    with open(path, "rb") as fd:
+        return fd.read()
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return BlobCache(str(tmpdir.join("blobs")), max_size=250)
+
+
+def test_blobs_are_stored_read_only_and_linked(cache, tmpdir):
+    digest, source = blob(tmpdir, "source", b"x" * 100)
+    dest = str(tmpdir.join("out", "dest"))
+
+    assert not cache.link(digest, dest)
+    cache.add(digest, source)
+    assert cache.link(digest, dest)
+
+    assert read(dest) == b"x" * 100
+    assert os.stat(dest).st_ino == os.stat(cache.path(digest)).st_ino
+    assert not os.stat(cache.path(digest)).st_mode & (
+        stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+def test_blobs_are_copied_across_devices(cache, tmpdir, monkeypatch):
+    digest, source = blob(tmpdir, "source", b"x" * 100)
+
+    def cross_device(source, dest):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(mirrors.blobs.os, "link", cross_device)
+
+    dest = str(tmpdir.join("dest"))
+    cache.add(digest, source)
+    assert cache.link(digest, dest)
+    assert read(dest) == b"x" * 100
+    assert os.stat(dest).st_ino != os.stat(cache.path(digest)).st_ino
+
+
+def test_mismatched_blob_is_not_added(cache, tmpdir):
+    digest, _ = blob(tmpdir, "expected", b"expected")
+    _, source = blob(tmpdir, "source", b"tampered")
+
+    cache.add(digest, source, verify=True)
+    assert digest not in cache
+
+
+def test_least_recently_used_blobs_are_evicted(cache, tmpdir):
+    digests = []
+    for i in range(2):
+        digest, source = blob(tmpdir, "source-%d" % i, b"%d" % i * 100)
+        cache.add(digest, source)
+        os.utime(cache.path(digest), (time.time() - 100 + i,) * 2)
+        digests.append(digest)
+
+    # Using the oldest blob makes the other one the least recently used
+    assert cache.link(digests[0], str(tmpdir.join("dest")))
+
+    digest, source = blob(tmpdir, "source-2", b"2" * 100)
+    cache.add(digest, source)
+    assert digests[0] in cache
+    assert digests[1] not in cache
+    assert digest in cache
@@ -0,0 +1,90 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import pytest
+
+from mirrors.base import Mirror
+from mirrors.catalog import Catalog, index_entries, specfile_hash
+
+zlib = "a" * 32
+bzip2 = "b" * 32
+xz = "c" * 32
+
+
+def node(name, version="1.0"):
+    return {"name": name, "version": version,
+            "arch": {"platform": "linux", "platform_os": "ubuntu20.04",
+                     "target": {"name": "x86_64"}},
+            "compiler": {"name": "gcc", "version": "10.3.0"}}
+
+
+def installs(*hashes_and_names):
+    return dict((dag_hash, {"spec": node(name)})
+                for dag_hash, name in hashes_and_names)
+
+
+@pytest.fixture
+def mirrors(server):
+    server.add_build_cache_index(installs((zlib, "zlib"), (bzip2, "bzip2")),
+                                 prefix="one/build_cache")
+    server.add_build_cache_index(installs((zlib, "zlib"), (xz, "xz")),
+                                 prefix="two/build_cache")
+    return (Mirror(server.url + "/one", name="one"),
+            Mirror(server.url + "/two", name="two"))
+
+
+@pytest.fixture
+def catalog(tmpdir):
+    catalog = Catalog(str(tmpdir.join("catalog.db")))
+    yield catalog
+    catalog.close()
+
+
+def test_specfile_names_from_the_index():
+    entries = list(index_entries({"database": {"installs": installs(
+        (zlib, "zlib"))}}))
+    assert entries == [(zlib, "zlib",
+                        "linux-ubuntu20.04-x86_64-gcc-10.3.0-zlib-1.0-%s"
+                        ".spec.json" % zlib)]
+    assert specfile_hash(entries[0][2]) == zlib
+
+    # Older databases key the node by the package name
+    old = dict(node("zlib"))
+    del old["name"]
+    entries = list(index_entries({"database": {"installs": {
+        zlib: {"spec": {"zlib": old}}}}}))
+    assert entries[0][1] == "zlib"
+    assert specfile_hash(entries[0][2]) == zlib
+
+
+def test_hashes_are_located_without_requests(server, mirrors, catalog):
+    one, two = mirrors
+    assert catalog.refresh(one)
+    assert catalog.refresh(two)
+
+    server.reset_requests()
+    found = catalog.locate([zlib, bzip2, xz, "d" * 32])
+    assert server.requests == 0
+    assert sorted(found) == [zlib, bzip2, xz]
+    assert sorted(url for url, _ in found[zlib]) == [one.fetch_url,
+                                                     two.fetch_url]
+    assert found[xz][0][1].endswith("-xz-1.0-%s.spec.json" % xz)
+
+    assert list(catalog.locate([zlib], [two.fetch_url])) == [zlib]
+    assert [row[1] for row in catalog.find("bzip2")] == [one.fetch_url]
+
+
+def test_index_is_downloaded_when_it_changes(server, mirrors, catalog):
+    one, _ = mirrors
+    assert catalog.refresh(one)
+
+    server.reset_requests()
+    assert not catalog.refresh(one)
+    assert list(server.paths) == ["/one/build_cache/index.json.hash"]
+
+    server.add_build_cache_index(installs((xz, "xz")),
+                                 prefix="one/build_cache")
+    assert catalog.refresh(one)
+    assert list(catalog.locate([zlib, xz])) == [xz]
@@ -0,0 +1,77 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import os
+import time
+
+import pytest
+
+import spack.spec
+
+import mirror
+
+names = ["new-a", "new-b", "bad", "old", "new-c", "new-d"]
+
+
+@pytest.fixture
+def log(tmpdir, monkeypatch):
+    """
+    Replace staging a spec with a short sleep, logging the process and the
+    time each spec was added in, under the returned directory
+    """
+    log = tmpdir.join("log")
+    log.ensure(dir=True)
+
+    def add_single_spec(spec, mirror_cache, mirror_stats, policy=None):
+        start = time.time()
+        time.sleep(0.1)
+        if spec.name == "bad":
+            mirror_stats.error()
+        elif spec.name == "old":
+            mirror_stats.already_existed(spec.name + ".tar.gz")
+        else:
+            mirror_stats.added(spec.name + ".tar.gz")
+        log.join(spec.name).write("%d %f %f" % (os.getpid(), start,
+                                                time.time()))
+    monkeypatch.setattr(mirror, "_add_single_spec", add_single_spec)
+    return log
+
+
+def create(path, jobs, host_jobs=None):
+    specs = [spack.spec.Spec(name) for name in names]
+    present, mirrored, errors = mirror.create(str(path), specs, jobs=jobs,
+                                              host_jobs=host_jobs)
+    return (sorted(spec.name for spec in present),
+            sorted(spec.name for spec in mirrored),
+            sorted(spec.name for spec in errors))
+
+
+def entries(log):
+    return [tuple(float(field) for field in log.join(name).read().split())
+            for name in names]
+
+
+def test_parallel_create_matches_serial(tmpdir, log):
+    parallel = create(tmpdir.join("parallel"), jobs=3)
+    assert parallel == (["old"], ["new-a", "new-b", "new-c", "new-d"],
+                        ["bad"])
+    assert create(tmpdir.join("serial"), jobs=1) == parallel
+
+
+def test_specs_are_added_in_worker_processes(tmpdir, log):
+    create(tmpdir.join("mirror"), jobs=3)
+    pids = set(int(pid) for pid, _, _ in entries(log))
+    assert os.getpid() not in pids
+    assert len(pids) > 1
+
+
+def test_host_jobs_limits_specs_per_host(tmpdir, log, monkeypatch):
+    monkeypatch.setattr(mirror, "_spec_host", lambda spec: "example.com")
+    create(tmpdir.join("mirror"), jobs=4, host_jobs=1)
+
+    # With one spec at a time from the host, no two were added at once
+    intervals = sorted((start, end) for _, start, end in entries(log))
+    for (_, end), (start, _) in zip(intervals, intervals[1:]):
+        assert start >= end
@@ -0,0 +1,98 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import hashlib
+import os
+
+from mirrors.download import _RangeDownload, download
+from mirrors.session import session
+
+
+def digest_of(content):
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+def read(path):
+    with open(path, "rb") as fd:
+        return fd.read()
+
+
+def test_ranges_are_checked_as_they_land(server, small_ranges, tmpdir):
+    content = os.urandom(10500)
+    server.add_file("build_cache/x.spack", content)
+    path = str(tmpdir.join("x.spack"))
+
+    download(server.url + "/build_cache/x.spack", path,
+             digest=digest_of(content))
+    assert read(path) == content
+    assert server.paths["/build_cache/x.spack"] == 11
+    assert not os.path.exists(path + ".part")
+    assert not os.path.exists(path + ".part.state")
+
+
+def test_interrupted_download_is_resumed(server, small_ranges, tmpdir):
+    content = os.urandom(10500)
+    server.add_file("build_cache/x.spack", content)
+    url = server.url + "/build_cache/x.spack"
+    path = str(tmpdir.join("x.spack"))
+
+    # The first five ranges made it to disk before the download stopped
+    interrupted = _RangeDownload(url, path, digest=digest_of(content))
+    interrupted._set_size(len(content))
+    interrupted._allocate()
+    with open(interrupted.partial, "r+b") as fd:
+        fd.write(content[:5000])
+    interrupted.done = set(range(5))
+    interrupted._save_state()
+
+    download(url, path, digest=digest_of(content))
+    assert read(path) == content
+    assert server.paths["/build_cache/x.spack"] == 6
+    assert not os.path.exists(path + ".part.state")
+
+
+def test_state_of_another_download_is_ignored(server, small_ranges, tmpdir):
+    content = os.urandom(3500)
+    server.add_file("build_cache/x.spack", content)
+    path = str(tmpdir.join("x.spack"))
+
+    stale = _RangeDownload(server.url + "/build_cache/old.spack", path)
+    stale._set_size(len(content))
+    stale._allocate()
+    stale.done = set(range(4))
+    stale._save_state()
+
+    download(server.url + "/build_cache/x.spack", path,
+             digest=digest_of(content))
+    assert read(path) == content
+
+
+def test_expired_credentials_are_renewed_once(server, small_ranges, tmpdir,
+                                              monkeypatch):
+    content = os.urandom(10500)
+    server.add_file("v2/org/repo/blobs/x", content)
+    path = "/v2/org/repo/blobs/x"
+    server.require_token("first")
+
+    # The token expires once the first range is downloaded
+    get = session.get
+
+    def expiring_get(url, **kwargs):
+        if server.paths[path] == 1:
+            server.require_token("second")
+        return get(url, **kwargs)
+    monkeypatch.setattr(session, "get", expiring_get)
+
+    renewed = []
+
+    def auth(response):
+        renewed.append(response.status)
+        return {"Authorization": "Bearer second"}
+
+    dest = download(server.url + path, str(tmpdir.join("x.spack")),
+                    digest=digest_of(content),
+                    headers={"Authorization": "Bearer first"}, auth=auth)
+    assert read(dest) == content
+    assert renewed == [401]
@@ -0,0 +1,76 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import errno
+import socket
+
+import pytest
+
+from six.moves.urllib.error import HTTPError, URLError
+
+from mirrors.base import Mirror
+from mirrors.errors import error_for, error_from
+
+url = "s3://mirror/build_cache/x.spec.json"
+
+
+@pytest.mark.parametrize("status,kind", [
+    (404, "not_found"),
+    (410, "not_found"),
+    (401, "forbidden"),
+    (403, "forbidden"),
+    (429, "transient"),
+    (503, "transient"),
+    (None, "transient"),
+    (400, "error"),
+])
+def test_error_for_status(status, kind):
+    error = error_for(url, status)
+    assert error.kind == kind
+    assert error.status == status
+
+
+class ClientError(Exception):
+    """
+    The shape of a botocore ClientError
+    """
+    def __init__(self, status):
+        super(ClientError, self).__init__("An error occurred")
+        self.response = {"ResponseMetadata": {"HTTPStatusCode": status}}
+
+
+def raised_from(error, cause):
+    error.__cause__ = cause
+    return error
+
+
+@pytest.mark.parametrize("error,kind", [
+    (Exception("An error occurred (NoSuchKey) when calling GetObject"),
+     "not_found"),
+    (Exception("An error occurred (AccessDenied) when calling GetObject"),
+     "forbidden"),
+    (Exception("An error occurred (SlowDown) when calling GetObject"),
+     "transient"),
+    (Exception("Read timed out"), "transient"),
+    (Exception("Something else went wrong"), "error"),
+    (ClientError(404), "not_found"),
+    (raised_from(Exception("Failed"), ClientError(503)), "transient"),
+    (raised_from(Exception("Failed"),
+                 HTTPError(url, 403, "Forbidden", {}, None)), "forbidden"),
+    (URLError(socket.error(errno.ECONNREFUSED, "Connection refused")),
+     "transient"),
+    (URLError(OSError(errno.ENOENT, "No such file or directory")), "error"),
+])
+def test_error_from_message_or_cause(error, kind):
+    assert error_from(url, error).kind == kind
+
+
+def test_miss_is_one_request(server):
+    mirror = Mirror(server.url, name="test")
+    errors = []
+    assert mirror._get_request(server.url + "/build_cache/missing.json",
+                               errors=errors) is None
+    assert [e.kind for e in errors] == ["not_found"]
+    assert server.requests == 1
@@ -0,0 +1,56 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import pytest
+
+import spack.spec
+
+from mirrors.base import Mirror
+
+
+def names(name):
+    specfile = "linux-ubuntu20.04-x86_64-gcc-10.3.0-%s-1.0-abcdefg" % name
+    return specfile + ".spec.json", specfile + ".spec.yaml"
+
+
+@pytest.fixture
+def payload():
+    # json is valid yaml, so the same content serves both formats
+    return spack.spec.Spec("zlib@1.2.11").to_json()
+
+
+@pytest.fixture
+def mirror(server):
+    return Mirror(server.url, name="test")
+
+
+def test_mirror_format_is_learned(server, mirror, payload):
+    for name in ("first", "second"):
+        server.add_file("build_cache/" + names(name)[1], payload)
+
+    download = mirror.fetch_spec(*names("first"))
+    assert download.spec_url.endswith(".spec.yaml")
+    assert server.requests == 2
+    assert mirror.spec_index.spec_format == "yaml"
+
+    # yaml is tried first from now on
+    server.reset_requests()
+    assert mirror.fetch_spec(*names("second"))
+    assert list(server.paths) == ["/build_cache/" + names("second")[1]]
+
+
+def test_formats_are_raced_until_known(server, mirror, payload):
+    for name in ("first", "second"):
+        for specfile in names(name):
+            server.add_file("build_cache/" + specfile, payload)
+    server.httpd.latency = 0.2
+
+    download = mirror.fetch_spec(*names("first"), race=True)
+    assert download.spec_url.endswith(".spec.json")
+    assert server.peak == 2
+
+    server.reset_requests()
+    assert mirror.fetch_spec(*names("second"), race=True)
+    assert server.requests == 1
@@ -0,0 +1,72 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import pytest
+
+import spack.spec
+
+from mirrors import MirrorGHCR
+
+dates = ["21.%02d" % month for month in range(12, 4, -1)]
+
+
+def specfile(name):
+    return "linux-ubuntu20.04-x86_64-gcc-10.3.0-%s-1.0-abcdefg.spec.json" % (
+        name)
+
+
+@pytest.fixture
+def ghcr(server):
+    server.add_ghcr_dates(dates)
+    return MirrorGHCR({"url": server.url, "oras": "localhost/test"},
+                      name="test")
+
+
+def add_spec(server, name, *dates):
+    payload = spack.spec.Spec("zlib@1.2.11").to_json()
+    for date in dates:
+        server.add_file("_cache/%s/%s" % (date, name), payload)
+
+
+def test_newest_date_wins(server, ghcr):
+    name = specfile("both")
+    add_spec(server, name, dates[5], dates[2])
+
+    download = ghcr.fetch_spec(name, jobs=8)
+    assert download.spec_url == "%s/_cache/%s/%s" % (
+        server.url, dates[2], name)
+
+
+def test_hit_stops_probing(server, ghcr):
+    name = specfile("newest")
+    add_spec(server, name, dates[0])
+
+    assert ghcr.fetch_spec(name, jobs=1)
+    for date in dates[1:]:
+        assert not server.paths["/_cache/%s/%s" % (date, name)]
+
+
+def test_miss_is_remembered(server, ghcr):
+    name = specfile("missing")
+    assert ghcr.fetch_spec(name) is None
+
+    server.reset_requests()
+    assert ghcr.fetch_spec(name) is None
+    assert server.requests == 0
+
+
+def test_probes_run_concurrently(server, ghcr):
+    ghcr.get_prefixes()
+    server.httpd.latency = 0.2
+
+    def lookup(name, jobs):
+        add_spec(server, name, dates[-1])
+        server.reset_requests()
+        assert ghcr.fetch_spec(name, jobs=jobs)
+        return server.peak
+
+    # The specfile is only under the oldest date, so every date is probed
+    assert lookup(specfile("pairs"), 2) == 2
+    assert lookup(specfile("together"), 8) == 8
@@ -0,0 +1,103 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import pytest
+
+from mirrors.base import Mirror
+from mirrors.errors import error_for
+from mirrors.health import HealthTracker, get_tracker
+
+
+@pytest.fixture
+def mirrors(server):
+    server.add_file("one/build_cache/index.json", "{}")
+    return Mirror(server.url + "/one", name="one"), Mirror(
+        server.url + "/two", name="two")
+
+
+def fail(tracker, mirror, times):
+    for _ in range(times):
+        tracker.record(mirror.fetch_url, 0.1, error_for(mirror.fetch_url, 503))
+
+
+def test_breaker_opens_after_failures_in_a_row(mirrors):
+    one, two = mirrors
+    tracker = get_tracker()
+
+    # A file that is not found is a healthy answer, and ends the streak
+    fail(tracker, one, 2)
+    tracker.record(one.fetch_url, 0.1, error_for(one.fetch_url, 404))
+    fail(tracker, one, 2)
+    assert not tracker.is_open(one.fetch_url)
+
+    fail(tracker, one, 1)
+    assert tracker.is_open(one.fetch_url)
+    assert tracker.order([one, two]) == [two]
+
+    # With nothing better to try, open mirrors are tried anyway
+    assert tracker.order([one]) == [one]
+
+
+def test_healthier_mirror_is_tried_first(mirrors):
+    one, two = mirrors
+    tracker = get_tracker()
+
+    tracker.record(one.fetch_url, 0.5)
+    tracker.record(two.fetch_url, 0.1)
+    assert tracker.order([one, two]) == [two, one]
+    assert tracker.order([one, two], priority=lambda m: (
+        0 if m is one else None)) == [one, two]
+
+
+def test_ordering_does_not_use_up_the_probe(mirrors):
+    one, two = mirrors
+    tracker = get_tracker()
+    fail(tracker, one, 3)
+    tracker.get(one.fetch_url).opened -= tracker.cooldown
+
+    # Half open, but no request was made to probe the mirror yet
+    assert one in tracker.order([one, two])
+    assert one in tracker.order([one, two])
+
+    # The first request is the probe, and the others wait for its result
+    tracker.start(one.fetch_url)
+    assert tracker.is_open(one.fetch_url)
+    tracker.record(one.fetch_url, 0.1)
+    assert not tracker.is_open(one.fetch_url)
+
+
+def test_request_probes_a_half_open_mirror(server, mirrors):
+    one, two = mirrors
+    tracker = get_tracker()
+    fail(tracker, one, 3)
+    tracker.get(one.fetch_url).opened -= tracker.cooldown
+
+    one._read(one.fetch_url + "/build_cache/index.json")
+    assert tracker.get(one.fetch_url).opened is None
+    assert tracker.get(one.fetch_url).failures == 0
+
+
+def test_failed_probe_opens_the_breaker_again(mirrors):
+    one, two = mirrors
+    tracker = get_tracker()
+    fail(tracker, one, 3)
+    tracker.get(one.fetch_url).opened -= tracker.cooldown
+
+    tracker.start(one.fetch_url)
+    fail(tracker, one, 1)
+    assert tracker.is_open(one.fetch_url)
+    assert tracker.order([one, two]) == [two]
+
+
+def test_health_is_saved(mirrors, misc_cache):
+    one, two = mirrors
+    tracker = get_tracker()
+    tracker.record(one.fetch_url, 0.2)
+    fail(tracker, two, 3)
+    tracker.save()
+
+    loaded = HealthTracker(cache=misc_cache)
+    assert loaded.get(one.fetch_url).latency == pytest.approx(0.2)
+    assert loaded.is_open(two.fetch_url)
@@ -0,0 +1,140 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import time
+
+import pytest
+
+import spack.spec
+
+from mirrors.base import Mirror
+from mirrors.index import SpecIndex
+
+specfile = "linux-ubuntu20.04-x86_64-gcc-10.3.0-zlib-1.2.11-abcdefg.spec.json"
+deprecated = specfile[:-len(".json")] + ".yaml"
+
+
+def spec_index(**kwargs):
+    return SpecIndex("test", "https://mirror.example.com", **kwargs)
+
+
+def age(index, name, seconds):
+    """
+    Make the recorded entry for name seconds older
+    """
+    index.flush()
+
+    def update(data):
+        data["specs"][name]["time"] -= seconds
+    index._write(update)
+
+
+def test_locations_are_shared_through_the_misc_cache():
+    index = spec_index()
+    index.update(specfile, "https://mirror.example.com/" + specfile)
+    assert index.lookup(specfile)["url"].endswith(specfile)
+
+    # Another process only sees the entry once it is written
+    assert spec_index().lookup(specfile) is None
+    index.flush()
+    assert spec_index().lookup(specfile)["url"].endswith(specfile)
+
+
+def test_locations_expire():
+    index = spec_index(ttl=60)
+    index.update(specfile, "https://mirror.example.com/" + specfile)
+    age(index, specfile, 30)
+    assert index.lookup(specfile)
+
+    age(index, specfile, 60)
+    assert index.lookup(specfile) is None
+
+
+def test_changed_manifest_drops_the_index():
+    index = spec_index()
+    index.validate("first")
+    index.update(specfile, "https://mirror.example.com/" + specfile)
+    index.flush()
+
+    index.validate("first")
+    assert spec_index().lookup(specfile)
+
+    index.validate("second")
+    assert index.empty()
+    assert spec_index().lookup(specfile) is None
+
+
+@pytest.fixture
+def mirror(server):
+    server.add_build_cache({specfile: spack.spec.Spec("zlib").to_json()})
+    server.add_build_cache_index({})
+    return Mirror(server.url, name="test")
+
+
+def test_mirror_remembers_locations(server, mirror):
+    mirror.manifest_check_interval = 0
+    assert mirror.fetch_spec(specfile, deprecated)
+    mirror.spec_index.flush()
+
+    # A fresh mirror in a later run checks the index is still current, and
+    # then goes straight to the specfile
+    mirror = Mirror(server.url, name="test")
+    assert mirror.spec_index.lookup(specfile)["url"].endswith(specfile)
+
+    server.reset_requests()
+    assert mirror.fetch_spec(specfile, deprecated)
+    assert list(server.paths) == ["/build_cache/" + specfile]
+
+
+def test_mirror_drops_locations_when_its_index_changes(server, mirror):
+    mirror.manifest_check_interval = 0
+    assert mirror.fetch_spec(specfile, deprecated)
+    mirror.spec_index.flush()
+
+    server.add_build_cache_index({"abcdefg": {}})
+    assert mirror.spec_index.lookup(specfile) is None
+
+
+def test_flush_is_batched():
+    index = spec_index()
+    index.flush_interval = 60
+    index._flushed = time.time()
+    for i in range(3):
+        index.update("%d-%s" % (i, specfile), None)
+    assert spec_index().empty()
+
+    index.flush_size = 4
+    index.update("3-" + specfile, None)
+    assert len(spec_index()._load()["specs"]) == 4
+
+
+def test_misses_expire_sooner_than_locations():
+    index = spec_index(ttl=600, miss_ttl=60)
+    index.update(specfile, "https://mirror.example.com/" + specfile)
+    index.update(deprecated, None)
+    age(index, specfile, 120)
+    age(index, deprecated, 120)
+
+    assert index.lookup(specfile)
+    assert index.lookup(deprecated) is None
+
+
+def test_mirror_remembers_misses(server):
+    mirror = Mirror({"url": server.url, "miss_ttl": 60}, name="test")
+    assert mirror.spec_index.miss_ttl == 60
+
+    assert mirror.fetch_spec(specfile, deprecated) is None
+    server.reset_requests()
+    assert mirror.fetch_spec(specfile, deprecated) is None
+    assert server.requests == 0
+
+
+def test_failed_lookup_is_not_a_miss(server):
+    mirror = Mirror(server.url, name="test")
+    server.httpd.error_status = 403
+    server.httpd.error_rate = 1.0
+
+    assert mirror.fetch_spec(specfile, deprecated) is None
+    assert mirror.spec_index.lookup(specfile) is None
@@ -0,0 +1,72 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import pytest
+
+from mirrors import MirrorS3
+from mirrors.errors import MirrorRequestError
+from mirrors.keys import Keyring
+
+fingerprints = ["%016X" % i for i in range(1, 6)]
+
+
+@pytest.fixture
+def mirror(server):
+    server.add_keys(fingerprints)
+    return MirrorS3({"url": server.url}, name="s3")
+
+
+@pytest.fixture
+def keyring(tmpdir):
+    return Keyring(str(tmpdir.join("cache", "keys")))
+
+
+def test_only_new_or_changed_keys_are_downloaded(server, mirror, keyring):
+    keys = keyring.sync(mirror)
+    assert sorted(keys) == fingerprints
+    assert server.paths["/build_cache/_pgp/%s.pub" % fingerprints[0]] == 1
+
+    server.reset_requests()
+    assert keyring.sync(mirror) == keys
+    assert server.requests == 1
+
+    changed = dict((fingerprint, {}) for fingerprint in fingerprints)
+    changed[fingerprints[2]] = {"expires": "2030-01-01"}
+    server.add_json("build_cache/_pgp/index.json", {"keys": changed})
+    server.reset_requests()
+    keyring.sync(mirror)
+    assert [path for path in server.paths if path.endswith(".pub")] == [
+        "/build_cache/_pgp/%s.pub" % fingerprints[2]]
+
+
+def test_invalid_fingerprints_are_skipped(server, mirror, keyring, tmpdir):
+    server.add_keys(fingerprints + ["../../escaped"])
+
+    assert sorted(keyring.sync(mirror)) == fingerprints
+    assert not tmpdir.join("escaped.pub").exists()
+    assert not server.paths["/build_cache/_pgp/../../escaped.pub"]
+
+    with pytest.raises(ValueError):
+        keyring.add("../../escaped", b"key")
+    assert not tmpdir.join("escaped.pub").exists()
+
+
+def test_keyrings_on_one_root_keep_each_others_keys(tmpdir):
+    root = str(tmpdir.join("keys"))
+    first, second = Keyring(root), Keyring(root)
+    first.fingerprints()
+    second.fingerprints()
+
+    first.add(fingerprints[0], b"first")
+    second.add(fingerprints[1], b"second")
+    assert Keyring(root).fingerprints() == fingerprints[:2]
+
+
+def test_unreadable_keys_index_raises(server, mirror, keyring):
+    server.httpd.error_status = 403
+    server.httpd.error_rate = 1.0
+
+    with pytest.raises(MirrorRequestError):
+        keyring.sync(mirror)
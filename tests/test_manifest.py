@@ -0,0 +1,68 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import pytest
+
+from mirrors.errors import MirrorRequestError
+from mirrors.manifest import ManifestCache
+from mirrors.session import read_from_url
+
+
+@pytest.fixture
+def url(server):
+    server.add_json("manifest/dates/", {"dates": ["21.12"]})
+    return server.url + "/manifest/dates/"
+
+
+@pytest.fixture
+def statuses():
+    """
+    A read_from_url that records the status of every response
+    """
+    seen = []
+
+    def read(url, **kwargs):
+        result = read_from_url(url, **kwargs)
+        seen.append(result[2].status)
+        return result
+    read.seen = seen
+    return read
+
+
+def test_fresh_manifest_is_not_requested(server, url, misc_cache):
+    assert ManifestCache(cache=misc_cache).get(url) == {"dates": ["21.12"]}
+
+    # Another process reads it from the misc cache
+    server.reset_requests()
+    assert ManifestCache(cache=misc_cache).get(url) == {"dates": ["21.12"]}
+    assert server.requests == 0
+
+
+def test_unchanged_manifest_is_revalidated(server, url, statuses):
+    manifests = ManifestCache(max_age=0)
+    assert manifests.get(url, read=statuses) == {"dates": ["21.12"]}
+    assert manifests.get(url, read=statuses) == {"dates": ["21.12"]}
+    assert statuses.seen == [200, 304]
+
+    server.add_json("manifest/dates/", {"dates": ["22.01", "21.12"]})
+    assert manifests.get(url, read=statuses) == {"dates": ["22.01", "21.12"]}
+    assert statuses.seen == [200, 304, 200]
+
+
+def test_stale_manifest_when_unreachable(server, url):
+    manifests = ManifestCache(max_age=0)
+    assert manifests.get(url)
+
+    server.httpd.error_status = 403
+    server.httpd.error_rate = 1.0
+    assert manifests.get(url) == {"dates": ["21.12"]}
+    with pytest.raises(MirrorRequestError):
+        manifests.get(url, strict=True)
+
+
+def test_missing_manifest(server):
+    manifests = ManifestCache()
+    assert manifests.get(server.url + "/manifest/") is None
+    assert manifests.get(server.url + "/manifest/", strict=True) is None
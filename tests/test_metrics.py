@@ -0,0 +1,101 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import json
+import os
+import stat
+
+import pytest
+
+import spack.spec
+
+from six.moves.urllib.request import urlopen
+
+import mirrors.metrics
+from mirrors import get_instrumentation
+from mirrors.base import Mirror
+from mirrors.errors import error_for
+
+specfile = "linux-ubuntu20.04-x86_64-gcc-10.3.0-zlib-1.2.11-abcdefg.spec.json"
+deprecated = specfile[:-len(".json")] + ".yaml"
+
+
+@pytest.fixture
+def metrics():
+    metrics = mirrors.metrics.enable()
+    yield metrics
+    mirrors.metrics.set_instrumentation(None)
+
+
+def test_default_records_nothing():
+    instrumentation = get_instrumentation()
+    assert type(instrumentation) is mirrors.metrics.Instrumentation
+    with instrumentation.span("fetch_spec") as span:
+        span.error()
+
+
+def test_spans_and_errors(metrics):
+    with metrics.span("pull", "ghcr.io"):
+        pass
+    with pytest.raises(Exception):
+        with metrics.span("pull", "ghcr.io"):
+            raise error_for("https://ghcr.io", 503)
+
+    # A missing file is an answer, not an error
+    with pytest.raises(Exception):
+        with metrics.span("pull", "ghcr.io"):
+            raise error_for("https://ghcr.io", 404)
+
+    pulls = metrics.snapshot()["operations"]["pull"]["ghcr.io"]
+    assert pulls["count"] == 3
+    assert pulls["errors"] == 1
+
+
+def test_mirror_operations_are_recorded(server, metrics):
+    server.add_build_cache({specfile: spack.spec.Spec("zlib").to_json()})
+    mirror = Mirror(server.url, name="test")
+    assert mirror.fetch_spec(specfile, deprecated)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["operations"]["fetch_spec"][server.url]["count"] == 1
+    assert snapshot["operations"]["request"][server.url]["count"] == 1
+    assert snapshot["counters"]["spec_index_misses"][server.url] == 1
+
+
+def test_prometheus_format(metrics):
+    metrics.record("request", 0.02, 'https://mirror.example.com/"x"')
+    metrics.count("archive_bytes", 100, "https://mirror.example.com")
+    text = metrics.to_prometheus()
+
+    labels = 'mirror="https://mirror.example.com/\\"x\\"",operation="request"'
+    assert ('spack_mirror_operation_seconds_bucket{le="0.025",%s} 1' %
+            labels) in text
+    assert 'spack_mirror_operation_seconds_count{%s} 1' % labels in text
+    assert ('spack_mirror_archive_bytes_total'
+            '{mirror="https://mirror.example.com"} 100') in text
+
+
+def test_written_files_are_readable(metrics, tmpdir):
+    metrics.count("blob_cache_hits")
+    for name in ("mirrors.prom", "mirrors.json"):
+        path = str(tmpdir.join(name))
+        metrics.write(path)
+        assert os.stat(path).st_mode & stat.S_IROTH
+
+    with open(str(tmpdir.join("mirrors.json"))) as stream:
+        assert json.load(stream)["counters"]["blob_cache_hits"][""] == 1
+
+
+def test_serve_on_localhost(metrics):
+    metrics.count("blob_cache_hits")
+    server = metrics.serve(0)
+    try:
+        host, port = server.server_address[:2]
+        assert host == "127.0.0.1"
+        body = urlopen("http://127.0.0.1:%d/metrics" % port).read()
+        assert b"spack_mirror_blob_cache_hits_total" in body
+    finally:
+        server.shutdown()
+        server.server_close()
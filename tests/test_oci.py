@@ -0,0 +1,51 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import os
+
+import pytest
+
+from mirrors.blobs import get_blob_cache
+from mirrors.download import DigestMismatchError
+from mirrors.oci import OCIClient
+
+
+def client_for(server):
+    return OCIClient(server.url.split("://", 1)[1], scheme="http")
+
+
+def read(path):
+    with open(path, "rb") as fd:
+        return fd.read()
+
+
+def test_pull_requests_one_token(server, small_ranges, tmpdir):
+    content = os.urandom(5500)
+    digest = server.add_oci_artifact("org/repo", "x.spack", content)
+    server.require_token()
+    client = client_for(server)
+
+    path = client.pull("org/repo", str(tmpdir.join("out")))
+    client.get_manifest("org/repo")
+
+    assert read(path) == content
+    assert os.path.basename(path) == "x.spack"
+    assert server.paths["/token"] == 1
+
+    # Every range carried the token, so none was sent twice
+    assert server.paths["/v2/org/repo/blobs/" + digest] == 6
+
+
+def test_digest_mismatch(server, tmpdir):
+    digest = server.add_oci_artifact("org/repo", "x.spack", b"expected")
+    server.add_file("v2/org/repo/blobs/" + digest, b"tampered")
+    dest = tmpdir.join("out")
+
+    with pytest.raises(DigestMismatchError):
+        client_for(server).pull("org/repo", str(dest))
+
+    assert not dest.join("x.spack").exists()
+    assert not dest.join("x.spack.part").exists()
+    assert digest not in get_blob_cache()
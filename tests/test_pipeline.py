@@ -0,0 +1,172 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import collections
+import io
+import os
+import tarfile
+import threading
+import time
+
+import pytest
+
+import mirrors.pipeline
+from mirrors.download import download
+from mirrors.pipeline import Pipeline
+
+Match = collections.namedtuple("Match", ["spec", "mirror"])
+
+
+class Node(object):
+    """
+    The parts of a concrete Spec the pipeline uses
+    """
+    def __init__(self, name, *dependencies):
+        self.name = name
+        self._dependencies = dependencies
+
+    def dependencies(self):
+        return list(self._dependencies)
+
+    def traverse(self, order="post", root=True):
+        seen = set()
+
+        def visit(node):
+            for dependency in node._dependencies:
+                for child in visit(dependency):
+                    yield child
+            if node.name not in seen:
+                seen.add(node.name)
+                yield node
+        for node in visit(self):
+            if root or node is not self:
+                yield node
+
+
+zlib = Node("zlib")
+ncurses = Node("ncurses", zlib)
+tree = Node("tree", ncurses, zlib)
+other = Node("other")
+
+
+class Mirror(object):
+    """
+    Archives are build_cache/<name>.spack on the server
+    """
+    def __init__(self, server, nodes):
+        self.server = server
+        self.nodes = dict((node.name + ".spec.json", node) for node in nodes)
+
+    def fetch_tarball(self, match, dest):
+        name = match.spec.name + ".spack"
+        return download("%s/build_cache/%s" % (self.server.url, name),
+                        os.path.join(dest, name))
+
+
+class Collection(object):
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def _fetch_first(self, specfile_name):
+        node = self.mirror.nodes.get(specfile_name)
+        if node is not None:
+            return Match(node, self.mirror)
+
+
+def archive(name):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        info = tarfile.TarInfo(name + ".spec.json")
+        info.size = 2
+        tar.addfile(info, io.BytesIO(b"{}"))
+    return stream.getvalue()
+
+
+@pytest.fixture
+def collection(server, monkeypatch):
+    monkeypatch.setattr(mirrors.pipeline, "specfile_name",
+                        lambda spec: spec.name + ".spec.json")
+    nodes = (zlib, ncurses, tree, other)
+    for node in nodes:
+        server.add_file("build_cache/%s.spack" % node.name,
+                        archive(node.name))
+    return Collection(Mirror(server, nodes))
+
+
+def run(pipeline, names):
+    """
+    Run the pipeline in a thread, failing instead of hanging the tests
+    """
+    results = {}
+    thread = threading.Thread(
+        target=lambda: results.update(pipeline.run(names)))
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "the pipeline did not finish"
+    return results
+
+
+def test_dependencies_are_ready_first(collection, tmpdir):
+    ready = []
+    pipeline = Pipeline(collection, dest=str(tmpdir), on_ready=ready.append)
+    results = run(pipeline, ["tree.spec.json", "other.spec.json",
+                             "missing.spec.json"])
+
+    assert sorted(results) == sorted(
+        ["tree.spec.json", "ncurses.spec.json", "zlib.spec.json",
+         "other.spec.json", "missing.spec.json"])
+    assert [name for name, result in results.items() if not result.ok] == [
+        "missing.spec.json"]
+    assert results["missing.spec.json"].error is None
+
+    order = [result.name for result in ready]
+    assert sorted(order) == sorted(results)
+    assert (order.index("zlib.spec.json") <
+            order.index("ncurses.spec.json") <
+            order.index("tree.spec.json"))
+
+
+def test_slow_callback_does_not_hold_the_lock(collection, tmpdir):
+    acquired = []
+
+    def acquire(lock, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if lock.acquire(False):
+                lock.release()
+                return True
+            time.sleep(0.01)
+        return False
+
+    def on_ready(result):
+        if acquired:
+            return
+        # Another result finishes while this callback is still running, and
+        # waits its turn for on_ready without keeping everyone else out
+        deadline = time.time() + 10
+        while len(pipeline._finished) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        acquired.append(acquire(pipeline._lock, 5))
+
+    pipeline = Pipeline(collection, dest=str(tmpdir), verify_jobs=2,
+                        on_ready=on_ready)
+    run(pipeline, ["zlib.spec.json", "other.spec.json"])
+    assert acquired == [True]
+
+
+def test_resolve_error_finishes_the_result(collection, tmpdir,
+                                           monkeypatch):
+    def specfile_name(spec):
+        if spec is ncurses:
+            raise ValueError("no specfile name for ncurses")
+        return spec.name + ".spec.json"
+    monkeypatch.setattr(mirrors.pipeline, "specfile_name", specfile_name)
+
+    pipeline = Pipeline(collection, dest=str(tmpdir), resolve_jobs=1)
+    results = run(pipeline, ["tree.spec.json", "other.spec.json"])
+
+    assert isinstance(results["tree.spec.json"].error, ValueError)
+    assert results["other.spec.json"].ok
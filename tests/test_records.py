@@ -0,0 +1,76 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import collections
+import pickle
+
+import pytest
+
+from mirrors import MirrorDownload, MirrorDownloadSet
+
+FakeMirror = collections.namedtuple("FakeMirror", ["fetch_url"])
+
+
+class FakeSpec(object):
+    def __init__(self, dag_hash):
+        self._dag_hash = dag_hash
+
+    def dag_hash(self):
+        return self._dag_hash
+
+
+one = FakeMirror("https://one.example.com")
+two = FakeMirror("https://two.example.com")
+
+
+def record(dag_hash, mirror):
+    return MirrorDownload(FakeSpec(dag_hash), "%s/build_cache/%s.spec.json" % (
+        mirror.fetch_url, dag_hash), mirror)
+
+
+def test_records_are_immutable():
+    download = record("abc", one)
+    with pytest.raises(AttributeError):
+        download.spec_url = "https://elsewhere.example.com"
+    with pytest.raises(AttributeError):
+        download.extra = True
+    assert not hasattr(download, "__dict__")
+
+
+def test_records_have_a_dictionary_view():
+    download = record("abc", one)
+    assert download["mirror_url"] == one.fetch_url
+    assert download.get("checksum") is None
+    assert download.get("unknown", 1) == 1
+    assert sorted(download.to_dict()) == sorted(download.keys())
+    with pytest.raises(KeyError):
+        download["unknown"]
+
+
+def test_records_compare_by_location():
+    assert record("abc", one) == record("abc", one)
+    assert record("abc", one) != record("abc", two)
+    assert len(set([record("abc", one), record("abc", one)])) == 1
+
+    download = pickle.loads(pickle.dumps(record("abc", one)))
+    assert download == record("abc", one)
+    assert download.dag_hash == "abc"
+
+
+def test_download_set():
+    downloads = MirrorDownloadSet([
+        record("abc", one), record("def", one), record("abc", two)])
+    assert not downloads.add(record("abc", one))
+    assert len(downloads) == 3
+
+    assert "abc" in downloads
+    assert record("abc", two) in downloads
+    assert downloads.hashes() == ["abc", "def"]
+    assert downloads.get("abc").mirror is one
+    assert [d.mirror for d in downloads.by_hash("abc")] == [one, two]
+    assert downloads.by_mirror(two) == [record("abc", two)]
+    assert list(downloads.group_by_mirror()) == [one.fetch_url,
+                                                 two.fetch_url]
+    assert downloads.missing(["abc", "ghi"]) == ["ghi"]
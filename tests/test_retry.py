@@ -0,0 +1,58 @@
+# Copyright 2013-2021 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import errno
+import socket
+
+import pytest
+
+from six.moves.urllib.error import HTTPError, URLError
+
+from mirrors.errors import error_for
+from mirrors.retry import RetryPolicy, is_transient
+
+
+@pytest.mark.parametrize("error", [
+    socket.timeout("timed out"),
+    socket.error(errno.ECONNRESET, "Connection reset by peer"),
+    IOError(errno.EPIPE, "Broken pipe"),
+    URLError("connection refused"),
+    HTTPError("https://mirror.example.com", 503, "Unavailable", {}, None),
+    error_for("https://mirror.example.com", 429),
+])
+def test_transient(error):
+    assert is_transient(error)
+
+
+@pytest.mark.parametrize("error", [
+    OSError(errno.ENOENT, "No such file or directory"),
+    OSError(errno.EACCES, "Permission denied"),
+    IOError(errno.ENOSPC, "No space left on device"),
+    HTTPError("https://mirror.example.com", 404, "Not Found", {}, None),
+    error_for("https://mirror.example.com", 403),
+    ValueError("bad json"),
+])
+def test_not_transient(error):
+    assert not is_transient(error)
+
+
+def test_only_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+    policy = RetryPolicy(attempts=3)
+    calls = []
+
+    def flaky(error):
+        calls.append(error)
+        if len(calls) < 3:
+            raise error
+        return "done"
+
+    assert policy.call(flaky, socket.timeout("timed out")) == "done"
+    assert len(calls) == 3
+
+    del calls[:]
+    with pytest.raises(IOError):
+        policy.call(flaky, IOError(errno.ENOSPC, "No space left on device"))
+    assert len(calls) == 1